@@ -1,3 +1,4 @@
 from .ml_logger import *
 from .server import LogEntry, ALLOWED_TYPES
 from .log_client import LogClient
+from .policies import Every, EverySeconds, LogSpaced, ReservoirSample
@@ -0,0 +1,294 @@
+"""
+Node-local aggregator.
+
+Every training process on a node (DDP ranks, dataloader workers, actors) normally opens its own
+connections to the logging server. The aggregator sits in between: the processes log to it over a
+unix domain socket with `ML_Logger("unix:///tmp/ml-logger.sock")`, and it batches their writes,
+compresses them, and forwards them upstream to the `/batch` route over a few connections.
+
+    python -m ml_logger.aggregator --socket /tmp/ml-logger.sock --upstream http://logger:8081
+
+Writes (`log` and `remove`) are acknowledged right away. Everything else (reads, pings, broadcasts)
+waits for the pending writes to go out first, and is then forwarded as-is, so that a process always
+reads back what it has written.
+"""
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+
+from params_proto import cli_parse, Proto
+
+from ml_logger.serdes import pack_batch
+
+HEADER = struct.Struct("!I")
+
+
+def send_frame(sock, obj):
+    """writes a length-prefixed json frame to a blocking socket."""
+    payload = json.dumps(obj).encode("utf-8")
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_frame(sock):
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return json.loads(_recv_exactly(sock, size).decode("utf-8"))
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("aggregator closed the connection")
+        buf += chunk
+    return bytes(buf)
+
+
+async def read_frame(reader):
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads((await reader.readexactly(size)).decode("utf-8"))
+
+
+async def write_frame(writer, obj):
+    payload = json.dumps(obj).encode("utf-8")
+    writer.write(HEADER.pack(len(payload)) + payload)
+    await writer.drain()
+
+
+def is_write(method, route):
+    """log and remove requests are acknowledged by the aggregator without waiting for upstream."""
+    return route == "/" and method in ("POST", "DELETE")
+
+
+class UnixResponse(NamedTuple):
+    status_code: int
+    text: str
+    headers: dict = {}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+
+class UnixSession:
+    """
+    Stands in for the `FuturesSession` of a `LogClient` with a `unix://` url. Requests go over a small
+    pool of unix socket connections to the aggregator, and return already-completed futures.
+
+    Requests are sent from the calling thread, so requests made from one thread stay in order.
+    """
+
+    def __init__(self, url):
+        """
+        :param url: `unix://` followed by the absolute path to the aggregator's socket.
+        """
+        self.url = url
+        self.path = url[len("unix://"):]
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        """:return: a connection, and whether it was idle in the pool."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock, False
+
+    def _release(self, sock):
+        with self.lock:
+            self.idle.append(sock)
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        route = url[len(self.url):] or "/"
+        reply = not is_write(method, route)
+        frame = dict(method=method, route=route, json=json, headers=headers, reply=reply, timeout=timeout)
+        future = Future()
+        try:
+            response = self._send(frame, reply)
+        except OSError as e:
+            future.set_exception(e)
+        else:
+            future.set_result(response)
+        return future
+
+    def _send(self, frame, reply):
+        while True:
+            sock, idle = self._acquire()
+            try:
+                send_frame(sock, frame)
+                response = UnixResponse(**recv_frame(sock)) if reply else UnixResponse(200, "ok")
+            except OSError:
+                sock.close()
+                # note: an idle connection might be to an aggregator that has restarted since.
+                if idle:
+                    continue
+                raise
+            self._release(sock)
+            return response
+
+    def post(self, url, json=None, **kwargs):
+        return self.request("POST", url, json=json, **kwargs)
+
+    def get(self, url, json=None, **kwargs):
+        return self.request("GET", url, json=json, **kwargs)
+
+    def delete(self, url, json=None, **kwargs):
+        return self.request("DELETE", url, json=json, **kwargs)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sock in idle:
+            sock.close()
+
+
+class Aggregator:
+    """
+    Batches the writes of the processes on a node, and forwards them upstream.
+
+    Writes are split into `connections` shards by their directory, and each shard has at most one
+    batch in flight, so the writes to the same directory reach the server in the order they were
+    made. A `remove` waits for all shards to drain first, since it can cover several directories.
+    """
+
+    def __init__(self, socket_path, upstream, connections=4, interval=1.0, max_batch=1000, max_polls=1024):
+        """
+        :param socket_path: the path of the unix socket to listen on.
+        :param upstream: the http url of the logging server.
+        :param connections: the number of upstream connections, which is also the number of shards.
+        :param interval: the time between two flushes of the pending writes, in seconds.
+        :param max_batch: the number of pending writes in a shard that triggers a flush early.
+        :param max_polls: the number of long-polls (pings and tails) held upstream at once.
+        """
+        self.socket_path = socket_path
+        self.upstream = upstream.rstrip("/")
+        self.connections = connections
+        self.interval = interval
+        self.max_batch = max_batch
+        self.shards = [[] for _ in range(connections)]
+        self.locks = None
+        # reads and long-polls use their own threads, so that they do not hold up the batches. Long-polls
+        #   hold a thread for up to their timeout, so they get a pool of their own, and never hold up reads.
+        self.batch_executor = ThreadPoolExecutor(max_workers=connections)
+        self.executor = ThreadPoolExecutor(max_workers=32)
+        self.poll_executor = ThreadPoolExecutor(max_workers=max_polls)
+        self.local = threading.local()
+        self.loop = None
+        # the open connections, closed on the way out so that the processes reconnect.
+        self.writers = set()
+
+    @property
+    def session(self):
+        """one keep-alive `requests.Session` per thread, i.e. per upstream connection."""
+        if not hasattr(self.local, "session"):
+            import requests
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _send_batch(self, entries):
+        try:
+            res = self.session.post(self.upstream + "/batch", json=dict(data=pack_batch(entries)))
+            if not res.ok:
+                print(f"upstream rejected a batch of {len(entries)} entries: {res.status_code}")
+        except Exception as e:
+            print(f"failed to forward a batch of {len(entries)} entries: {e}")
+
+    def _forward(self, method, route, json, headers=None, timeout=None):
+        # long-polls hold on to the request for `timeout`, so give them some slack on top.
+        timeout = None if timeout is None else timeout + 10
+        try:
+            res = self.session.request(method, self.upstream + route, json=json, headers=headers, timeout=timeout)
+            return dict(status_code=res.status_code, text=res.text, headers=dict(res.headers))
+        except Exception as e:
+            return dict(status_code=502, text=str(e))
+
+    async def flush_shard(self, i):
+        async with self.locks[i]:
+            entries, self.shards[i] = self.shards[i], []
+            if entries:
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(self.batch_executor, self._send_batch, entries)
+
+    async def flush(self):
+        await asyncio.gather(*[self.flush_shard(i) for i in range(self.connections)])
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    frame = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                method, route, json = frame['method'], frame['route'], frame['json']
+                if method == "POST" and is_write(method, route):
+                    i = hash(os.path.dirname(json['key'])) % self.connections
+                    self.shards[i].append((method, json))
+                    if len(self.shards[i]) >= self.max_batch:
+                        asyncio.ensure_future(self.flush_shard(i))
+                elif is_write(method, route):
+                    await self.flush()
+                    await loop.run_in_executor(self.batch_executor, self._send_batch, [(method, json)])
+                else:
+                    await self.flush()
+                    timeout = frame.get('timeout')
+                    executor = self.executor if timeout is None else self.poll_executor
+                    response = await loop.run_in_executor(
+                        executor, self._forward, method, route, json, frame.get('headers'), timeout)
+                    await write_frame(writer, response)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def run(self):
+        loop = self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.locks = [asyncio.Lock() for _ in range(self.connections)]
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = loop.run_until_complete(asyncio.start_unix_server(self.handle, path=self.socket_path))
+        print(f'aggregating {self.socket_path} -> {self.upstream}')
+        tick = loop.create_task(self.tick())
+        try:
+            loop.run_forever()
+        finally:
+            tick.cancel()
+            loop.run_until_complete(self.flush())
+            server.close()
+            for writer in list(self.writers):
+                writer.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            os.remove(self.socket_path)
+
+    def stop(self):
+        """stops `run` from another thread. The pending writes are forwarded first."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@cli_parse
+class Params:
+    socket = Proto("/tmp/ml-logger.sock", help="the unix socket the training processes log to")
+    upstream = Proto("http://localhost:8081", help="the url of the logging server")
+    connections = Proto(4, help="the number of connections to the logging server")
+    interval = Proto(1.0, help="the time between two batches, in seconds")
+
+
+if __name__ == '__main__':
+    Aggregator(Params.socket, Params.upstream, Params.connections, Params.interval).run()
@@ -0,0 +1,124 @@
+"""
+Archives of finished experiments.
+
+`pack` turns an experiment directory into a single zip file next to it, i.e. `sweep/run-1` into
+`sweep/run-1.archive.zip`. The zip's central directory is the index of the members, so a member is
+read from its offset without extracting anything. Images, videos and other compressed formats are
+stored as-is, and everything else is deflated.
+"""
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+
+# the suffix of the archive of a directory.
+ARCHIVE = ".archive.zip"
+# formats that are already compressed, and are stored without compressing them again.
+COMPRESSED = {".png", ".jpg", ".jpeg", ".gif", ".mp4", ".webm", ".avi", ".npz", ".gz", ".zip", ".pt", ".pth"}
+
+
+def pack(src_dir, archive_path):
+    """
+    packs the files under src_dir into a zip file at archive_path, replacing it atomically.
+
+    :return: the number of files packed.
+    """
+    tmp_path = archive_path + ".tmp"
+    n = 0
+    with zipfile.ZipFile(tmp_path, "w", allowZip64=True) as zf:
+        for parent, dirs, files in os.walk(src_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(parent, name)
+                compression = zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in COMPRESSED \
+                    else zipfile.ZIP_DEFLATED
+                zf.write(path, os.path.relpath(path, src_dir), compress_type=compression)
+                n += 1
+    os.replace(tmp_path, archive_path)
+    return n
+
+
+def unpack(archive_path, dst_dir):
+    """
+    extracts the archive into dst_dir. Files that were written to dst_dir after the archive was made
+    are newer, and are kept.
+
+    :return: the names of the members, relative to dst_dir.
+    """
+    with zipfile.ZipFile(archive_path) as zf:
+        names = zf.namelist()
+        for name in names:
+            if not os.path.exists(os.path.join(dst_dir, name)):
+                zf.extract(name, dst_dir)
+    return names
+
+
+class Archives:
+    """
+    Finds the members of the archives under a directory, and keeps the most recently used archives
+    open, so that reading a member costs a seek into an already indexed file.
+    """
+
+    def __init__(self, root, size=16):
+        """
+        :param root: the logging directory.
+        :param size: the number of archives kept open.
+        """
+        self.root = root
+        self.size = size
+        # archive path => (mtime, ZipFile), least recently used first.
+        self.open_files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def find(self, key):
+        """
+        finds the archive that holds `key`, from the closest archived directory above it.
+
+        :return: (ZipFile, ZipInfo), or None if no archive holds the key.
+        """
+        path = os.path.normpath(key)
+        directory = os.path.dirname(path)
+        while directory and directory != ".":
+            archive_path = os.path.join(self.root, directory + ARCHIVE)
+            try:
+                mtime = os.stat(archive_path).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                directory = os.path.dirname(directory)
+                continue
+            zf = self._open(archive_path, mtime)
+            try:
+                return zf, zf.getinfo(os.path.relpath(path, directory))
+            except KeyError:
+                return None
+        return None
+
+    def _open(self, archive_path, mtime):
+        with self.lock:
+            entry = self.open_files.pop(archive_path, None)
+            if entry is not None and entry[0] != mtime:
+                entry[1].close()
+                entry = None
+            if entry is None:
+                entry = mtime, zipfile.ZipFile(archive_path)
+            self.open_files[archive_path] = entry
+            while len(self.open_files) > self.size:
+                _, (_, zf) = self.open_files.popitem(last=False)
+                zf.close()
+            return entry[1]
+
+    def after_fork(self):
+        """
+        starts over in a forked child, with a new lock. The open archives are dropped rather than
+        closed, since they share their file offsets with the parent.
+        """
+        self.lock = threading.Lock()
+        self.open_files = OrderedDict()
+
+    def close(self, archive_path=None):
+        """closes the archive at archive_path, i.e. before it is removed. Closes all of them by default."""
+        with self.lock:
+            paths = list(self.open_files) if archive_path is None else [archive_path]
+            for path in paths:
+                entry = self.open_files.pop(path, None)
+                if entry is not None:
+                    entry[1].close()
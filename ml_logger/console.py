@@ -0,0 +1,115 @@
+import atexit
+import threading
+import time
+import weakref
+from functools import partial
+
+
+class ConsoleRenderer:
+    """ Console Renderer
+    Renders and prints the metric tables from a background thread, at most once every `interval`
+    seconds, so that a slow stdout (i.e. on a networked file system) does not hold up training.
+
+    Only the latest table is kept. Tables that come in faster than the interval are skipped on the
+    console, while the metrics themselves are still logged every step.
+
+    Like `LogPipeline`, the thread and the exit hook only hold a weak reference to the renderer, and
+    `close` stops the thread.
+    """
+
+    def __init__(self, render, interval=5.0):
+        """
+        :param render: callable that receives a submitted snapshot, and prints it.
+        :param interval: the minimum time between two printouts, in seconds.
+        """
+        self.render = render
+        self.interval = interval
+        self.pending = None
+        self.last = 0
+        # note: reentrant, since the render callable might drop the last reference to the logger.
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.closed = False
+        self._at_exit = partial(_flush, weakref.ref(self))
+        atexit.register(self._at_exit)
+        self._start()
+
+    def _start(self):
+        self.thread = threading.Thread(target=_run, args=(weakref.ref(self),))
+        self.thread.daemon = True  # Daemonize thread
+        self.thread.start()
+        self._finalizer = weakref.finalize(self, _stop, self.wake, self.stopped, self._at_exit)
+
+    def close(self):
+        """renders the pending snapshot, and stops the thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self._finalizer()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+    def after_fork(self):
+        """starts over in a forked child, with a new lock and a new thread. The parent prints its own table."""
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.pending = None
+        self._finalizer.detach()
+        if not self.closed:
+            self._start()
+
+    def submit(self, *snapshot):
+        self.pending = snapshot
+        self.wake.set()
+
+    def flush(self):
+        """renders the pending snapshot right away, if there is one."""
+        with self.lock:
+            snapshot, self.pending = self.pending, None
+            if snapshot is not None:
+                self.last = time.time()
+                self.render(*snapshot)
+
+
+def _run(ref):
+    """the rendering thread. Holds the renderer only while it renders, and exits once it is closed or gone."""
+    while True:
+        renderer = ref()
+        if renderer is None or renderer.closed:
+            return
+        wake, stopped = renderer.wake, renderer.stopped
+        del renderer
+        wake.wait()
+        wake.clear()
+        renderer = ref()
+        if renderer is None or renderer.closed:
+            return
+        delay = renderer.last + renderer.interval - time.time()
+        del renderer
+        # note: waits on `stopped` rather than on `wake`, which every new snapshot sets.
+        if delay > 0 and stopped.wait(delay):
+            return
+        renderer = ref()
+        if renderer is None:
+            return
+        try:
+            renderer.flush()
+        except Exception as e:
+            print(e)
+        del renderer
+
+
+def _flush(ref):
+    renderer = ref()
+    if renderer is not None:
+        renderer.flush()
+
+
+def _stop(wake, stopped, at_exit):
+    """wakes the thread up to exit, and drops the exit hook."""
+    atexit.unregister(at_exit)
+    stopped.set()
+    wake.set()
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from fnmatch import fnmatch
+
+from ml_logger.archive import ARCHIVE
+
+
+class DirectoryIndex:
+    """
+    The directories under the logging directory, with the time of the last write into each, kept up
+    to date by `LoggingServer.log` and `LoggingServer.remove`. Listing then never walks the disk.
+
+    The directories are kept in a sorted list, so that a prefix is a contiguous slice found by
+    bisection. The mtime order is a second sorted list of (-mtime, path), where a write moves its
+    directories to their new place.
+
+    The walk that builds the index runs without the lock, either in the background (see `start`)
+    or on first use. The writes and removals made meanwhile are replayed on its result.
+
+    Pages are cut with cursors rather than offsets: a cursor is the sort key of the last entry of
+    the previous page, so the next page starts right after it even if directories were added since.
+
+    Archived directories (see `ml_logger.archive`) are listed as directories.
+    """
+
+    def __init__(self, root, ignore=()):
+        """
+        :param root: the absolute path of the logging directory. Walked once, by `start` or on first use.
+        :param ignore: the names of top-level directories to leave out, i.e. the trash.
+        """
+        self.root = root
+        self.ignore = set(ignore)
+        self.names = None
+        self.mtimes = {}
+        self.by_mtime = None
+        self.lock = threading.Lock()
+        # notified when a walk is done. `pending` holds the writes and removals made during the walk.
+        self.built = threading.Condition(self.lock)
+        self.building = False
+        self.pending = []
+
+    def after_fork(self):
+        """starts over in a forked child, where the walk of the parent does not exist."""
+        self.lock = threading.Lock()
+        self.built = threading.Condition(self.lock)
+        self.building = False
+        self.pending = []
+
+    def start(self):
+        """walks the disk in a background thread, so that the first listing does not have to."""
+        with self.lock:
+            if self.building or self.names is not None:
+                return
+            self.building = True
+        threading.Thread(target=self._build, daemon=True).start()
+
+    def _ensure(self):
+        """builds the index, or waits for the walk in progress. Call without the lock."""
+        with self.lock:
+            while self.building:
+                self.built.wait()
+            if self.names is not None:
+                return
+            self.building = True
+        self._build()
+
+    def _build(self):
+        mtimes = None
+        try:
+            mtimes = self._walk()
+        finally:
+            with self.lock:
+                self.building = False
+                pending, self.pending = self.pending, []
+                if mtimes is not None:
+                    self.mtimes = mtimes
+                    self.names = sorted(mtimes)
+                    self.by_mtime = sorted((-mtime, path) for path, mtime in mtimes.items())
+                    for op, *args in pending:
+                        op(*args)
+                self.built.notify_all()
+
+    def _walk(self):
+        """:return: path => mtime of the directories on disk."""
+        mtimes = {}
+        stack = [""]
+        while stack:
+            path = stack.pop()
+            try:
+                entries = os.scandir(os.path.join(self.root, path))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and (path or entry.name not in self.ignore):
+                        child = os.path.join(path, entry.name)
+                        mtimes[child] = entry.stat(follow_symlinks=False).st_mtime
+                        stack.append(child)
+                    elif entry.name.endswith(ARCHIVE) and entry.is_file(follow_symlinks=False):
+                        child = os.path.join(path, entry.name[:-len(ARCHIVE)])
+                        mtimes[child] = max(mtimes.get(child, 0), entry.stat(follow_symlinks=False).st_mtime)
+        return mtimes
+
+    def touch(self, key, mtime=None):
+        """records a write to the file `key`, which updates its directory and all the ones above it."""
+        path = os.path.dirname(os.path.normpath(key))
+        mtime = time.time() if mtime is None else mtime
+        with self.lock:
+            if self.names is not None:
+                self._touch(path, mtime)
+            elif self.building:
+                self.pending.append((self._touch, path, mtime))
+            # note: otherwise not built yet, and the walk will pick the write up.
+
+    def _touch(self, path, mtime):
+        names, mtimes, by_mtime = self.names, self.mtimes, self.by_mtime
+        while path and path != ".":
+            old = mtimes.get(path)
+            if old != mtime:
+                if old is None:
+                    insort(names, path)
+                else:
+                    del by_mtime[bisect_left(by_mtime, (-old, path))]
+                mtimes[path] = mtime
+                insort(by_mtime, (-mtime, path))
+            path = os.path.dirname(path)
+
+    def discard(self, key):
+        """records the removal of `key`, which drops it and everything underneath it, if it is a directory."""
+        path = os.path.normpath(key)
+        with self.lock:
+            if self.names is not None:
+                self._discard(path)
+            elif self.building:
+                self.pending.append((self._discard, path))
+
+    def _discard(self, path):
+        names, mtimes = self.names, self.mtimes
+        i = bisect_left(names, path)
+        removed = []
+        if i < len(names) and names[i] == path:
+            removed.append(names.pop(i))
+        # note: everything underneath is contiguous, while i.e. `path-2` sorts in between.
+        start = bisect_left(names, path + "/")
+        stop = bisect_left(names, path + "/\U0010ffff")
+        removed += names[start:stop]
+        del names[start:stop]
+        if len(removed) < 64:
+            by_mtime = self.by_mtime
+            for name in removed:
+                del by_mtime[bisect_left(by_mtime, (-mtimes.pop(name), name))]
+        else:
+            # note: one pass over the mtime order beats a deletion per directory of a large tree.
+            for name in removed:
+                mtimes.pop(name)
+            self.by_mtime = [entry for entry in self.by_mtime if entry[1] in mtimes]
+
+    def list(self, prefix="", pattern=None, sort="name", limit=100, cursor=None):
+        """
+        returns a page of directories.
+
+        :param prefix: only the directories whose path starts with this string, i.e. `sweep/lr-`.
+        :param pattern: only the directories whose path matches this glob, i.e. `*/seed-[0-9]`.
+        :param sort: `name` for alphabetical order, or `mtime` for the most recently written first.
+        :param limit: the maximum number of directories in the page.
+        :param cursor: the `cursor` returned with the previous page.
+        :return: dict(entries=[(path, mtime), ...], cursor=...). The cursor is None on the last page.
+        """
+        assert sort in ("name", "mtime"), f"sort has to be `name` or `mtime`, not {sort}"
+        self._ensure()
+        with self.lock:
+            if sort == "name":
+                names = self.names
+                start = bisect_left(names, prefix)
+                if cursor is not None:
+                    start = max(start, bisect_right(names, cursor))
+                keys = (names[i] for i in range(start, len(names)))
+            else:
+                by_mtime = self.by_mtime
+                start = 0 if cursor is None else bisect_right(by_mtime, tuple(cursor))
+                keys = (by_mtime[i][1] for i in range(start, len(by_mtime)))
+
+            entries = []
+            for path in keys:
+                if not path.startswith(prefix):
+                    if sort == "name":
+                        break  # past the end of the prefix.
+                    continue
+                if pattern and not fnmatch(path, pattern):
+                    continue
+                if len(entries) == limit:
+                    last, mtime = entries[-1]
+                    return dict(entries=entries, cursor=last if sort == "name" else (-mtime, last))
+                entries.append((path, self.mtimes[path]))
+            return dict(entries=entries, cursor=None)
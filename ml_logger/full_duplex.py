@@ -6,10 +6,12 @@ import time
 class Duplex(object):
     """ Duplex Agent
     The full duplex agent runs in the background. This is responsible for maintaining `alive` (running) state
-    when the main thread is running. This also allows duplex communication (lots of delay though) with the
-    server without using `server-sent-events` or `websocket`.
+    when the main thread is running. This also allows duplex communication with the server without using
+    `server-sent-events` or `websocket`.
 
-    This is not necessary if we use websocket or other duplex communication protocols.
+    With `long_poll=True`, the thunk is expected to block on the server until a signal arrives (see
+    `LogClient.listen`), so signals come through right away. Without it, the thunk is called once per
+    interval and signals wait until the next call.
 
     When you call
 
@@ -27,15 +29,18 @@ class Duplex(object):
     Make this as thin as possible. 
     """
 
-    def __init__(self, thunk, keep_alive_interval=10):
+    def __init__(self, thunk, keep_alive_interval=10, long_poll=False):
         """
         runs the thunk per interval. Saves the output of the
         thunk in the signal buffer.
 
         :type interval: int
         :param interval: Check interval, in seconds
+        :param long_poll: the thunk blocks until a signal arrives. Call it again right after a signal,
+            and otherwise at most once per interval.
         """
         self.keep_alive_interval = keep_alive_interval
+        self.long_poll = long_poll
         self.thunk = thunk
         self.buffer = []
         self.send_buffer = []
@@ -50,15 +55,20 @@ class Duplex(object):
         """ Method that runs forever """
         import random  # add random bits to avoid simultaneous requests
         while True:
+            started = time.time()
             try:
                 r = self.thunk(*self.send_buffer)
                 self.send_buffer.clear()
                 if r is not None:
                     self.buffer.append(r)
-                scale = 1 + (random.random() - 0.5) * 0.1
-                time.sleep(self.keep_alive_interval * scale)
+                    if self.long_poll:
+                        continue
             except Exception as e:
                 print(e)
+            scale = 1 + (random.random() - 0.5) * 0.1
+            # note: a long poll that returns early without a signal (e.g. on an error) should not spin.
+            elapsed = time.time() - started if self.long_poll else 0
+            time.sleep(max(0, self.keep_alive_interval * scale - elapsed))
 
     def control_thunk(self, signal=None):
         stream = self.thunk(signal) or []
@@ -1,43 +1,573 @@
-from random import randint
+import os
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from datetime import datetime
+from itertools import islice
+from math import exp, floor, log
+
+import numpy as np
+
+# marks a record that holds a block of rows as column arrays, one entry per key.
+COLUMNAR = "__columnar__"
+
+
+class PickleIndex:
+    """
+    The byte offsets of the records in a pickle log, and the number of rows up to the end of each
+    record. `load_from_pickle` builds it as a by-product of reading the whole file, so that later
+    reads know the row count, and can seek to a record without decoding the ones before it.
+    """
+
+    def __init__(self):
+        self.offsets = array('q')
+        self.row_ends = array('q')
+        self.end = 0
+        self.mtime = None
+
+    @property
+    def n_rows(self):
+        return self.row_ends[-1] if self.row_ends else 0
+
+    @property
+    def nbytes(self):
+        return (len(self.offsets) + len(self.row_ends)) * self.offsets.itemsize
+
+    def copy(self):
+        index = PickleIndex()
+        index.offsets, index.row_ends = array('q', self.offsets), array('q', self.row_ends)
+        index.end, index.mtime = self.end, self.mtime
+        return index
+
+    def add(self, offset, record):
+        n = 1
+        if is_columnar(record):
+            n = max((len(v) for v in record.values() if np.ndim(v)), default=0)
+        self.offsets.append(offset)
+        self.row_ends.append(self.n_rows + n)
+
+
+# absolute path => PickleIndex of the files that have been read to the end, least recently used
+# first. Bounded by the bytes of the offsets, since a server reads every file it serves with
+# `load_from_pickle`, and the index of a long metric log holds 16 bytes per record.
+_pickle_indices = OrderedDict()
+_pickle_indices_lock = threading.Lock()
+_pickle_indices_bytes = 0
+MAX_PICKLE_INDEX_BYTES = 16 << 20
+
+
+def _reset_after_fork():
+    global _pickle_indices_lock
+    _pickle_indices_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _remember_index(abs_path, index):
+    global _pickle_indices_bytes
+    with _pickle_indices_lock:
+        old = _pickle_indices.pop(abs_path, None)
+        if old is not None:
+            _pickle_indices_bytes -= old.nbytes
+        if index.nbytes > MAX_PICKLE_INDEX_BYTES:
+            return
+        _pickle_indices[abs_path] = index
+        _pickle_indices_bytes += index.nbytes
+        while _pickle_indices_bytes > MAX_PICKLE_INDEX_BYTES:
+            _, evicted = _pickle_indices.popitem(last=False)
+            _pickle_indices_bytes -= evicted.nbytes
+
+
+def _forget_index(abs_path):
+    global _pickle_indices_bytes
+    with _pickle_indices_lock:
+        index = _pickle_indices.pop(abs_path, None)
+        if index is not None:
+            _pickle_indices_bytes -= index.nbytes
+
+
+def pickle_index(path):
+    """
+    returns the index of the pickle log if it is known and up-to-date, otherwise None. Records that were
+    appended since the index was built are indexed now, by decoding only the new part of the file.
+
+    Cached indices are never changed in place: the new records are added to a copy, which replaces it.
+    """
+    import dill
+    abs_path = os.path.abspath(path)
+    with _pickle_indices_lock:
+        index = _pickle_indices.get(abs_path)
+        if index is None:
+            return None
+        _pickle_indices.move_to_end(abs_path)
+    stat = os.stat(abs_path)
+    if stat.st_size == index.end and stat.st_mtime == index.mtime:
+        return index
+    if stat.st_size < index.end:
+        _forget_index(abs_path)
+        return None
+    index = index.copy()
+    try:
+        with open(abs_path, 'rb') as f:
+            f.seek(index.end)
+            while f.tell() < stat.st_size:
+                offset = f.tell()
+                index.add(offset, dill.load(f))
+            index.end, index.mtime = f.tell(), stat.st_mtime
+    except Exception:  # overwritten, or a record is still being written.
+        _forget_index(abs_path)
+        return None
+    _remember_index(abs_path, index)
+    return index
 
 
 def load_from_pickle(path='parameters.pkl'):
     import dill
+    index = PickleIndex()
     with open(path, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime
         while True:
+            offset = f.tell()
             try:
-                yield dill.load(f)
+                d = dill.load(f)
             except EOFError:
                 break
+            index.add(offset, d)
+            yield d
+        index.end, index.mtime = offset, mtime
+    _remember_index(os.path.abspath(path), index)
+
+
+def read_pickle_from(path, offset=0):
+    """
+    reads the records appended to a pickle log after the byte `offset`. Stops before a record that is
+    still being written, so that the next call reads it in full.
+
+    :return: the records, and the offset to continue from. When the file has become shorter than the
+        offset, i.e. because it was overwritten, it is read again from the start.
+    """
+    import dill
+    records = []
+    with open(path, 'rb') as f:
+        if offset > os.fstat(f.fileno()).st_size:
+            offset = 0
+        f.seek(offset)
+        while True:
+            try:
+                record = dill.load(f)
+            except Exception:  # EOFError at the end, anything else on a partly written record.
+                break
+            records.append(record)
+            offset = f.tell()
+    return records, offset
+
+
+class PickleFollower:
+    """
+    Follows a pickle log as it grows, like `tail -f`. Remembers the offset of the last record it has
+    decoded, so that every read only decodes the records appended since. A record that is still being
+    written is left for the next read.
+
+    Iterating yields the records one by one, and blocks for new ones in between. `poll` returns the
+    new records as a list, without blocking.
+
+    When `inotify_simple` is installed (linux only), the wait for new data blocks on inotify events of
+    the file. Otherwise the file is checked every `interval` seconds.
+    """
+
+    def __init__(self, path, offset=0, block=True, timeout=None, interval=1.0, inotify=None):
+        """
+        :param path: the pickle file. Does not have to exist yet.
+        :param offset: the byte offset to start from, 0 for the whole file.
+        :param block: whether iterating waits for new records, or stops once the file is read.
+        :param timeout: the longest time to wait for new records before the iteration stops, in seconds.
+            None waits forever.
+        :param interval: the time between checks of the file, when inotify is not used.
+        :param inotify: True to require inotify, False to never use it, and None to use it if available.
+        """
+        self.path = os.path.abspath(path)
+        self.offset = offset
+        self.block = block
+        self.timeout = timeout
+        self.interval = interval
+        self.pending = deque()
+        self.inotify = None
+        if inotify or inotify is None:
+            try:
+                from inotify_simple import INotify, flags
+            except ImportError:
+                if inotify:
+                    raise
+            else:
+                self.inotify = INotify()
+                try:
+                    self.inotify.add_watch(os.path.dirname(self.path),
+                                           flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE | flags.MOVED_TO)
+                except OSError:  # i.e. the directory does not exist yet.
+                    self.close()
+                    if inotify:
+                        raise
+
+    def poll(self):
+        """returns the records appended since the last read, which can be an empty list."""
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            return []
+        if size == self.offset:
+            return []
+        records, self.offset = read_pickle_from(self.path, self.offset)
+        return records
+
+    def wait(self, timeout=None):
+        """blocks until the file might have changed, or the timeout runs out."""
+        if self.inotify is None:
+            time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+            return
+        name = os.path.basename(self.path)
+        for event in self.inotify.read(timeout=None if timeout is None else int(timeout * 1000)):
+            if event.name == name:
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        while not self.pending:
+            self.pending.extend(self.poll())
+            if self.pending:
+                break
+            remaining = None if self.timeout is None else self.timeout - (time.time() - start)
+            if not self.block or remaining is not None and remaining <= 0:
+                raise StopIteration
+            self.wait(remaining)
+        return self.pending.popleft()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def follow_pickle(path, offset=0, block=True, timeout=None, interval=1.0, inotify=None):
+    """
+    yields the records of a pickle log, and then the records that are appended to it, as they come in.
+    Decodes every record only once. See `PickleFollower` for the arguments.
 
+    example:
 
-def sample(stream, k):
+        follower = follow_pickle("runs/exp/metrics.pkl")
+        for record in follower:  # blocks for new records
+            ...
+        new_records = follower.poll()  # or check for new records without blocking
     """
+    return PickleFollower(path, offset, block, timeout, interval, inotify)
+
+
+def is_columnar(record):
+    return type(record) is dict and record.get(COLUMNAR, False)
+
+
+def local_datetime64(epoch_seconds):
+    """converts an array of `time.time()` values to datetime64, in local time like regular records."""
+    offset = datetime.now().astimezone().utcoffset().total_seconds()
+    return ((epoch_seconds + offset) * 1e6).astype('datetime64[us]')
+
+
+def expand_columnar(records):
+    """
+    expands columnar records back into one dictionary per row. Other records are passed through.
+
+    Scalar entries are repeated on every row, and datetime columns come back as strings, same as
+    the `_timestamp` of regular metric records.
+
+    :param records: an iterable of log records, i.e. from `load_from_pickle`
+    :return: generator of the records, row by row.
+    """
+    for record in records:
+        if not is_columnar(record):
+            yield record
+            continue
+        columns, length = {}, 0
+        for k, v in record.items():
+            if k == COLUMNAR:
+                continue
+            if np.ndim(v) == 0:
+                columns[k] = v
+                continue
+            if isinstance(v, np.ndarray):
+                if v.dtype.kind == "M":
+                    v = np.datetime_as_string(v).tolist()
+                elif v.ndim == 1:
+                    v = v.tolist()
+            columns[k] = v
+            length = len(v)
+        for i in range(length):
+            yield {k: v[i] if isinstance(v, (list, np.ndarray)) else v for k, v in columns.items()}
+
+
+class Reservoir:
+    """
+    Online reservoir sampling: keeps a uniform sample of k items out of a stream of unknown length.
+
+    Uses Algorithm L (Li, 1994), which draws the number of items to skip until the next one that goes
+    into the reservoir. Random numbers are only drawn when the reservoir changes, instead of once per item.
+
+    :param k: the reservoir size
+    :param seed: seed for the random number generator, for a reproducible sample.
+    """
+
+    def __init__(self, k, seed=None):
+        self.k = k
+        self.rng = random.Random(seed)
+        self.count = 0
+        self.items = []
+        self.next = k - 1
+        self.w = 1.0
+
+    def _advance(self):
+        rng = self.rng
+        self.w *= exp(log(1.0 - rng.random()) / self.k)
+        gap = floor(log(1.0 - rng.random()) / log(1 - self.w)) if self.w < 1 else 0
+        self.next += gap + 1
+
+    @property
+    def skip(self):
+        """the number of items that will be dropped before the next one is taken."""
+        return max(0, self.next - self.count) if self.count >= self.k else 0
+
+    def add(self, item):
+        """
+        offers the item to the reservoir.
+
+        :return: True if the item is kept, False if it is dropped right away.
+        """
+        count = self.count
+        self.count = count + 1
+        if count < self.k:
+            self.items.append((count, item))
+            if count == self.k - 1:
+                self._advance()
+            return True
+        if count < self.next:
+            return False
+        self.items[self.rng.randrange(self.k)] = (count, item)
+        self._advance()
+        return True
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        """yields the sampled items in the order they came in."""
+        for i, d in sorted(self.items, key=lambda t: t[0]):
+            yield d
+
+
+def sample(stream, k, seed=None):
+    """
+    uniformly samples k items out of the stream, in the order they came in.
 
     :param stream:
     :param k: the reservoir size
+    :param seed: seed for a reproducible sample
     :return:
     """
+    reservoir = Reservoir(k, seed)
+    stream = iter(stream)
+    for d in stream:
+        reservoir.add(d)
+        skip = reservoir.skip
+        if skip:
+            # note: drop the skipped items without looking at them.
+            deque(islice(stream, skip), maxlen=0)
+            reservoir.count += skip
+    yield from reservoir
 
-    reservoir = []
-    for count, d in enumerate(stream):
-        if count < k:
-            reservoir.append((count, d))
-        else:
-            ind = randint(0, count)
-            if ind < k:
-                reservoir[ind] = (count, d)
-    for i, d in sorted(reservoir, key=lambda t: t[0]):
-        yield d
 
+def sample_pickle(path, k, seed=None):
+    """
+    uniformly samples k rows out of a pickle log. Columnar records count as one row per entry.
+
+    When the row count of the file is known (see `PickleIndex`), the row numbers are sampled first, and
+    only the records holding them are decoded. Otherwise the whole file is streamed through `sample`.
+
+    :param path: path to the pickle file
+    :param k: the number of rows
+    :param seed: seed for a reproducible sample
+    :return: generator of the sampled rows, in the order of the file.
+    """
+    import dill
+    index = pickle_index(path)
+    if index is None:
+        yield from sample(expand_columnar(load_from_pickle(path)), k, seed)
+        return
+    rows = sorted(random.Random(seed).sample(range(index.n_rows), min(k, index.n_rows)))
+    current, records = None, None
+    with open(path, 'rb') as f:
+        for row in rows:
+            i = bisect_right(index.row_ends, row)
+            if i != current:
+                f.seek(index.offsets[i])
+                current, records = i, list(expand_columnar([dill.load(f)]))
+            yield records[row - (index.row_ends[i - 1] if i else 0)]
+
+
+def _column_array(values, downcast=False):
+    """turns a list of values into a typed 1-D array. `None` marks missing values."""
+    try:
+        arr = np.asarray(values)
+    except ValueError:  # ragged sequences
+        arr = None
+    if arr is None or arr.ndim != 1 or (arr.dtype.kind == "U" and not all(type(v) is str for v in values)):
+        arr = np.empty(len(values), dtype=object)
+        for i, v in enumerate(values):
+            arr[i] = v
+    elif arr.dtype == object:
+        try:  # numbers with missing values in between
+            arr = np.asarray(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            pass
+    if downcast and arr.dtype == np.float64:
+        arr = arr.astype(np.float32)
+    return arr
+
+
+def _promote(a, b):
+    if a == b:
+        return a
+    if (a.kind in "biuf" and b.kind in "biuf") or (a.kind == b.kind == "U"):
+        return np.promote_types(a, b)
+    return np.dtype(object)
+
+
+class _Columns:
+    """Typed column arrays, filled chunk by chunk. Rows where a key is missing are NaN (or None)."""
+
+    def __init__(self, capacity=0, downcast=False):
+        self.capacity = capacity
+        self.downcast = downcast
+        self.size = 0
+        self.arrays = OrderedDict()
+        self.filled = {}
 
-def load_pickle_as_dataframe(path='data.pkl', k=None):
-    import pandas
+    def extend(self, columns, n):
+        """
+        :param columns: dictionary of key => list or array of n values
+        :param n: the number of rows
+        """
+        start, end = self.size, self.size + n
+        for key, values in columns.items():
+            arr = values if isinstance(values, np.ndarray) and values.ndim == 1 else \
+                _column_array(values, self.downcast)
+            if key not in self.arrays:
+                self.arrays[key] = np.empty(max(self.capacity, end), dtype=arr.dtype)
+                self.filled[key] = 0
+            self._pad(key, start)
+            col = self._fit(key, arr.dtype, end)
+            col[start:end] = arr
+            self.filled[key] = end
+        self.size = end
+
+    def _fit(self, key, dtype, end):
+        col = self.arrays[key]
+        dtype = _promote(col.dtype, dtype)
+        if len(col) < end or dtype != col.dtype:
+            new = np.empty(max(end, 2 * len(col)) if len(col) < end else len(col), dtype=dtype)
+            new[:self.filled[key]] = col[:self.filled[key]]
+            col = self.arrays[key] = new
+        return col
+
+    def _pad(self, key, end):
+        start = self.filled[key]
+        if start >= end:
+            return
+        kind = self.arrays[key].dtype.kind
+        if kind in "biu":
+            self._fit(key, np.dtype(np.float32 if self.downcast else np.float64), end)
+        elif kind not in "fcMO":
+            self._fit(key, np.dtype(object), end)
+        col = self._fit(key, self.arrays[key].dtype, end)
+        col[start:end] = np.datetime64("NaT") if col.dtype.kind == "M" else \
+            None if col.dtype == object else np.nan
+        self.filled[key] = end
+
+    def to_dataframe(self, columns=None):
+        import pandas
+        for key in self.arrays:
+            self._pad(key, self.size)
+        keys = [k for k in columns if k in self.arrays] if columns else list(self.arrays)
+        return pandas.DataFrame(OrderedDict((k, self.arrays[k][:self.size]) for k in keys), copy=False)
+
+
+def load_pickle_as_dataframe(path='data.pkl', k=None, columns=None, downcast=False, chunk_size=10000, n_rows=None):
+    """
+    loads a pickle log (i.e. `metrics.pkl`) as a pandas DataFrame.
+
+    The records are read in chunks of `chunk_size` rows, and each chunk is turned into typed column
+    arrays right away, so the memory stays close to the size of the final frame. Columnar records
+    (from `ML_Logger.log_batch` or `schema`) are copied over column by column.
+
+    :param path: path to the pickle file.
+    :param k: randomly sample k rows from the file.
+    :param columns: only load these columns.
+    :param downcast: store float64 columns as float32.
+    :param chunk_size: the number of rows decoded before they are turned into columns.
+    :param n_rows: hint for the number of rows, to allocate the columns up-front. Defaults to the row
+        count from the index, when the file has been read before.
+    :return: pandas.DataFrame
+    """
+    select = set(columns) if columns else None
     if k:
-        d = pandas.DataFrame([_ for _ in sample(load_from_pickle(path), k)])
+        records, n_rows = sample_pickle(path, k), k
     else:
-        d = pandas.DataFrame([_ for _ in load_from_pickle(path)])
-    return d
+        records = load_from_pickle(path)
+        if n_rows is None:
+            index = pickle_index(path)
+            n_rows = index.n_rows if index else None
+    builder = _Columns(n_rows or 0, downcast)
+
+    chunk = []
+
+    def flush_chunk():
+        keys = OrderedDict()
+        for row in chunk:
+            for key in row:
+                if select is None or key in select:
+                    keys[key] = None
+        builder.extend({key: [row.get(key) for row in chunk] for key in keys}, len(chunk))
+        chunk.clear()
+
+    for record in records:
+        if is_columnar(record):
+            if chunk:
+                flush_chunk()
+            block = {key: v for key, v in record.items() if key != COLUMNAR and (select is None or key in select)}
+            n = max((len(v) for v in record.values() if np.ndim(v)), default=0)
+            for key, v in block.items():
+                if np.ndim(v) == 0:
+                    block[key] = [v] * n
+                elif isinstance(v, np.ndarray) and v.dtype.kind == "M":
+                    # note: keep the same type as the `_timestamp` string of the regular records.
+                    block[key] = np.datetime_as_string(v).astype(object)
+                elif isinstance(v, np.ndarray) and v.ndim > 1:
+                    block[key] = list(v)
+                elif downcast and isinstance(v, np.ndarray) and v.dtype == np.float64:
+                    block[key] = v.astype(np.float32)
+            builder.extend(block, n)
+        else:
+            chunk.append(record if isinstance(record, dict) else dict(enumerate(record)))
+            if len(chunk) >= chunk_size:
+                flush_chunk()
+    if chunk:
+        flush_chunk()
+    return builder.to_dataframe(columns)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import cloudpickle
+import numpy as np
+from ruamel.yaml import YAML, StringIO
+
+
+class KVStore:
+    """
+    Small records (presence, status and parameters) keyed by their path, in a SQLite database in WAL
+    mode. Updates are atomic upserts, so concurrent pings never see or write a half-merged record, and
+    the primary key on the path makes lookups, and listings by prefix, index scans.
+
+    The records stand in for the YAML files the server used to rewrite on every update. `to_yaml`
+    generates the file on demand, when it is read.
+
+    The store also indexes the parameters of the experiments, one row per flattened parameter, so
+    that `query` finds experiments by their parameter values without loading any parameter file.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the database file. Created on first use.
+        """
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        """one connection per thread, reopened in a forked child."""
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS records (path TEXT PRIMARY KEY, data BLOB, mtime REAL)")
+            # numbers (and booleans) go in `num`, strings in `text`, so that both compare by value.
+            conn.execute("CREATE TABLE IF NOT EXISTS params (prefix TEXT, key TEXT, num REAL, text TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS params_num ON params (key, num)")
+            conn.execute("CREATE INDEX IF NOT EXISTS params_text ON params (key, text)")
+            conn.execute("CREATE INDEX IF NOT EXISTS params_prefix ON params (prefix)")
+            self.local.conn, self.local.pid = conn, pid
+        return self.local.conn
+
+    def close(self):
+        """closes the connection of the calling thread. The ones of other threads close with their threads."""
+        conn = getattr(self.local, "conn", None)
+        # note: a connection inherited over a fork is only dropped, since it belongs to the parent.
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = self.local.pid = None
+
+    @contextmanager
+    def transaction(self):
+        """a write transaction, taken up-front so that read-modify-writes do not interleave."""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, path):
+        """:return: the record at path, or None."""
+        row = self.conn.execute("SELECT data FROM records WHERE path = ?", (path,)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, path, data):
+        """replaces the record at path."""
+        self.conn.execute("INSERT OR REPLACE INTO records (path, data, mtime) VALUES (?, ?, ?)",
+                          (path, cloudpickle.dumps(data), time.time()))
+
+    def update(self, path, data):
+        """
+        merges the keys of data into the record at path, in one transaction.
+
+        :return: the merged record
+        """
+        with self.transaction() as conn:
+            return self._merge(conn, path, data)
+
+    @staticmethod
+    def _merge(conn, path, data):
+        row = conn.execute("SELECT data FROM records WHERE path = ?", (path,)).fetchone()
+        record = {} if row is None else pickle.loads(row[0])
+        record.update(data)
+        conn.execute("INSERT OR REPLACE INTO records (path, data, mtime) VALUES (?, ?, ?)",
+                     (path, cloudpickle.dumps(record), time.time()))
+        return record
+
+    def delete(self, path):
+        """deletes the record at path, and every record underneath it. An empty path deletes all of them."""
+        path = os.path.normpath(path).strip("/") if path else ""
+        if not path or path == ".":
+            self.conn.execute("DELETE FROM records")
+            self.conn.execute("DELETE FROM params")
+            return
+        # note: `0` is the character right after `/`, so this is the range of `path/...`.
+        clause, args = "path = ? OR (path >= ? AND path < ?)", (path, path + "/", path + "0")
+        # most removals are of files, which have no records. Reading first skips the write lock.
+        # Indexed parameters always come with their `parameters.yml` record.
+        if self.conn.execute(f"SELECT 1 FROM records WHERE {clause} LIMIT 1", args).fetchone():
+            self.conn.execute(f"DELETE FROM records WHERE {clause}", args)
+            self.conn.execute(f"DELETE FROM params WHERE {clause.replace('path', 'prefix')}", args)
+
+    def list(self, prefix=""):
+        """:return: the paths of the records that start with prefix, in order."""
+        rows = self.conn.execute("SELECT path FROM records WHERE path >= ? AND path < ? ORDER BY path",
+                                 (prefix, prefix + "\U0010ffff"))
+        return [path for path, in rows]
+
+    def index(self, prefix, params):
+        """replaces the indexed parameters of the experiment at prefix, see `flatten`."""
+        with self.transaction() as conn:
+            self._index(conn, prefix, params)
+
+    @staticmethod
+    def _index(conn, prefix, params):
+        rows = [(prefix, key, *value) for key, value in flatten(params).items()]
+        conn.execute("DELETE FROM params WHERE prefix = ?", (prefix,))
+        conn.executemany("INSERT INTO params (prefix, key, num, text) VALUES (?, ?, ?, ?)", rows)
+
+    def update_params(self, path, prefix, params, merge=True):
+        """
+        writes the parameters record at path, and indexes it for the experiment at prefix, in one
+        transaction.
+
+        :param merge: merges the sections of params into the record. False replaces the record.
+        :return: the record
+        """
+        with self.transaction() as conn:
+            if merge:
+                record = self._merge(conn, path, params)
+            else:
+                record = dict(params)
+                conn.execute("INSERT OR REPLACE INTO records (path, data, mtime) VALUES (?, ?, ?)",
+                             (path, cloudpickle.dumps(record), time.time()))
+            self._index(conn, prefix, record)
+        return record
+
+    def query(self, where=(), prefix="", limit=1000):
+        """
+        finds the experiments whose parameters match all the predicates.
+
+        :param where: a list of (key, op, value) predicates, i.e. `("Args.seed", "<", 5)`. The key is
+            the flattened parameter, and op is one of `==`, `!=`, `<`, `<=`, `>`, `>=`, `in` (with a
+            list of values) and `prefix` (for strings).
+        :param prefix: only the experiments whose path starts with this string.
+        :param limit: the maximum number of experiments to return.
+        :return: the sorted list of the matching experiment prefixes.
+        """
+        selects, args = [], []
+        for key, op, value in where:
+            assert op in QUERY_OPS, f"op has to be one of {', '.join(QUERY_OPS)}, not {op}"
+            if op == "prefix":
+                condition, values = "text >= ? AND text < ?", [value, value + "\U0010ffff"]
+            elif op == "in":
+                value = list(value)
+                column = "text" if value and isinstance(value[0], str) else "num"
+                condition, values = f"{column} IN ({', '.join('?' * len(value))})", value
+            else:
+                column = "text" if isinstance(value, str) else "num"
+                condition, values = f"{column} {QUERY_OPS[op]} ?", [value]
+            selects.append(f"SELECT prefix FROM params WHERE key = ? AND {condition}")
+            args += [key, *values]
+        matches = " INTERSECT ".join(selects) or "SELECT DISTINCT prefix FROM params"
+        rows = self.conn.execute(f"SELECT prefix FROM ({matches}) WHERE prefix >= ? AND prefix < ? "
+                                 f"ORDER BY prefix LIMIT ?", (*args, prefix, prefix + "\U0010ffff", limit))
+        return [path for path, in rows]
+
+
+# the predicates of `KVStore.query`, and their SQL operator.
+QUERY_OPS = {"==": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=", "in": None, "prefix": None}
+
+
+def flatten(params, parent=""):
+    """
+    flattens nested dictionaries of parameters into `section.key` keys, i.e. `Args.lr`.
+
+    :return: dict of key => (num, text). Only numbers, booleans and strings are kept.
+    """
+    flat = {}
+    for key, value in params.items():
+        key = f"{parent}.{key}" if parent else str(key)
+        if isinstance(value, np.generic):
+            value = value.item()
+        if hasattr(value, "items"):
+            flat.update(flatten(value, key))
+        elif isinstance(value, (bool, int, float)):
+            flat[key] = float(value), None
+        elif isinstance(value, str):
+            flat[key] = None, value
+    return flat
+
+
+def to_yaml(data):
+    """the YAML file of a record."""
+    yaml = YAML()
+    stream = StringIO()
+    yaml.dump(data, stream)
+    return stream.getvalue()
@@ -1,47 +1,169 @@
 import os
+import threading
+import weakref
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from requests_futures.sessions import FuturesSession
-from ml_logger.serdes import serialize, deserialize
+from ml_logger.aggregator import UnixSession
+from ml_logger.read_cache import ReadCache
+from ml_logger.serdes import serialize, deserialize, deserialize_many
 from ml_logger.server import LogEntry, LoadEntry, PingData, LoggingServer, ALLOWED_TYPES, Signal, LogOptions, \
-    RemoveEntry
+    RemoveEntry, ListenData, BroadcastEntry, ListEntry, TailEntry, MultiEntry, ParamsQuery, ArchiveEntry
+
+
+# the dtypes of `LoadEntry`, which the read cache keys its entries by.
+READ_TYPES = ("read", "read_text", "read_pkl", "read_np")
 
 
 class LogClient:
     local_server = None
+    # url -> the client shared by all loggers in this process, see `shared` and `release`.
+    registry = {}
+    registry_lock = threading.Lock()
+    # every open client, so that their sessions can be reopened in a forked child.
+    instances = weakref.WeakSet()
 
     def __init__(self, url: str = None, max_workers=None):
         if url.startswith("file://"):
             self.local_server = LoggingServer(data_dir=url[6:])
         elif os.path.isabs(url):
             self.local_server = LoggingServer(data_dir=url)
-        elif url.startswith('http://'):
+        elif url.startswith('http://') or url.startswith('unix://'):
             self.url = url
             self.ping_url = os.path.join(url, "ping")
+            self.list_url = os.path.join(url, "list")
+            self.tail_url = os.path.join(url, "tail")
+            self.multi_url = os.path.join(url, "multi")
+            self.trash_url = os.path.join(url, "trash")
+            self.params_url = os.path.join(url, "params")
+            self.archive_url = os.path.join(url, "archive")
+            self.listen_url = os.path.join(url, "listen")
+            self.broadcast_url = os.path.join(url, "broadcast")
         else:
             # todo: add https://, and s3://
-            raise TypeError('log url need to begin with `/`, `file://` or `http://`.')
-        if max_workers:
-            self.session = FuturesSession(ThreadPoolExecutor(max_workers=max_workers))
+            raise TypeError('log url need to begin with `/`, `file://`, `http://` or `unix://`.')
+        self.key = url
+        self.max_workers = max_workers
+        self.refs = 0
+        # the read cache, off until `enable_cache`.
+        self.cache = None
+        self._open()
+        LogClient.instances.add(self)
+
+    def _open(self):
+        if self.local_server:
+            return
+        if self.url.startswith('unix://'):
+            # requests to a node-local aggregator are sent from the calling thread, and stay in order.
+            self.session = self.ordered_session = UnixSession(self.url)
         else:
-            self.session = FuturesSession()
+            if self.max_workers:
+                self.session = FuturesSession(ThreadPoolExecutor(max_workers=self.max_workers))
+            else:
+                self.session = FuturesSession()
+            # a single worker sends the requests one at a time, in the order they are made.
+            self.ordered_session = FuturesSession(ThreadPoolExecutor(max_workers=1))
 
-    def _get(self, key, dtype):
+    @classmethod
+    def shared(cls, url, max_workers=None):
+        """
+        returns the client for the url that is shared across the process, and creates it on first use.
+        Every call needs a matching `release`. The first caller picks the `max_workers`.
+        """
+        with cls.registry_lock:
+            client = cls.registry.get(url)
+            if client is None:
+                client = cls.registry[url] = cls(url, max_workers)
+            client.refs += 1
+            return client
+
+    def release(self):
+        """drops a reference from `shared`, and closes the client once the last one is gone."""
+        with LogClient.registry_lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            if LogClient.registry.get(self.key) is self:
+                del LogClient.registry[self.key]
+        self.close()
+
+    def close(self):
+        """waits for the pending requests, then closes the sessions and shuts down their thread pools."""
         if self.local_server:
-            return self.local_server.load(key, dtype)
+            self.local_server.close()
+            return
+        for session in {self.session, self.ordered_session}:
+            executor = getattr(session, "executor", None)
+            if executor is not None:
+                executor.shutdown(wait=True)
+            session.close()
+
+    def enable_cache(self, max_bytes=256 << 20, disk_dir=None, max_disk_bytes=4 << 30, max_age=0):
+        """
+        turns on the read cache for the reads from the server, or replaces it. See `ReadCache`.
+
+        :param max_bytes: the size of the memory tier.
+        :param disk_dir: the directory for the disk tier. None keeps the cache in memory only.
+        :param max_disk_bytes: the size of the disk tier.
+        :param max_age: the time (in seconds) an entry is used without revalidating it with the server.
+        :return: the new cache
+        """
+        self.cache = ReadCache(max_bytes, disk_dir, max_disk_bytes, max_age)
+        return self.cache
+
+    def _get(self, key, dtype, start=None, stop=None, cache=True):
+        """
+        reads from the server. With `enable_cache`, reads go through the read cache, which asks the
+        server to confirm its copy with the ETag, so reading a file that has not changed since costs
+        a `304 Not Modified`.
+
+        :param start: for `read`, the first byte to read. Negative values count from the end.
+        :param stop: for `read`, the byte to stop at (exclusive).
+        :param cache: False to go to the server, and leave the cache alone, i.e. for live data.
+        """
+        if self.local_server:
+            return self.local_server.load(key, dtype, start, stop)
+        json = LoadEntry(key, dtype)._asdict()
+        if start is not None or stop is not None:
+            if stop is not None and stop <= max(start or 0, 0):
+                return b""
+            headers = {'Range': byte_range(start, stop)}
+            res = self.session.get(self.url, json=json, headers=headers).result()
+            if res.status_code == 416:
+                return b""
+            data = deserialize(res.text)
+            # note: a server that ignores the range sends the whole file.
+            return data if res.status_code == 206 or data is None else data[start:stop]
+        if not cache or self.cache is None:
+            return deserialize(self.session.get(self.url, json=json).result().text)
+
+        read_cache = self.cache
+        cached = read_cache.get((key, dtype))
+        if cached and read_cache.fresh(cached):
+            return deserialize(cached.text)
+        headers = {'If-None-Match': cached.etag} if cached else None
+        # note: reading stuff from the server is always synchronous via the result call.
+        res = self.session.get(self.url, json=json, headers=headers).result()
+        if res.status_code == 304 and cached:
+            read_cache.validated((key, dtype), cached)
+            return deserialize(cached.text)
+        etag = res.headers.get('ETag')
+        if etag and res.ok:
+            read_cache.put((key, dtype), etag, res.text)
         else:
-            json = LoadEntry(key, dtype)._asdict()
-            # note: reading stuff from the server is always synchronous via the result call.
-            res = self.session.get(self.url, json=json).result()
-            result = deserialize(res.text)
-            return result
+            read_cache.discard((key, dtype))
+        return deserialize(res.text)
 
-    def _post(self, key, data, dtype, options: LogOptions = None):
+    def _post(self, key, data, dtype, options: LogOptions = None, ordered=False):
         if self.local_server:
             self.local_server.log(key, data, dtype, options)
         else:
             # todo: make the json serialization more robust. Not priority b/c this' client-side.
             json = LogEntry(key, serialize(data), dtype, options)._asdict()
-            self.session.post(self.url, json=json)
+            session = self.ordered_session if ordered else self.session
+            self._forget(key)
+            return session.post(self.url, json=json)
 
     def _delete(self, key):
         if self.local_server:
@@ -49,8 +171,15 @@ class LogClient:
         else:
             # todo: make the json serialization more robust. Not priority b/c this' client-side.
             json = RemoveEntry(key)._asdict()
+            self._forget(key)
             self.session.delete(self.url, json=json)
 
+    def _forget(self, key):
+        # note: entries within `max_age` are not revalidated, so drop the ones this client writes to.
+        if self.cache is not None and self.cache.max_age:
+            for dtype in READ_TYPES:
+                self.cache.discard((key, dtype))
+
     def ping(self, exp_key, status, _duplex=True, burn=True):
         # todo: add configuration for early termination
         if self.local_server:
@@ -65,30 +194,194 @@ class LogClient:
                 # note: I wonder if we should raise if the response is non-ok.
                 return deserialize(response.text) if response.ok else None
 
+    def listen(self, exp_key, status, timeout=120, burn=True):
+        """
+        long-polling version of `ping`. Blocks until a signal arrives for `exp_key` or the `timeout`
+        runs out, so signals are received right away instead of at the next ping.
+
+        :param exp_key: the experiment prefix
+        :param status: the status to report
+        :param timeout: the time (in seconds) the server holds on to the request.
+        :param burn: whether the server should remove the signal once read.
+        :return: the list of signals, or None
+        """
+        if self.local_server:
+            signals = self.local_server.listen(exp_key, status, timeout, burn)
+            return deserialize(signals)
+        else:
+            listen_data = ListenData(exp_key, status, timeout, burn)._asdict()
+            # note: give the server some slack before timing out on our side.
+            response = self.session.post(self.listen_url, json=listen_data, timeout=timeout + 10).result()
+            return deserialize(response.text) if response.ok else None
+
     # send signals to the worker
     def send_signal(self, exp_key, signal=None):
         options = LogOptions(overwrite=True)
         channel = os.path.join(exp_key, "__signal.pkl")
         self._post(channel, signal, dtype="log", options=options)
 
-    # Reads binary data
-    def read(self, key):
-        return self._get(key, dtype="read")
+    def broadcast_signal(self, pattern, signal=None):
+        """
+        send a signal to every experiment matching the pattern, in a single request.
+
+        :param pattern: glob pattern or prefix of the experiment keys, i.e. `sweep/lr-*`
+        :param signal: the signal to send
+        :return: the list of experiment keys that receive the signal
+        """
+        if self.local_server:
+            return self.local_server.broadcast(pattern, signal)
+        else:
+            json = BroadcastEntry(pattern, serialize(signal))._asdict()
+            response = self.session.post(self.broadcast_url, json=json).result()
+            return deserialize(response.text) if response.ok else None
+
+    def list(self, prefix="", pattern=None, sort="name", limit=100, cursor=None):
+        """
+        lists the directories on the server, one page at a time, without walking the disk.
+
+        :param prefix: only the directories whose path starts with this string
+        :param pattern: only the directories whose path matches this glob
+        :param sort: `name`, or `mtime` for the most recently written first
+        :param limit: the size of the page
+        :param cursor: the cursor returned with the previous page
+        :return: dict(entries=[(path, mtime), ...], cursor=...). The cursor is None on the last page.
+        """
+        if self.local_server:
+            return self.local_server.list(prefix, pattern, sort, limit, cursor)
+        else:
+            json = ListEntry(prefix, pattern, sort, limit, cursor)._asdict()
+            response = self.session.get(self.list_url, json=json).result()
+            return deserialize(response.text) if response.ok else None
+
+    def query_params(self, where=(), prefix="", limit=1000):
+        """
+        finds the experiments by their parameter values, from the index the server keeps of the
+        `parameters.pkl` files. See `KVStore.query`.
+
+        :param where: a list of (key, op, value) predicates, i.e. `[("Args.lr", "==", 3e-4), ("Args.seed", "<", 5)]`
+        :param prefix: only the experiments whose path starts with this string
+        :param limit: the maximum number of experiments
+        :return: the sorted list of the matching experiment prefixes
+        """
+        if self.local_server:
+            return self.local_server.query_params(where, prefix, limit)
+        else:
+            json = ParamsQuery(where, prefix, limit)._asdict()
+            response = self.session.get(self.params_url, json=json).result()
+            return deserialize(response.text) if response.ok else None
+
+    def archive(self, key, unpack=False):
+        """
+        packs the directory at key into a single archive file on the server, which is still read
+        file by file. See `LoggingServer.archive`.
+
+        :param key: the path of the directory
+        :param unpack: extracts the archive back into the directory instead
+        :return: the number of files
+        """
+        if self.local_server:
+            return self.local_server.unarchive(key) if unpack else self.local_server.archive(key)
+        else:
+            json = ArchiveEntry(key, unpack)._asdict()
+            response = self.session.post(self.archive_url, json=json).result()
+            return deserialize(response.text) if response.ok else None
+
+    def trash_status(self):
+        """
+        the progress of the server on deleting removed directories in the background.
+
+        :return: dict(pending=..., removed=..., current=...): the number of directories left, the
+            number of files deleted since the server started, and the directory being deleted.
+        """
+        if self.local_server:
+            return self.local_server.trash.status()
+        else:
+            response = self.session.get(self.trash_url).result()
+            return deserialize(response.text) if response.ok else None
+
+    def tail(self, key, offset=0, record=None, timeout=30):
+        """
+        long-polls for the records appended to a pickle file after the cursor. Returns right away if
+        there are some, and otherwise as soon as the server writes to the file.
+
+        :param key: the path to the pickle file
+        :param offset: the byte offset to read from, i.e. the `offset` returned by the previous call
+        :param record: the number of records to skip instead of the byte offset
+        :param timeout: the time (in seconds) the server holds on to the request
+        :return: dict(records=[...], offset=..., record=...)
+        """
+        if self.local_server:
+            return self.local_server.tail(key, offset, record, timeout)
+        else:
+            json = TailEntry(key, offset, record, timeout)._asdict()
+            response = self.session.post(self.tail_url, json=json, timeout=timeout + 10).result()
+            return deserialize(response.text) if response.ok else None
+
+    # Reads binary data, or the bytes from start to stop.
+    def read(self, key, start=None, stop=None, cache=True):
+        return self._get(key, dtype="read", start=start, stop=stop, cache=cache)
+
+    def read_text(self, key, cache=True):
+        return self._get(key, dtype="read_text", cache=cache)
 
     # Reads binary data
-    def read_pkl(self, key):
-        return self._get(key, dtype="read_pkl")
+    def read_pkl(self, key, cache=True):
+        return self._get(key, dtype="read_pkl", cache=cache)
 
-    def read_np(self, key):
-        return self._get(key, dtype="read_np")
+    def read_np(self, key, cache=True):
+        return self._get(key, dtype="read_np", cache=cache)
 
-    # appends data
-    def log(self, key, data, **options):
-        self._post(key, data, dtype="log", options=LogOptions(**options))
+    def read_many(self, keys, dtype="read_pkl", chunk_size=32, max_parallel=8):
+        """
+        reads many files at once. The keys are sent to the server's `/multi` route in chunks, which
+        each come back in one response, with at most `max_parallel` requests in flight. Local
+        loggers load the chunks from a pool of `max_parallel` threads instead, which mostly wait on
+        the disk.
+
+        Reads here do not go through the read cache.
+
+        :param keys: the paths of the files
+        :param dtype: the read type, i.e. `read_pkl`, `read_np` or `read_text`
+        :param chunk_size: the number of keys per request (or per task, for local loggers)
+        :param max_parallel: the number of requests in flight (or of threads, for local loggers)
+        :return: the list of the loaded files, in the order of the keys. None for the missing ones.
+        """
+        keys = list(keys)
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        if self.local_server:
+            if len(chunks) < 2 or max_parallel < 2:
+                return self.local_server.load_many(keys, dtype)
+            with ThreadPoolExecutor(min(max_parallel, len(chunks))) as pool:
+                loaded = pool.map(self.local_server.load_many, chunks, repeat(dtype))
+                return [data for chunk in loaded for data in chunk]
+
+        results, pending = [], deque()
+
+        def collect():
+            chunk, future = pending.popleft()
+            response = future.result()
+            results.extend(deserialize_many(response.text) if response.ok else [None] * len(chunk))
+
+        for chunk in chunks:
+            if len(pending) >= max_parallel:
+                collect()
+            json = MultiEntry(chunk, dtype)._asdict()
+            pending.append((chunk, self.session.get(self.multi_url, json=json)))
+        while pending:
+            collect()
+        return results
+
+    # appends data. `ordered` requests are sent one after another, in order.
+    def log(self, key, data, ordered=False, **options):
+        return self._post(key, data, dtype="log", options=LogOptions(**options), ordered=ordered)
+
+    # appends a list of data items, one after another
+    def log_many(self, key, items, ordered=False, **options):
+        return self._post(key, items, dtype="log_many", options=LogOptions(**options), ordered=ordered)
 
     # appends text
-    def log_text(self, key, text):
-        self._post(key, text, dtype="text")
+    def log_text(self, key, text, ordered=False):
+        return self._post(key, text, dtype="text", ordered=ordered)
 
     # sends out images
     def send_image(self, key, data):
@@ -98,3 +391,26 @@ class LogClient:
     # appends text
     def log_buffer(self, key, buf):
         self._post(key, buf, dtype="byte")
+
+
+def byte_range(start=None, stop=None):
+    """the `Range` header for the bytes from start to stop (exclusive), with python's slice semantics."""
+    if start is not None and start < 0:
+        assert stop is None, "a range that counts from the end has to run to the end."
+        return "bytes={}".format(start)
+    return "bytes={}-{}".format(start or 0, "" if stop is None else stop - 1)
+
+
+def _reopen_after_fork():
+    """the thread pools, connections and locks of the parent do not survive a fork, so the child opens its own."""
+    LogClient.registry_lock = threading.Lock()
+    for client in list(LogClient.instances):
+        if client.local_server:
+            client.local_server.after_fork()
+        if client.cache is not None:
+            client.cache.lock = threading.Lock()
+        client._open()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reopen_after_fork)
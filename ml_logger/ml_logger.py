@@ -1,50 +1,372 @@
 from io import BytesIO
 
 import os
+import re
+import threading
+import time
+import weakref
 from datetime import datetime
 import pytz
 
 from typing import Union, Callable, Any
 from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from functools import lru_cache
 from itertools import zip_longest
 
+from ml_logger.console import ConsoleRenderer
 from ml_logger.full_duplex import Duplex
+from ml_logger.helpers import COLUMNAR, expand_columnar, local_datetime64
 from ml_logger.log_client import LogClient
+from ml_logger.pipeline import LogPipeline
+from ml_logger.policies import ReservoirSample
 from termcolor import colored as c
 import numpy as np
 
 
+class P2Quantile:
+    """
+    Streaming quantile estimate with the P² algorithm (Jain & Chlamtac, 1985). Keeps five markers,
+    so both memory and the cost of `append` are constant.
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * q, 4 * q, 2 + 2 * q, 4]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def append(self, x):
+        h, n = self.heights, self.positions
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+
+        if x < h[0]:
+            h[0], k = x, 0
+        elif x >= h[4]:
+            h[4], k = x, 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # adjust the middle markers if they are off by more than one position
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                        (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+                        (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+                if h[i - 1] < parabolic < h[i + 1]:
+                    h[i] = parabolic
+                else:
+                    h[i] = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    @property
+    def value(self):
+        h = self.heights
+        if len(h) == 5:
+            return h[2]
+        # not enough samples for the markers yet, so we just read it off the sorted values.
+        return h[round(self.q * (len(h) - 1))] if h else None
+
+
 class Stream:
-    def __init__(self, len=100):
-        self.d = deque(maxlen=len)
+    """
+    Running statistics over a window of the last `len` values.
+
+    The values are kept in a numpy ring buffer. The sum is maintained incrementally, and min/max use
+    monotonic deques, so `append` and every read are O(1) (amortized). On top of the window, the stream
+    keeps an exponential moving average and P² estimates of the `quantiles`, over all values seen.
+
+    example:
+
+        step_times = Stream(len=100, quantiles=(0.5, 0.99))
+        step_times.append(dt)
+        step_times.mean, step_times.ema, step_times.quantile(0.99)
+
+    :param len: the size of the window
+    :param alpha: the smoothing factor of the EMA. Defaults to 2 / (len + 1).
+    :param quantiles: the quantiles to estimate, between 0 and 1.
+    """
+
+    def __init__(self, len=100, alpha=None, quantiles=()):
+        self.maxlen = len
+        self.alpha = 2 / (len + 1) if alpha is None else alpha
+        self.buffer = np.empty(len, dtype=np.float64)
+        self.count = 0
+        self.sum = 0.0
+        self._ema = None
+        # (index, value) pairs, decreasing in value for max and increasing for min.
+        self._max = deque()
+        self._min = deque()
+        self.quantiles = {q: P2Quantile(q) for q in quantiles}
 
     def append(self, d):
-        self.d.append(d)
+        i, n = self.count, self.maxlen
+        if i >= n:
+            self.sum -= self.buffer[i % n]
+        self.buffer[i % n] = d
+        self.sum += d
+        self.count = i + 1
+        if self.count % n == 0:
+            # recompute once per window, so that floating point errors do not pile up.
+            self.sum = float(self.buffer.sum())
+
+        _max, _min = self._max, self._min
+        while _max and _max[-1][1] <= d:
+            _max.pop()
+        _max.append((i, d))
+        if _max[0][0] <= i - n:
+            _max.popleft()
+        while _min and _min[-1][1] >= d:
+            _min.pop()
+        _min.append((i, d))
+        if _min[0][0] <= i - n:
+            _min.popleft()
+
+        self._ema = d if self._ema is None else self._ema + self.alpha * (d - self._ema)
+        for estimate in self.quantiles.values():
+            estimate.append(d)
+
+    def __len__(self):
+        return min(self.count, self.maxlen)
+
+    @property
+    def d(self):
+        """the values in the window, oldest first."""
+        n = self.maxlen
+        if self.count <= n:
+            return self.buffer[:self.count].copy()
+        return np.roll(self.buffer, -(self.count % n))
 
     @property
     def latest(self):
-        return self.d[-1]
+        if not self.count:
+            raise IndexError('the stream is empty')
+        return self._max[-1][1]
 
     @property
     def mean(self):
-        try:
-            return np.mean(self.d)
-        except ValueError:
-            return None
+        return self.sum / len(self) if self.count else None
 
     @property
     def max(self):
-        try:
-            return np.max(self.d)
-        except ValueError:
-            return None
+        return self._max[0][1] if self.count else None
 
     @property
     def min(self):
-        try:
-            return np.min(self.d)
-        except ValueError:
-            return None
+        return self._min[0][1] if self.count else None
+
+    @property
+    def ema(self):
+        return self._ema
+
+    def quantile(self, q):
+        """the streaming estimate of quantile `q`. It has to be one of the `quantiles` of the stream."""
+        return self.quantiles[q].value
+
+
+class MetricBuffer:
+    """
+    Preallocated column buffers for a fixed set of metric keys, one row per step. Used by
+    `ML_Logger.schema` to log without allocating anything per call.
+
+    Logging the same key twice within a step overwrites the value. Keys that are not logged
+    in a step are left as NaN (0 for integer columns).
+    """
+    sidecar = False
+
+    def __init__(self, capacity=4096, **dtypes):
+        self.capacity = capacity
+        # only the thread that declared the schema takes the fast path, since the writes are not locked.
+        self.owner = threading.get_ident()
+        self.steps = np.empty(capacity, dtype=np.int64)
+        self.timestamps = np.empty(capacity, dtype=np.float64)
+        self.columns = {k: np.empty(capacity, dtype=dtype) for k, dtype in dtypes.items()}
+        self.size = 0
+        self.clear()
+
+    def clear(self):
+        for col in self.columns.values():
+            col.fill(np.nan if col.dtype.kind in "fc" else 0)
+        self.size = 0
+
+    def accepts(self, values):
+        columns = self.columns
+        for k in values:
+            if k not in columns:
+                return False
+        return True
+
+    def write(self, step, values):
+        """
+        writes the values into the row of the step.
+
+        :return: False if the step needs a new row and the buffer is full, in which case nothing is written.
+        """
+        i = self.size - 1
+        if i < 0 or self.steps[i] != step:
+            i = self.size
+            if i == self.capacity:
+                return False
+            self.size = i + 1
+            self.steps[i] = step
+            self.timestamps[i] = time.time()
+        columns = self.columns
+        for k, v in values.items():
+            columns[k][i] = v
+        return True
+
+    def to_record(self):
+        """returns the filled rows as a columnar record, with the same keys as a regular metric record."""
+        n = self.size
+        return {COLUMNAR: True, "_step": self.steps[:n].copy(), "_timestamp": local_datetime64(self.timestamps[:n]),
+                **{k: col[:n].copy() for k, col in self.columns.items()}}
+
+
+class Accumulator:
+    """
+    A typed, growable buffer for the values of one key, reduced to summary statistics on flush.
+    Used by `ML_Logger.accumulate`.
+
+    The supported statistics are `mean`, `std`, `min`, `max`, `sum`, `count`, `median`, and
+    percentiles written as `p<q>`, i.e. `p90` or `p99.9`.
+    """
+    STATS = ("mean", "std", "min", "max", "sum", "count", "median")
+    PERCENTILE = re.compile(r"p\d+(\.\d+)?")
+
+    @classmethod
+    def check(cls, stats):
+        """raises a `ValueError` on the statistics that are not supported."""
+        unknown = [stat for stat in stats if stat not in cls.STATS and not cls.PERCENTILE.fullmatch(stat)]
+        if unknown:
+            raise ValueError(f"unsupported statistics {unknown}, use {', '.join(cls.STATS)} or percentiles like p90")
+
+    def __init__(self, stats, dtype=np.float64, capacity=256, silent=False):
+        self.check(stats)
+        self.stats = stats
+        self.silent = silent
+        self.values = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, v):
+        n = np.size(v)
+        end = self.size + n
+        if end > len(self.values):
+            values = np.empty(max(end, 2 * len(self.values)), dtype=self.values.dtype)
+            values[:self.size] = self.values[:self.size]
+            self.values = values
+        if n == 1 and np.ndim(v) == 0:
+            self.values[self.size] = v
+        else:
+            self.values[self.size:end] = np.ravel(v)
+        self.size = end
+
+    def clear(self):
+        self.size = 0
+
+    def reduce(self):
+        """returns an ordered dict of statistic => value for the values collected so far."""
+        values = self.values[:self.size]
+        percentiles = [(stat, 50 if stat == 'median' else float(stat[1:]))
+                       for stat in self.stats if stat == 'median' or self.PERCENTILE.fullmatch(stat)]
+        results = OrderedDict()
+        if percentiles:
+            for (stat, _), v in zip(percentiles, np.percentile(values, [q for _, q in percentiles])):
+                results[stat] = v
+        for stat in self.stats:
+            if stat == 'count':
+                results[stat] = self.size
+            elif stat not in results:
+                results[stat] = getattr(np, stat)(values)
+        return OrderedDict((stat, results[stat]) for stat in self.stats)
+
+
+class Stage:
+    """
+    The key/value pairs, silent keys and accumulators that one thread has logged in the current step.
+    `ML_Logger` keeps one per thread, so that `log` only takes the uncontended lock of the calling
+    thread. The stages are merged on flush.
+    """
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.silent = set()
+        self.accumulators = OrderedDict()
+
+
+class StepData(MutableMapping):
+    """
+    `ML_Logger.data`: the key/value pairs of the current step, from all threads. Reads see the stages
+    merged, like the row `flush` writes. Setting a key replaces it in every stage with the value in
+    the stage of the calling thread, and deleting a key deletes it from all of them.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def _stages(self):
+        with self.logger._stages_lock:
+            return list(self.logger._stages)
+
+    def _merged(self):
+        data = OrderedDict()
+        for stage in self._stages():
+            with stage.lock:
+                for key, v in stage.data.items():
+                    _put(data, key, v)
+        return data
+
+    def __getitem__(self, key):
+        return self._merged()[key]
+
+    def __setitem__(self, key, value):
+        own = self.logger._stage()
+        for stage in self._stages():
+            with stage.lock:
+                if stage is own:
+                    stage.data[key] = value
+                else:
+                    stage.data.pop(key, None)
+
+    def __delitem__(self, key):
+        found = False
+        for stage in self._stages():
+            with stage.lock:
+                if key in stage.data:
+                    del stage.data[key]
+                    found = True
+        if not found:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._merged())
+
+    def __len__(self):
+        return len(self._merged())
+
+    def __repr__(self):
+        return repr(self._merged())
+
+
+def _put(data, key, v):
+    """adds a value to the key/value pairs of a step, the way repeated calls to `log` do."""
+    if key in data:
+        data[key] = [data[key], v]
+    else:
+        data[key] = v
 
 
 class Color:
@@ -106,46 +428,205 @@ def brown(value, *args, **kwargs):
     return Color(value, 'brown', *args, **kwargs)
 
 
+@lru_cache(maxsize=64)
+def _key_layout(keys, min_key_width):
+    """the printed labels and the width of the key column, cached until the keys change."""
+    return tuple(k.replace("_", " ") for k in keys), max([min_key_width] + [len(k) for k in keys])
+
+
+def _reset_after_fork():
+    """
+    the locks and threads of the parent do not survive a fork. A forked child starts over with its
+    own, and only keeps the stage of the thread that forked.
+    """
+    current = threading.current_thread()
+    for _logger in list(ML_Logger.instances):
+        _logger._stages_lock = threading.Lock()
+        _logger._flush_lock = threading.RLock()
+        _logger._stages = [stage for stage in _logger._stages if stage.thread is current]
+        for stage in _logger._stages:
+            stage.lock = threading.Lock()
+        if _logger.pipeline:
+            _logger.pipeline.after_fork()
+        if _logger.renderer:
+            _logger.renderer.after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _weak(obj, name):
+    """calls the method `name` of obj, without keeping obj alive. Does nothing once obj is gone."""
+    ref = weakref.ref(obj)
+
+    def call(*args):
+        obj = ref()
+        if obj is not None:
+            return getattr(obj, name)(*args)
+
+    return call
+
+
+@lru_cache(maxsize=64)
+def _table_borders(key_width, value_width):
+    return ("╒" + "═" * key_width + "╤" + "═" * value_width + "╕\n",
+            "├" + "─" * key_width + "┼" + "─" * value_width + "┤\n",
+            "╘" + "═" * key_width + "╧" + "═" * value_width + "╛\n")
+
+
 class ML_Logger:
     logger = None
     log_directory = None
+    pipeline = None
+    renderer = None
+    _prefix_cache = None
+    _release_logger = None
+    # every logger, so that their locks and threads can be reset in a forked child.
+    instances = weakref.WeakSet()
+    # the default statistics for `accumulate`
+    reduce_stats = ("mean", "std", "min", "max", "count")
+    # the time (in seconds) the server holds on to a `ping` long-poll. At least twice the status interval.
+    listen_timeout = 600
 
     # noinspection PyInitNewSignature
     def __init__(self, log_directory: str = None, prefix="", buffer_size=2048, max_workers=5,
-                 color='green', line_prefix_format='[%Y-%m-%d %H:%M:%S %Z]  '):
+                 color='green', line_prefix_format='[%Y-%m-%d %H:%M:%S %Z]  ', ship_interval=2.0,
+                 print_interval=None):
         """
         :param log_directory: Overloaded to use either
             - file://some_abs_dir
             - http://19.2.34.3:8081
+            - unix:///tmp/ml-logger.sock, for a node-local `ml_logger.aggregator`
             - /tmp/some_dir
         :param prefix: The directory relative to those above
             - prefix: causal_infogan => /tmp/some_dir/causal_infogan
             - prefix: "" => /tmp/some_dir
+        :param buffer_size: the text (in characters) to collect before it is shipped.
+        :param ship_interval: the maximum time (in seconds) text logs and metrics wait before being shipped.
+        :param print_interval: print the metric table at most once every this many seconds, from a background
+            thread. Every step is still logged. The default `None` prints every table right away.
         """
         # self.summary_writer = tf.summary.FileWriter(log_directory)
+        buffer = getattr(self, 'metric_buffer', None)
+        if buffer is not None:
+            self.flush_metric_buffer()
+        if self.renderer:
+            self.renderer.flush()
+            self.renderer.interval = print_interval
+        if self.pipeline:
+            # ship the pending logs to the old log directory and prefix.
+            self.pipeline.flush()
+            self.pipeline.interval = ship_interval
+            self.pipeline.max_size = buffer_size
+        if buffer is not None and buffer.sidecar:
+            buffer.close()
         self.step = None
         self.duplex = None
         self.timestamp = None
-        self.data = OrderedDict()
-        self.flush()
+        self._local = threading.local()
+        self._stages = []
+        self._stages_lock = threading.Lock()
+        self._flush_lock = threading.RLock()
+        self.policies = {}
+        self.metric_buffer = None
+        self._flush_step()
         self.print_buffer_size = buffer_size
+        self.ship_interval = ship_interval
+        self.print_interval = print_interval
         self.color = color
         self.line_prefix_format = line_prefix_format
+        ML_Logger.instances.add(self)
 
-        self.do_not_print_list = set()
         assert not os.path.isabs(prefix), "prefix can not start with `/`"
         self.prefix = prefix
 
         # todo: add https support
         if log_directory:
-            self.logger = LogClient(url=log_directory, max_workers=max_workers)
+            # loggers with the same log directory share one client, and so one connection pool.
+            if self._release_logger is not None:
+                self._release_logger()
+            self.logger = LogClient.shared(log_directory, max_workers=max_workers)
+            self._release_logger = weakref.finalize(self, self.logger.release)
             self.log_directory = log_directory
 
     configure = __init__
 
+    def schema(self, capacity=4096, sidecar=False, **dtypes):
+        """
+        declares the metric keys and their dtypes up-front, which turns on a fast path in `log`.
+
+        Once declared, calls such as `logger.log(step=i, loss=0.1, reward=1)` that only carry keys
+        from the schema (and a step) are written directly into preallocated numpy buffers. The buffer
+        is sent as a single record in `metrics.pkl` when it fills up, or on `flush`. Calls with other
+        keys or with text go through the regular path. Calling `schema()` without keys turns it off.
+
+        With `sidecar=True`, the rows go through a shared-memory ring to a separate process instead,
+        which writes them to `metrics.pkl` as they come in (see `ml_logger.shm`). `flush` then hands
+        over the current step, but does not wait for the sidecar to write it. The sidecar is then the
+        only writer of `metrics.pkl`: the metrics logged through the regular path go through it too.
+
+        example:
+
+            logger.schema(capacity=10_000, loss='float32', reward='float64', episode='int64')
+
+        :param capacity: the number of steps the buffer (or the ring) holds.
+        :param sidecar: log from a sidecar process, through shared memory.
+        :param dtypes: key=dtype pairs, the dtype being anything `numpy.dtype` accepts.
+        """
+        buffer = self.metric_buffer
+        if buffer is not None:
+            self.flush_metric_buffer()
+            if buffer.sidecar:
+                # the pending records for the sidecar's file go out through the sidecar, before it exits.
+                self.print_flush()
+                buffer.close()
+        if not dtypes:
+            self.metric_buffer = None
+        elif sidecar:
+            from ml_logger.shm import ShmMetricBuffer
+            assert self.log_directory, "the sidecar needs a log directory, call `configure` first."
+            key = os.path.join(self.prefix or "", "metrics.pkl")
+            self.metric_buffer = ShmMetricBuffer(self.log_directory, key, capacity, **dtypes)
+        else:
+            self.metric_buffer = MetricBuffer(capacity, **dtypes)
+
+    def set_policy(self, **policies):
+        """
+        sets how often the values of a key are kept, from `ml_logger.policies`. Values that a policy
+        drops are thrown away in `log` and `log_keyvalue`, before any formatting or serialization.
+
+        example:
+
+            from ml_logger import Every, EverySeconds, LogSpaced, ReservoirSample
+            logger.set_policy(loss=Every(100), fps=EverySeconds(30), grad_norm=LogSpaced(2),
+                              histogram=ReservoirSample(20))
+
+        :param policies: key=policy pairs. Pass `None` to remove the policy of a key.
+        """
+        for key, policy in policies.items():
+            if policy is None:
+                self.policies.pop(key, None)
+            else:
+                self.policies[key] = policy
+
+    def flush_samples(self, path="samples.pkl"):
+        """
+        writes out the values kept by the `ReservoirSample` policies, one `dict(_step=step, key=value)`
+        record per value. The file is overwritten, since the sample changes over the run.
+
+        :param path: path for the samples, relative to the prefix.
+        """
+        records = []
+        for key, policy in self.policies.items():
+            if isinstance(policy, ReservoirSample):
+                records.extend({"_step": step, key: value} for step, value in policy.reservoir)
+        if records:
+            self.logger.log_many(key=os.path.join(self.prefix or "", path), items=records, overwrite=True)
+
     """ Basic Logging Functionality """
 
-    def log(self, *args, step: Union[int, Color] = None, silent=False, sep=' ', end='\n', flush=True, **kwargs) -> None:
+    def log(self, *args, step: Union[int, Color] = None, silent=False, sep=' ', end='\n', flush=False, **kwargs) -> None:
         """
         logs *args as line and kwargs as key / value pairs
 
@@ -155,13 +636,29 @@ class ML_Logger:
         :param sep: (str) separator between the strings in *args
         :param end: (str) end of line character
         :param silent: (boolean) whether to also print to stdout or just log to file
-        :param flush: (boolean) whether to flush the text logs
+        :param flush: (boolean) whether to ship the text logs right away, instead of with the next batch
         :param kwargs: key/value arguments
         :return:
         """
+        policies = self.policies
+        if policies:
+            _step = self.step if step is None else step
+            kwargs = {k: v for k, v in kwargs.items() if k not in policies or policies[k].accept(_step, v)}
+
+        buffer = self.metric_buffer
+        # note: only plain values take the schema buffer. Lines, silent keys, flushes and colors need the regular path.
+        if buffer is not None and kwargs and step is not None and not (args or silent or flush) \
+                and type(step) is not Color and buffer.owner == threading.get_ident() and buffer.accepts(kwargs) \
+                and not any(type(v) is Color for v in kwargs.values()):
+            if self.step != step:
+                self._next_step(step)
+            if not buffer.write(step, kwargs):
+                self.flush_metric_buffer()
+                buffer.write(step, kwargs)
+            return
+
         if self.step != step and step is not None:
-            self.flush()
-            self.step = step
+            self._next_step(step)
 
         self.timestamp = np.datetime64(datetime.now())
 
@@ -169,37 +666,60 @@ class ML_Logger:
         self.log_line(*args, sep=sep, end=end, silent=silent, flush=flush)
 
         # log key values
-        if silent:
-            self.do_not_print_list.update(kwargs.keys())
+        stage = self._stage()
+        with stage.lock:
+            if silent:
+                stage.silent.update(kwargs.keys())
+            data = stage.data
+            for key, v in kwargs.items():
+                _put(data, key, v.value if type(v) is Color else v)
+
+    def log_batch(self, steps, file_name="metrics.pkl", **arrays):
+        """
+        logs many steps at once, i.e. from vectorized environments or offline evaluation. The shapes are
+        checked once, and the whole block is sent as a single columnar record. `load_pkl_log` expands it
+        back into one row per step.
 
-        for key, v in kwargs.items():
-            if key in self.data:
-                if type(self.data) is list:
-                    self.data[key].append(v.value if type(v) is Color else v)
-                else:
-                    self.data[key] = [self.data[key], v.value if type(v) is Color else v]
-            else:
-                self.data[key] = v.value if type(v) is Color else v
+        The block does not go through the per-key policies, and is not printed.
+
+        example:
+
+            logger.log_batch(steps=np.arange(1000), reward=rewards, success=successes)
 
-    def log_line(self, *args, sep=' ', end='\n', silent=False, flush=True):
+        :param steps: 1-D array of the steps, one per row.
+        :param file_name: the metrics file to write to.
+        :param arrays: key=array pairs, each with one entry per step along the first axis.
         """
-        Logs a line of character
+        steps = np.asarray(steps)
+        assert steps.ndim == 1, "steps need to be a 1-D array, instead got shape {}".format(steps.shape)
+        columns = {}
+        for key, value in arrays.items():
+            value = np.asarray(value)
+            assert value.shape[:1] == steps.shape, \
+                "`{}` has shape {}, but there are {} steps.".format(key, value.shape, len(steps))
+            columns[key] = value
+        pipeline = self.pipeline or self._start_pipeline()
+        pipeline.append(os.path.join(self.prefix or "", file_name or "metrics.pkl"),
+                        {COLUMNAR: True, "_step": steps, "_timestamp": str(np.datetime64(datetime.now())),
+                         **columns})
+
+    def log_line(self, *args, sep=' ', end='\n', silent=False, flush=False):
+        """
+        Logs a line of character. The lines are collected by the log pipeline, and shipped in batches.
+
         :param args: (str) strings to be logged
         :param sep: (str) separator between the strings in *args
         :param end: (str) end of line character
         :param silent: (boolean) whether to print to stdout
-        :param flush: (boolean) whether to flush the text logs
+        :param flush: (boolean) whether to ship the text logs right away, instead of with the next batch
         """
         line = sep.join([str(a) for a in args])
-        text = line + end
-        try:
-            self.print_buffer += text
-        except:
-            self.print_buffer = text
         if not silent:
             print(self._format_line(line), end=end)
-        if flush or len(self.print_buffer) > self.print_buffer_size:
-            self.print_flush()
+        pipeline = self.pipeline or self._start_pipeline()
+        pipeline.write(line + end)
+        if flush:
+            pipeline.flush()
 
     def log_text(self, text, filename="text.log", silent=False):
         """
@@ -221,41 +741,174 @@ class ML_Logger:
         :param silent (bool): whether to also print to stdout
         :return:
         """
+        policy = self.policies.get(key)
+        if policy is not None and not policy.accept(self.step if step is None else step, value):
+            return
+
+        buffer = self.metric_buffer
+        if buffer is not None and step is not None and buffer.owner == threading.get_ident() \
+                and buffer.accepts((key,)):
+            if not buffer.write(step, {key: value}):
+                self.flush_metric_buffer()
+                buffer.write(step, {key: value})
+            return
+
         if self.step != step and step is not None:
-            self.flush()
-            self.step = step
+            self._next_step(step)
 
         self.timestamp = np.datetime64(datetime.now())
 
-        if silent:
-            self.do_not_print_list.update([key])
+        stage = self._stage()
+        if step is None and self.step is None and key in stage.data:
+            self._flush_step()
 
-        if step is None and self.step is None and key in self.data:
-            self.flush()
+        with stage.lock:
+            if silent:
+                stage.silent.add(key)
+            _put(stage.data, key, value.value if type(value) is Color else value)
 
-        if key in self.data:
-            if type(self.data) is list:
-                self.data[key].append(value.value if type(value) is Color else value)
-            else:
-                self.data[key] = [self.data[key]] + [value.value if type(value) is Color else value]
-        else:
-            self.data[key] = value.value if type(value) is Color else value
+    def accumulate(self, stats=None, dtype=np.float64, silent=False, **kwargs):
+        """
+        collects values for the keys without logging them one by one. On `flush` (or when the step
+        changes), the values of each key are reduced to summary statistics, and only those are printed
+        and saved to `metrics.pkl`, as `key/mean`, `key/std` etc.
+
+        example:
+
+            logger.log(step=epoch, lr=lr)
+            for env_step in range(1000):
+                logger.accumulate(episode_return=returns)  # numpy arrays are taken element-wise
+            logger.flush()  # or move on to the next step
+
+        :param stats: the statistics to compute for these keys. Defaults to `ML_Logger.reduce_stats`.
+            Can be `mean`, `std`, `min`, `max`, `sum`, `count`, `median` or percentiles like `p90`.
+        :param dtype: the dtype of the buffer of a new key.
+        :param silent: whether to leave the statistics out of the printout.
+        :param kwargs: key/value pairs. The values can be scalars or arrays.
+        """
+        if stats is not None:
+            Accumulator.check(stats)
+        stage = self._stage()
+        with stage.lock:
+            accumulators = stage.accumulators
+            for key, v in kwargs.items():
+                try:
+                    acc = accumulators[key]
+                    if stats is not None:
+                        acc.stats = stats
+                except KeyError:
+                    acc = accumulators[key] = Accumulator(stats or self.reduce_stats, dtype, silent=silent)
+                acc.append(v.value if type(v) is Color else v)
 
     def flush(self, file_name="metrics.pkl", fmt=".3f"):
-        if self.data:
-            try:
-                output = self._tabular(self.data, fmt, self.do_not_print_list)
-            except Exception as e:
-                print(e)
-                output = self._row_table(self.data, fmt, self.do_not_print_list)
-            self.log_line('\n'+output)
-            self.logger.log(key=os.path.join(self.prefix or "", file_name or "metrics.pkl"),
-                            data=dict(_step=self.step, _timestamp=str(self.timestamp), **self.data))
-            self.data.clear()
-            self.do_not_print_list.clear()
-
+        """
+        flushes the current step and the schema buffer, and ships all pending logs right away. The schema
+        buffer is only flushed from the thread that declared it, since its writes are not locked.
+        """
+        buffer = self.metric_buffer
+        if buffer is not None and buffer.owner == threading.get_ident():
+            self.flush_metric_buffer(file_name)
+        self._flush_step(file_name, fmt)
         self.print_flush()
 
+    def flush_metric_buffer(self, file_name="metrics.pkl"):
+        """queues the rows in the schema buffer (see `schema`) as one columnar record."""
+        buffer = self.metric_buffer
+        if buffer.sidecar:
+            buffer.commit()
+        elif buffer.size:
+            pipeline = self.pipeline or self._start_pipeline()
+            pipeline.append(os.path.join(self.prefix or "", file_name or "metrics.pkl"), buffer.to_record())
+            buffer.clear()
+
+    @property
+    def data(self):
+        """the key/value pairs logged in the current step so far, from all threads. See `StepData`."""
+        return StepData(self)
+
+    def _stage(self):
+        """the staging buffers of the calling thread."""
+        try:
+            return self._local.stage
+        except AttributeError:
+            stage = self._local.stage = Stage()
+            with self._stages_lock:
+                self._stages.append(stage)
+            return stage
+
+    def _next_step(self, step):
+        with self._flush_lock:
+            # note: another thread might have moved on to this step while we waited for the lock.
+            if self.step != step:
+                self._flush_step()
+                self.step = step
+
+    def _merge_stages(self):
+        """
+        takes the current step out of the stages of all threads. Each stage is locked only while it is
+        swapped out, and the stages of threads that have exited are dropped.
+
+        :return: the merged key/value pairs, the silent keys, and the merged accumulators.
+        """
+        data, silent, accumulators = OrderedDict(), set(), OrderedDict()
+        with self._stages_lock:
+            stages = list(self._stages)
+        for stage in stages:
+            with stage.lock:
+                stage_data, stage.data = stage.data, OrderedDict()
+                stage_silent, stage.silent = stage.silent, set()
+                for key, acc in stage.accumulators.items():
+                    if not acc.size:
+                        continue
+                    try:
+                        merged = accumulators[key]
+                    except KeyError:
+                        merged = accumulators[key] = Accumulator(acc.stats, acc.values.dtype, acc.size, acc.silent)
+                    merged.append(acc.values[:acc.size])
+                    acc.clear()
+            for key, v in stage_data.items():
+                _put(data, key, v)
+            silent.update(stage_silent)
+            if not stage.thread.is_alive():
+                with self._stages_lock:
+                    self._stages.remove(stage)
+        return data, silent, accumulators
+
+    def _flush_step(self, file_name="metrics.pkl", fmt=".3f"):
+        """flushes the key/value pairs of the current step. Does not touch the schema buffer."""
+        with self._flush_lock:
+            data, silent, accumulators = self._merge_stages()
+            for key, acc in accumulators.items():
+                for stat, value in acc.reduce().items():
+                    data[f"{key}/{stat}"] = value
+                    if acc.silent:
+                        silent.add(f"{key}/{stat}")
+
+            if data:
+                if self.print_interval:
+                    renderer = self.renderer or self._start_renderer()
+                    renderer.submit(data, fmt, silent)
+                else:
+                    self._print_table(data, fmt, silent)
+                # note: goes through the pipeline to keep the order with the text logs.
+                pipeline = self.pipeline or self._start_pipeline()
+                pipeline.append(os.path.join(self.prefix or "", file_name or "metrics.pkl"),
+                                dict(_step=self.step, _timestamp=str(self.timestamp), **data))
+
+    def _print_table(self, data, fmt, do_not_print_list):
+        try:
+            output = self._tabular(data, fmt, do_not_print_list)
+        except Exception as e:
+            print(e)
+            output = self._row_table(data, fmt, do_not_print_list)
+        if output:
+            self.log_line('\n' + output)
+
+    def _start_renderer(self):
+        # note: the background threads only hold the logger weakly, so that a dropped logger is collected.
+        self.renderer = ConsoleRenderer(_weak(self, '_print_table'), self.print_interval)
+        return self.renderer
+
     """ Advanced Logging Functionality """
 
     def log_pkl(self, data, path="data.pkl"):
@@ -325,7 +978,7 @@ class ML_Logger:
         :return:
         """
         if self.step != step and step is not None:
-            self.flush()
+            self._flush_step()
             self.step = step
 
         for var_name, module in kwargs.items():
@@ -443,31 +1096,105 @@ class ML_Logger:
 
     """ Loading Functionality """
 
-    def load_file(self, key):
+    def enable_read_cache(self, max_bytes=256 << 20, disk_dir=None, max_disk_bytes=4 << 30, max_age=0):
+        """
+        caches the files this logger loads from the server, so that loading the same parameters or
+        checkpoints again does not download them again. Loads are not cached until this is called.
+        The cache is shared with the other loggers of the same server in this process.
+
+        Cached files are revalidated with the server on every load, which only costs a round trip
+        when they have not changed. Pass `cache=False` to a load call to skip the cache for live data.
+
+        :param max_bytes: the size of the in-memory cache.
+        :param disk_dir: a directory to also cache the files on disk, across processes. Optional.
+        :param max_disk_bytes: the size of the disk cache.
+        :param max_age: the time (in seconds) a cached file is used without asking the server.
+        :return: the cache
+        """
+        return self.logger.enable_cache(max_bytes, disk_dir, max_disk_bytes, max_age)
+
+    def load_file(self, key, start=None, stop=None, cache=True):
         """ return the binary stream, most versatile.
 
         :param key:
+        :param start: the first byte to read, to read only part of a large file. Negative counts from the end.
+        :param stop: the byte to stop at (exclusive).
+        :param cache: False to skip the read cache, see `enable_read_cache`.
         :return:
         """
-        return self.logger.read(os.path.join(self.prefix, key))
+        return self.logger.read(os.path.join(self.prefix, key), start, stop, cache=cache)
 
-    def load_pkl_log(self, path):
+    def load_pkl_log(self, path, expand=True, cache=True):
         """
         load a pkl log (as a list of data instances)
 
         :param path: relative pickle file path
+        :param expand: expand columnar records (i.e. from `schema`) into one item per row.
+        :param cache: False to skip the read cache, see `enable_read_cache`.
         :return: list of data log items
         """
-        return self.logger.read_pkl(os.path.join(self.prefix, path))
+        data = self.logger.read_pkl(os.path.join(self.prefix, path), cache=cache)
+        return list(expand_columnar(data)) if expand and data is not None else data
+
+    def load_many(self, prefixes, path="metrics.pkl", tag="prefix", max_parallel=8):
+        """
+        loads the same pickle log from many experiments at once, i.e. for the summary of a sweep, into
+        one DataFrame with a column that tags each row with its experiment. See `LogClient.read_many`.
+
+        example:
+
+            page = logger.list_dirs("sweep/lr-")
+            df = logger.load_many([path for path, mtime in page['entries']])
+            df.groupby("prefix")['loss'].min()
+
+        :param prefixes: the experiment directories, relative to the prefix of this logger.
+        :param path: the pickle log in each of them.
+        :param tag: the name of the column with the experiment prefix.
+        :param max_parallel: the number of requests in flight, or of threads for local loggers.
+        :return: pandas.DataFrame, without the experiments that do not have the log.
+        """
+        import pandas
+        prefixes = list(prefixes)
+        keys = [os.path.join(self.prefix, prefix, path) for prefix in prefixes]
+        frames = []
+        for prefix, data in zip(prefixes, self.logger.read_many(keys, max_parallel=max_parallel)):
+            if data is None:
+                continue
+            df = pandas.DataFrame(list(expand_columnar(data)))
+            df.insert(0, tag, prefix)
+            frames.append(df)
+        return pandas.concat(frames, ignore_index=True, sort=False) if frames else pandas.DataFrame(columns=[tag])
+
+    def tail_pkl_log(self, path="metrics.pkl", offset=0, timeout=30, expand=True):
+        """
+        returns the rows appended to a pickle log since `offset`, waiting up to `timeout` seconds for
+        the next write if there are none. The server only sends the new part of the file.
+
+        example:
+
+            rows, offset = logger.tail_pkl_log("metrics.pkl")
+            while True:
+                new_rows, offset = logger.tail_pkl_log("metrics.pkl", offset)
 
-    def load_pkl(self, path):
+        :param path: the pickle file, relative to the prefix
+        :param offset: the byte offset returned by the previous call
+        :param timeout: the maximum time to wait for new rows, in seconds
+        :param expand: whether to expand columnar records into one row per step
+        :return: the new rows, and the offset to pass to the next call
+        """
+        res = self.logger.tail(os.path.join(self.prefix, path), offset=offset, timeout=timeout)
+        records = res['records']
+        return (list(expand_columnar(records)) if expand else records), res['offset']
+
+    def load_pkl(self, path, cache=True):
         """
         load a pkl file
 
         :param path: relative pickle file path
+        :param cache: False to skip the read cache, see `enable_read_cache`.
         :return: data instance loaded from pickle file
         """
-        return self.logger.read_pkl(os.path.join(self.prefix, path))[0]
+        return self.logger.read_pkl(os.path.join(self.prefix, path), cache=cache)[0]
 
     def remove(self, path):
         """
@@ -479,6 +1206,57 @@ class ML_Logger:
         abs_path = os.path.join(self.prefix, path)
         self.logger._delete(abs_path)
 
+    def archive(self, path="", unpack=False):
+        """
+        packs a finished experiment (by default, the prefix of this logger) into a single file on the
+        server, instead of its many small images, videos and checkpoints. The files are still loaded
+        as before, from inside the archive.
+
+        :param path: the directory, relative to the prefix of this logger.
+        :param unpack: extracts the archive back into the directory instead.
+        :return: the number of files
+        """
+        return self.logger.archive(os.path.join(self.prefix, path), unpack)
+
+    def list_dirs(self, prefix="", pattern=None, sort="name", limit=100, cursor=None):
+        """
+        lists the directories under the prefix of this logger, one page at a time. The server keeps an
+        index of its directories, so this does not walk the disk.
+
+        example:
+
+            page = logger.list_dirs("sweep/lr-", sort="mtime")
+            while page['cursor'] is not None:
+                page = logger.list_dirs("sweep/lr-", sort="mtime", cursor=page['cursor'])
+
+        :param prefix: the start of the directory path, relative to the prefix of this logger.
+        :param pattern: a glob for the directory path, relative to the prefix of this logger.
+        :param sort: `name`, or `mtime` for the most recently written first.
+        :param limit: the size of the page.
+        :param cursor: the cursor returned with the previous page.
+        :return: dict(entries=[(path, mtime), ...], cursor=...), with the paths relative to the log directory.
+        """
+        return self.logger.list(os.path.join(self.prefix, prefix),
+                                pattern and os.path.join(self.prefix, pattern), sort, limit, cursor)
+
+    def query_params(self, *where, prefix="", limit=1000):
+        """
+        finds the experiments under the prefix of this logger by the parameters they logged with
+        `log_params`. The server keeps an index of the parameters, so this does not load any file.
+
+        Nested parameters are matched by their dotted key, i.e. `Args.lr` for `log_params(Args=dict(lr=...))`.
+
+        example:
+
+            logger.query_params(("Args.lr", "==", 3e-4), ("Args.seed", "<", 5), prefix="sweep/")
+
+        :param where: (key, op, value) predicates, op being one of `==`, `!=`, `<`, `<=`, `>`, `>=`, `in` and `prefix`.
+        :param prefix: the start of the experiment path, relative to the prefix of this logger.
+        :param limit: the maximum number of experiments.
+        :return: the sorted list of the matching experiments, relative to the log directory.
+        """
+        return self.logger.query_params(list(where), os.path.join(self.prefix, prefix), limit)
+
     """ Version Control Functionality"""
 
     def diff(self, diff_directory=".", diff_filename="index.diff", silent=False):
@@ -538,16 +1316,36 @@ class ML_Logger:
         return c(line, color=self.color)
 
     def _line_prefix(self):
-        return datetime.now(tz=pytz.UTC).strftime(self.line_prefix_format)
+        # the prefix only changes once a second, unless the format has sub-second fields.
+        second, fmt = int(time.time()), self.line_prefix_format
+        cache = self._prefix_cache
+        if cache and cache[0] == second and cache[1] == fmt:
+            return cache[2]
+        prefix = datetime.now(tz=pytz.UTC).strftime(fmt)
+        if '%f' not in fmt:
+            self._prefix_cache = second, fmt, prefix
+        return prefix
 
     def print_flush(self):
-        try:
-            text = self.print_buffer
-        except:
-            text = ""
-        self.print_buffer = ""
-        if text:
-            self.log_text(text, silent=True)
+        """ships the pending text logs and metrics right away."""
+        if self.pipeline:
+            self.pipeline.flush()
+
+    def _start_pipeline(self):
+        self.pipeline = LogPipeline(_weak(self, '_ship_text'), _weak(self, '_ship_records'), self.ship_interval,
+                                    self.print_buffer_size)
+        return self.pipeline
+
+    def _ship_text(self, text):
+        if self.logger:
+            self.logger.log_text(key=os.path.join(self.prefix or "", "text.log"), text=text, ordered=True)
+
+    def _ship_records(self, key, records):
+        buffer = self.metric_buffer
+        if buffer is not None and buffer.sidecar and buffer.key == key and buffer.send(records):
+            return
+        if self.logger:
+            self.logger.log_many(key=key, items=records, ordered=True)
 
     def ping(self, status='running', interval=None):
         """
@@ -555,17 +1353,21 @@ class ML_Logger:
         The background thread is responsible for making the call . This method just returns the buffered
         signal synchronously.
 
+        The background thread long-polls the server, so signals sent with `send_signal` show up in the
+        buffer right away. The long-poll outlasts the status interval (see `listen_timeout`), so an idle
+        worker makes one request per long-poll. The latest status goes out with the next poll.
+
         :return: tuple signals
         """
         if not self.duplex:
             def thunk(*statuses):
                 nonlocal self
-                if len(statuses) > 0:
-                    return self.logger.ping(self.prefix, statuses[-1])
-                else:
-                    return self.logger.ping(self.prefix, "running")
+                status = statuses[-1] if len(statuses) > 0 else "running"
+                timeout = max(self.listen_timeout, 2 * self.duplex.keep_alive_interval)
+                return self.logger.listen(self.prefix, status, timeout=timeout)
 
-            self.duplex = Duplex(thunk, interval or 120)  # default interval is two minutes
+            # default interval is two minutes
+            self.duplex = Duplex(thunk, interval or 120, long_poll=True)
             self.duplex.start()
         if interval:
             self.duplex.keep_alive_interval = interval
@@ -603,39 +1405,30 @@ class ML_Logger:
 
     @staticmethod
     def _tabular(data, fmt=".3f", do_not_print_list=tuple(), min_key_width=20, min_value_width=20):
-        keys = [k for k in data.keys() if k not in do_not_print_list]
+        keys = tuple(k for k in data.keys() if k not in do_not_print_list)
         if len(keys) > 0:
-            max_key_len = max([min_key_width] + [len(k) for k in keys])
-            max_value_len = max([min_value_width] + [len(str(data[k])) for k in keys])
-            output = None
-            for k in keys:
-                v = f"{data[k]:{fmt}}"
-                if output is None:
-                    output = "╒" + "═" * max_key_len + "╤" + "═" * max_value_len + "╕\n"
-                else:
-                    output += "├" + "─" * max_key_len + "┼" + "─" * max_value_len + "┤\n"
-                if k not in do_not_print_list:
-                    k = k.replace('_', " ")
-                    v = "NA" if v is None else v  # for NoneTypes which doesn't have __format__ method
-                    output += f"│{k:^{max_key_len}}│{v:^{max_value_len}}│\n"
-            output += "╘" + "═" * max_key_len + "╧" + "═" * max_value_len + "╛\n"
-            return output
+            labels, max_key_len = _key_layout(keys, min_key_width)
+            # for NoneTypes which doesn't have __format__ method
+            values = ["NA" if data[k] is None else f"{data[k]:{fmt}}" for k in keys]
+            max_value_len = max(min_value_width, max(len(v) for v in values))
+            top, middle, bottom = _table_borders(max_key_len, max_value_len)
+            return top + middle.join([f"│{k:^{max_key_len}}│{v:^{max_value_len}}│\n"
+                                      for k, v in zip(labels, values)]) + bottom
 
     @staticmethod
     def _row_table(data, fmt=".3f", do_not_print_list=tuple(), min_column_width=5):
         """applies to metrics keys with multiple values"""
         keys = [k for k in data.keys() if k not in do_not_print_list]
-        output = ""
         if len(keys) > 0:
             values = [values if type(values) is list else [values] for values in data.values()]
             max_key_width = max([min_column_width] + [len(k) for k in keys])
             max_value_len = max([min_column_width] + [len(f"{v:{fmt}}") for d in values for v in d])
             max_width = max(max_key_width, max_value_len)
-            output += '|'.join([f"{key.replace('-', ' '):^{max_width}}" for key in keys]) + "\n"
-            output += "┼".join(["─" * max_width] * len(keys)) + "\n"
-            for row in zip_longest(*values):
-                output += '|'.join([f"{value:^{max_width}{fmt}}" for value in row]) + "\n"
-            return output
+            lines = ['|'.join([f"{key.replace('-', ' '):^{max_width}}" for key in keys]),
+                     "┼".join(["─" * max_width] * len(keys))]
+            lines.extend('|'.join([f"{value:^{max_width}{fmt}}" for value in row]) for row in zip_longest(*values))
+            return "\n".join(lines) + "\n"
+        return ""
 
     @staticmethod
     def plt2data(fig):
@@ -664,6 +1457,32 @@ class ML_Logger:
         now = datetime.now()
         return now.strftime(fmt) if fmt else now
 
+    def close(self):
+        """
+        ships everything that is pending, stops the background threads, and releases the client. Also
+        runs when the logger is dropped. Call `configure` to log again.
+        """
+        self.flush()
+        buffer = self.metric_buffer
+        if buffer is not None and buffer.sidecar:
+            buffer.close()
+            self.metric_buffer = None
+        if self.renderer:
+            self.renderer.close()
+            self.renderer = None
+        if self.pipeline:
+            self.pipeline.close()
+            self.pipeline = None
+        if self._release_logger is not None:
+            self._release_logger()
+            self._release_logger = self.logger = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception as e:
+            print(e)
+
     def __enter__(self):
         return self
 
@@ -671,6 +1490,7 @@ class ML_Logger:
         # self.summary_writer.close()
         # todo: wait for logger to finish upload in async mode.
         self.flush()
+        self.flush_samples()
 
 
 logger = ML_Logger()
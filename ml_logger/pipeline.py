@@ -0,0 +1,138 @@
+import atexit
+import threading
+import weakref
+from collections import OrderedDict
+from functools import partial
+
+
+class LogPipeline:
+    """ Log Pipeline
+    Collects printed text and metric records, and ships them in batches from a background thread, once
+    every `interval` seconds or as soon as `max_size` characters (or records) are pending. This way a
+    chatty training script costs a request every few seconds, instead of one request per printed line.
+
+    `flush` ships everything that is pending right away, from the calling thread. Batches are shipped
+    in order under a lock, while writers only hold a short one around the buffers. Within a batch,
+    the text goes first, then the records of each key in the order the keys first showed up.
+
+    The thread and the exit hook only hold a weak reference to the pipeline, so that a pipeline (and
+    the logger that owns it) that is dropped is collected, and its thread exits. `close` ships what is
+    pending and stops the thread right away.
+    """
+
+    def __init__(self, ship_text, ship_records, interval=2.0, max_size=2048):
+        """
+        :param ship_text: callable that receives the joined text.
+        :param ship_records: callable that receives a key and the list of records for it.
+        :param interval: the maximum time (in seconds) anything waits before it is shipped.
+        :param max_size: ship as soon as this many characters, or records, are pending.
+        """
+        self.ship_text = ship_text
+        self.ship_records = ship_records
+        self.interval = interval
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.records = OrderedDict()
+        self.n_records = 0
+        # note: reentrant, since the ship callables might drop the last reference to the logger.
+        self.lock = threading.RLock()
+        self.buffer_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self._at_exit = partial(_flush, weakref.ref(self))
+        atexit.register(self._at_exit)
+        self._start()
+
+    def _start(self):
+        self.thread = threading.Thread(target=_run, args=(weakref.ref(self),))
+        self.thread.daemon = True  # Daemonize thread
+        self.thread.start()
+        self._finalizer = weakref.finalize(self, _stop, self.wake, self._at_exit)
+
+    def close(self):
+        """ships what is pending, and stops the thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self._finalizer()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+    def after_fork(self):
+        """
+        starts over in a forked child, with new locks and a new thread. The logs that were pending in
+        the parent are left to the parent to ship.
+        """
+        self.lock = threading.RLock()
+        self.buffer_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.chunks, self.size = [], 0
+        self.records, self.n_records = OrderedDict(), 0
+        self._finalizer.detach()
+        if not self.closed:
+            self._start()
+
+    def write(self, text):
+        with self.buffer_lock:
+            self.chunks.append(text)
+            self.size += len(text)
+            full = self.size >= self.max_size
+        if full:
+            self.wake.set()
+
+    def append(self, key, record):
+        with self.buffer_lock:
+            try:
+                self.records[key].append(record)
+            except KeyError:
+                self.records[key] = [record]
+            self.n_records += 1
+            full = self.n_records >= self.max_size
+        if full:
+            self.wake.set()
+
+    def flush(self):
+        with self.lock:
+            # note: swap the buffers first, so that writes from other threads land in the new ones.
+            with self.buffer_lock:
+                chunks, self.chunks = self.chunks, []
+                records, self.records = self.records, OrderedDict()
+                self.size = self.n_records = 0
+            if chunks:
+                self.ship_text("".join(chunks))
+            for key, items in records.items():
+                self.ship_records(key, items)
+
+
+def _run(ref):
+    """the shipping thread. Holds the pipeline only while it ships, and exits once it is closed or gone."""
+    while True:
+        pipeline = ref()
+        if pipeline is None or pipeline.closed:
+            return
+        wake, interval = pipeline.wake, pipeline.interval
+        del pipeline
+        wake.wait(interval)
+        wake.clear()
+        pipeline = ref()
+        if pipeline is None or pipeline.closed:
+            return
+        try:
+            pipeline.flush()
+        except Exception as e:
+            print(e)
+        del pipeline
+
+
+def _flush(ref):
+    pipeline = ref()
+    if pipeline is not None:
+        pipeline.flush()
+
+
+def _stop(wake, at_exit):
+    """wakes the thread up to exit, and drops the exit hook."""
+    atexit.unregister(at_exit)
+    wake.set()
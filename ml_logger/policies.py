@@ -0,0 +1,66 @@
+"""
+Per-key logging policies for `ML_Logger.set_policy`. A policy decides, before any other work is done,
+whether a value logged for its key is kept.
+"""
+import time
+
+from ml_logger.helpers import Reservoir
+
+
+class Every:
+    """keeps the values logged at every n-th step. Without a step, every n-th call is kept."""
+
+    def __init__(self, n):
+        self.n = n
+        self.calls = 0
+
+    def accept(self, step, value):
+        if step is None:
+            step, self.calls = self.calls, self.calls + 1
+        return step % self.n == 0
+
+
+class EverySeconds:
+    """keeps at most one value every `seconds` seconds."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.next = 0
+
+    def accept(self, step, value):
+        now = time.time()
+        if now < self.next:
+            return False
+        self.next = now + self.seconds
+        return True
+
+
+class LogSpaced:
+    """keeps log-spaced steps: 0, 1, 2, 4, 8, 16... for `base=2`. Without a step, calls are counted."""
+
+    def __init__(self, base=2):
+        self.base = base
+        self.next = 0
+        self.calls = 0
+
+    def accept(self, step, value):
+        if step is None:
+            step, self.calls = self.calls, self.calls + 1
+        if step < self.next:
+            return False
+        self.next = max(step + 1, step * self.base)
+        return True
+
+
+class ReservoirSample:
+    """
+    keeps a uniform sample of k values over the whole run (with `helpers.Reservoir`). The sampled values
+    are held by the logger instead of going into the metrics, and are written out by `ML_Logger.flush_samples`.
+    """
+
+    def __init__(self, k, seed=None):
+        self.reservoir = Reservoir(k, seed)
+
+    def accept(self, step, value):
+        self.reservoir.add((step, value))
+        return False
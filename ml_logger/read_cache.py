@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class CacheEntry(NamedTuple):
+    etag: str
+    text: str
+    # when the server last confirmed the entry, for `max_age`.
+    time: float
+
+
+class ReadCache:
+    """
+    An LRU cache of server reads for `LogClient`, keyed by path and read type, and bounded by bytes.
+
+    Entries keep the ETag of the response, and are revalidated with the server on every read: a file
+    that has not changed costs a `304 Not Modified` without a payload. Entries younger than `max_age`
+    seconds are used without asking the server at all, which suits files that do not change anymore,
+    like final checkpoints and parameters.
+
+    With a `disk_dir`, entries are also written to disk, so that they survive the process and entries
+    evicted from memory can be read back from there. The disk tier is bounded by bytes as well, and
+    evicts the least recently used files first.
+
+    The response text is cached rather than the decoded object, so that every read returns a fresh copy.
+    """
+
+    def __init__(self, max_bytes=256 << 20, disk_dir=None, max_disk_bytes=4 << 30, max_age=0):
+        """
+        :param max_bytes: the size of the memory tier.
+        :param disk_dir: the directory for the disk tier. None keeps the cache in memory only.
+        :param max_disk_bytes: the size of the disk tier.
+        :param max_age: the time (in seconds) an entry is used without revalidating it with the server.
+        """
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age = max_age
+        self.memory = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk_dir = disk_dir
+        # file name => size, least recently used first.
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            entries = [e for e in os.scandir(disk_dir) if e.name.endswith(".entry")]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                self.disk[entry.name] = entry.stat().st_size
+                self.disk_size += entry.stat().st_size
+
+    def fresh(self, entry):
+        return time.time() - entry.time < self.max_age
+
+    def get(self, key):
+        """returns the entry for the key, or None. Looks in memory first, then on disk."""
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+        entry = self._read_disk(key)
+        if entry is not None:
+            with self.lock:
+                self._put_memory(key, entry)
+        return entry
+
+    def put(self, key, etag, text):
+        entry = CacheEntry(etag, text, time.time())
+        with self.lock:
+            self._put_memory(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def validated(self, key, entry):
+        """marks the entry as just confirmed by the server."""
+        entry = entry._replace(time=time.time())
+        with self.lock:
+            if key in self.memory:
+                self.memory[key] = entry
+        return entry
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.memory.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry.text)
+            name = self._file_name(key)
+            if name in self.disk:
+                self.disk_size -= self.disk.pop(name)
+                self._remove(name)
+
+    def _put_memory(self, key, entry):
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.size -= len(old.text)
+        if len(entry.text) > self.max_bytes:
+            return
+        self.memory[key] = entry
+        self.size += len(entry.text)
+        while self.size > self.max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.size -= len(evicted.text)
+
+    @staticmethod
+    def _file_name(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".entry"
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        name = self._file_name(key)
+        with self.lock:
+            if name not in self.disk:
+                return None
+            self.disk.move_to_end(name)
+        path = os.path.join(self.disk_dir, name)
+        try:
+            with open(path, "r") as f:
+                stored_key, etag, validated, text = f.read().split("\n", 3)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if stored_key != repr(key):
+            return None
+        return CacheEntry(etag, text, float(validated))
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir or len(entry.text) > self.max_disk_bytes:
+            return
+        name = self._file_name(key)
+        path = os.path.join(self.disk_dir, name)
+        # note: written to a temporary file first, so that other processes never read half an entry.
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write("\n".join([repr(key), entry.etag, str(entry.time), entry.text]))
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.disk_size += size - self.disk.pop(name, 0)
+            self.disk[name] = size
+            while self.disk_size > self.max_disk_bytes:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                self._remove(evicted)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.disk_dir, name))
+        except OSError:
+            pass
@@ -1,5 +1,7 @@
 import base64
-from cloudpickle import cloudpickle
+import json
+import zlib
+import cloudpickle
 
 
 def deserialize(code):
@@ -10,3 +12,22 @@ def deserialize(code):
 def serialize(data):
     code = cloudpickle.dumps(data)
     return base64.b64encode(code).decode("utf-8")
+
+
+def pack_batch(entries):
+    """compresses a list of json entries into one string, for the `/batch` route."""
+    code = zlib.compress(json.dumps(entries).encode("utf-8"))
+    return base64.b64encode(code).decode("utf-8")
+
+
+def unpack_batch(code):
+    return json.loads(zlib.decompress(base64.b64decode(code)).decode("utf-8"))
+
+
+def serialize_many(values):
+    """serializes each value on its own line, for the `/multi` route. base64 has no newlines."""
+    return "\n".join(serialize(v) for v in values)
+
+
+def deserialize_many(text):
+    return [deserialize(frame) for frame in text.split("\n")] if text else []
@@ -1,13 +1,23 @@
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from io import BytesIO
 import os
+import asyncio
+from stat import S_ISREG
+import threading
+from fnmatch import fnmatch
+from collections import defaultdict
 # todo: switch to dill instead
 import dill
-from ruamel.yaml import YAML, StringIO
 from collections import namedtuple
 
 from params_proto import cli_parse, Proto, BoolFlag
 
-from ml_logger.serdes import deserialize, serialize
+from ml_logger.archive import ARCHIVE, Archives, pack, unpack
+from ml_logger.directory_index import DirectoryIndex
+from ml_logger.kv_store import KVStore, to_yaml
+from ml_logger.serdes import deserialize, serialize, serialize_many, unpack_batch
+from ml_logger.trash import Trash
 import numpy as np
 from typing import NamedTuple, Any
 
@@ -34,27 +44,158 @@ class PingData(NamedTuple):
     burn: bool = False
 
 
+class BroadcastEntry(NamedTuple):
+    pattern: str
+    signal: Any
+
+
+class BatchEntry(NamedTuple):
+    # a `pack_batch`-ed list of (method, json) pairs, applied in order.
+    data: str
+
+
+class ListEntry(NamedTuple):
+    prefix: str = ""
+    pattern: str = None
+    sort: str = "name"
+    limit: int = 100
+    cursor: Any = None
+
+
+class MultiEntry(NamedTuple):
+    keys: list
+    type: str = "read_pkl"
+
+
+class ParamsQuery(NamedTuple):
+    # (key, op, value) predicates, see `KVStore.query`.
+    where: list = ()
+    prefix: str = ""
+    limit: int = 1000
+
+
+class ArchiveEntry(NamedTuple):
+    key: str
+    # unpacks the archive instead.
+    unpack: bool = False
+
+
+class TailEntry(NamedTuple):
+    key: str
+    offset: int = 0
+    record: int = None
+    timeout: float = 30
+
+
+class ListenData(NamedTuple):
+    exp_key: str
+    status: Any
+    timeout: float = 120
+    burn: bool = True
+
+
 Signal = namedtuple("Signal", ['exp_key', 'signal'])
+
+
+def get_header(req, name):
+    """looks up a request header, case-insensitively."""
+    name = name.lower()
+    for k, v in (req.headers or {}).items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def parse_range(header, size):
+    """
+    parses a single `Range: bytes=...` header against the size of the file.
+
+    :return: (start, stop) with stop exclusive, or None if the header is not a range we can serve.
+        `start >= stop` when the range is past the end of the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:  # the last `last` bytes
+            start, stop = max(size - int(last), 0), size
+        else:
+            start, stop = int(first), min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    return start, stop
+
+
 ALLOWED_TYPES = (np.uint8,)  # ONLY uint8 is supported.
 
 
+# the directory under data_dir that removed directories are moved to.
+TRASH = ".trash"
+# the database of small records under data_dir, see `KVStore`.
+RECORDS = ".records.sqlite"
+# `log_params` writes here. Also kept as a record, for `parameters.yml`.
+PARAMETERS = "parameters.pkl"
+# experiments that have not pinged for this long (in seconds) are dropped from the presence registry,
+# with their undelivered broadcasts. So are the ones past the most recent MAX_PRESENCE.
+PRESENCE_TTL = 24 * 3600
+MAX_PRESENCE = 100000
+
+
 class LoggingServer:
     def __init__(self, data_dir):
         assert os.path.isabs(data_dir)
         self.data_dir = data_dir
         os.makedirs(data_dir, exist_ok=True)
         print('logging data to {}'.format(data_dir))
+        # callbacks waiting on a channel, fired once by `notify`.
+        self.listeners = defaultdict(list)
+        # exp_key -> last status and time, for the experiments that have pinged recently, least
+        #   recently pinged first. See `PRESENCE_TTL`.
+        self.presence = {}
+        # signals sent with `broadcast` are held in memory, instead of in `__signal.pkl`.
+        self.mailbox = defaultdict(list)
+        # removed directories, deleted in the background.
+        self.trash = Trash(os.path.join(data_dir, TRASH))
+        # presence, status and parameters, served as YAML files.
+        self.kv = KVStore(os.path.join(data_dir, RECORDS))
+        # the archived directories, read in place by `load`.
+        self.archives = Archives(data_dir)
+        # the directories under data_dir, for `list`.
+        self.index = DirectoryIndex(data_dir, ignore=[TRASH])
 
     configure = __init__
 
+    def close(self):
+        """stops the trash thread, and closes the open archives and the records database."""
+        self.trash.close()
+        self.archives.close()
+        self.kv.close()
+
+    def after_fork(self):
+        """starts over in a forked child, i.e. of a process that logs to a local directory."""
+        self.trash.after_fork()
+        self.archives.after_fork()
+        self.index.after_fork()
+
     def serve(self, port):
         from japronto import Application
         self.app = Application()
         self.app.router.add_route('/', self.log_handler, method='POST')
         self.app.router.add_route('/', self.read_handler, method='GET')
         self.app.router.add_route('/ping', self.ping_handler, method='POST')
+        self.app.router.add_route('/listen', self.listen_handler, method='POST')
+        self.app.router.add_route('/broadcast', self.broadcast_handler, method='POST')
         self.app.router.add_route('/', self.remove_handler, method='DELETE')
+        self.app.router.add_route('/batch', self.batch_handler, method='POST')
+        self.app.router.add_route('/list', self.list_handler, method='GET')
+        self.app.router.add_route('/tail', self.tail_handler, method='POST')
+        self.app.router.add_route('/multi', self.multi_handler, method='GET')
+        self.app.router.add_route('/trash', self.trash_handler, method='GET')
+        self.app.router.add_route('/params', self.params_handler, method='GET')
+        self.app.router.add_route('/archive', self.archive_handler, method='POST')
         # todo: need a file serving url
+        self.index.start()
         self.app.run(port=port, debug=Params.debug)
 
     def ping_handler(self, req):
@@ -68,14 +209,218 @@ class LoggingServer:
         return req.Response(text=data)
 
     def ping(self, exp_key, status, burn=True):
+        self._presence(exp_key, status)
+        return serialize(self._read_signal(exp_key, burn))
+
+    async def listen_handler(self, req):
+        if not req.json:
+            msg = f'request json is empty: {req.text}'
+            print(msg)
+            return req.Response(text=msg)
+        listen_data = ListenData(**req.json)
+        data = await self.listen_async(*listen_data)
+        return req.Response(text=data)
+
+    def listen(self, exp_key, status, timeout=120, burn=True):
+        """
+        blocking version of `ping`. Holds on until a signal is sent to `exp_key`, or until `timeout`
+        runs out. Used in local mode, where the server lives in the same process.
+
+        :param exp_key: the experiment prefix
+        :param status: the status to record in `__presence`
+        :param timeout: the maximum time to wait for a signal, in seconds
+        :param burn: whether to remove the signal once it has been read
+        :return: serialized list of signals, or serialized None
+        """
+        event = threading.Event()
+        self.listeners[exp_key].append(event.set)
+        try:
+            self._presence(exp_key, status)
+            res = self._read_signal(exp_key, burn)
+            if res is None and event.wait(timeout):
+                res = self._read_signal(exp_key, burn)
+        finally:
+            self._unlisten(exp_key, event.set)
+        return serialize(res)
+
+    async def listen_async(self, exp_key, status, timeout=120, burn=True):
+        """
+        the long-poll version of `ping`, for the http server. The request is held open until a signal
+        is written to `exp_key` or `timeout` runs out, so that the workers get the signal right away
+        without having to poll.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        self.listeners[exp_key].append(wake)
+        try:
+            self._presence(exp_key, status)
+            res = self._read_signal(exp_key, burn)
+            if res is None:
+                try:
+                    await asyncio.wait_for(future, timeout)
+                    res = self._read_signal(exp_key, burn)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._unlisten(exp_key, wake)
+        return serialize(res)
+
+    async def tail_handler(self, req):
+        if not req.json:
+            msg = f'request json is empty: {req.text}'
+            print(msg)
+            return req.Response(text=msg)
+        tail_entry = TailEntry(**req.json)
+        res = await self.tail_async(*tail_entry)
+        return req.Response(text=serialize(res))
+
+    def tail(self, key, offset=0, record=None, timeout=30):
+        """
+        returns the records appended to the pickle file `key` after the cursor. If there are none yet,
+        holds on until `log` appends to the file, or until `timeout` runs out.
+
+        :param key: the path to the pickle file
+        :param offset: the byte offset to read from, i.e. the `offset` returned by the previous call
+        :param record: the number of records to skip instead, overrides the offset
+        :param timeout: the maximum time to wait for new records, in seconds
+        :return: dict(records=[...], offset=..., record=...), `record` is None for byte cursors
+        """
+        event = threading.Event()
+        self.listeners[key].append(event.set)
+        try:
+            res = self._read_tail(key, offset, record)
+            if not res['records'] and event.wait(timeout):
+                res = self._read_tail(key, res['offset'], res['record'])
+        finally:
+            self._unlisten(key, event.set)
+        return res
+
+    async def tail_async(self, key, offset=0, record=None, timeout=30):
+        """the long-poll version of `tail`, for the http server."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        self.listeners[key].append(wake)
+        try:
+            res = self._read_tail(key, offset, record)
+            if not res['records']:
+                try:
+                    await asyncio.wait_for(future, timeout)
+                    res = self._read_tail(key, res['offset'], res['record'])
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._unlisten(key, wake)
+        return res
+
+    def _read_tail(self, key, offset=0, record=None):
+        from ml_logger.helpers import pickle_index, read_pickle_from
+        abs_path = os.path.join(self.data_dir, key)
+        try:
+            if record is None:
+                records, offset = read_pickle_from(abs_path, offset)
+            else:
+                index = pickle_index(abs_path)
+                if index is not None and record <= len(index.offsets):
+                    start = index.offsets[record] if record < len(index.offsets) else index.end
+                    records, offset = read_pickle_from(abs_path, start)
+                else:
+                    records, offset = read_pickle_from(abs_path, 0)
+                    records = records[record:]
+                record += len(records)
+        except FileNotFoundError:
+            records = []
+        return dict(records=records, offset=offset, record=record)
+
+    def broadcast_handler(self, req):
+        if not req.json:
+            msg = f'request json is empty: {req.text}'
+            print(msg)
+            return req.Response(text=msg)
+        broadcast_entry = BroadcastEntry(**req.json)
+        print("broadcasting to: {}".format(broadcast_entry.pattern))
+        exp_keys = self.broadcast(broadcast_entry.pattern, deserialize(broadcast_entry.signal))
+        return req.Response(text=serialize(exp_keys))
+
+    def broadcast(self, pattern, signal):
+        """
+        sends the signal to all experiments matching the pattern, in one go.
+
+        The pattern is matched against the experiments in the presence registry, i.e. those that have
+        pinged this server since it started. A pattern also matches everything underneath it, so both
+        `sweep/lr-*` and `sweep` reach `sweep/lr-0.1/seed-1`.
+
+        :param pattern: a glob pattern, or a plain prefix for the experiments.
+        :param signal: the signal to deliver.
+        :return: the list of experiment keys the signal is delivered to.
+        """
+        pattern = pattern.rstrip('/')
+        exp_keys = [k for k in list(self.presence) if fnmatch(k, pattern) or fnmatch(k, pattern + '/*')]
+        for exp_key in exp_keys:
+            self.mailbox[exp_key].append(signal)
+            self.notify(exp_key)
+        return exp_keys
+
+    def notify(self, channel):
+        """wakes up everyone listening on the channel. Listeners are fired only once."""
+        for callback in self.listeners.pop(channel, []):
+            callback()
+
+    def _unlisten(self, channel, callback):
+        callbacks = self.listeners.get(channel)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.listeners[channel]
+
+    def _presence(self, exp_key, status):
+        now = datetime.now()
+        # note: re-inserted, so that the registry stays in the order of the last ping.
+        self.presence.pop(exp_key, None)
+        self.presence[exp_key] = dict(status=status, time=now)
+        self._expire_presence(now)
         status_path = os.path.join(exp_key, '__presence')
         self.log(status_path, dict(status=status, time=datetime.now()), dtype="yaml",
                  options=LogOptions(overwrite=True, write_mode='key'))
+
+    def _expire_presence(self, now):
+        """drops the least recently pinged experiments, while they are past `PRESENCE_TTL` or `MAX_PRESENCE`."""
+        while self.presence:
+            exp_key = next(iter(self.presence))
+            entry = self.presence.get(exp_key)
+            if entry is not None and len(self.presence) <= MAX_PRESENCE \
+                    and (now - entry['time']).total_seconds() <= PRESENCE_TTL:
+                break
+            self.presence.pop(exp_key, None)
+            self.mailbox.pop(exp_key, None)
+
+    def _forget_experiments(self, key):
+        """drops the experiments at key, and underneath it, from the presence registry and the mailbox."""
+        path = os.path.normpath(key)
+        for registry in (self.presence, self.mailbox):
+            for exp_key in list(registry):
+                exp_path = os.path.normpath(exp_key)
+                if exp_path == path or exp_path.startswith(path + "/"):
+                    registry.pop(exp_key, None)
+
+    def _read_signal(self, exp_key, burn=True):
         signal_path = os.path.join(exp_key, '__signal.pkl')
         res = self.load(signal_path, 'read_pkl')
         if burn:
             self.remove(signal_path)
-        return serialize(res)
+            broadcasts = self.mailbox.pop(exp_key, None)
+        else:
+            broadcasts = self.mailbox.get(exp_key)
+        if broadcasts:
+            res = (res or []) + broadcasts
+        return res
 
     def read_handler(self, req):
         if not req.json:
@@ -84,9 +429,73 @@ class LoggingServer:
             return req.Response(text=msg)
         load_entry = LoadEntry(**req.json)
         print("loading: {} type: {}".format(load_entry.key, load_entry.type))
-        res = self.load(load_entry.key, load_entry.type)
-        data = serialize(res)
-        return req.Response(text=data)
+        stat = self.stat(load_entry.key)
+        if stat is None:
+            # archived members and records have no validators, but are still read by range.
+            headers, size = {}, self._missing_size(load_entry.key)
+        else:
+            size = stat.st_size
+            etag = '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+            headers = {'ETag': etag, 'Last-Modified': formatdate(stat.st_mtime, usegmt=True)}
+            if_none_match = get_header(req, 'If-None-Match')
+            if_modified_since = get_header(req, 'If-Modified-Since')
+            if if_none_match is not None:
+                if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+                    return req.Response(code=304, headers=headers)
+            elif if_modified_since is not None:
+                try:
+                    if int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp():
+                        return req.Response(code=304, headers=headers)
+                except (TypeError, ValueError):
+                    pass
+
+        byte_range = get_header(req, 'Range')
+        if byte_range and load_entry.type == 'read' and size is not None:
+            span = parse_range(byte_range, size)
+            if span is not None:
+                start, stop = span
+                if start >= stop:
+                    headers['Content-Range'] = 'bytes */{}'.format(size)
+                    return req.Response(code=416, headers=headers)
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+                data = self.load(load_entry.key, load_entry.type, start, stop)
+                return req.Response(code=206, text=serialize(data), headers=headers)
+        return req.Response(text=serialize(self.load(load_entry.key, load_entry.type)), headers=headers)
+
+    def stat(self, key):
+        """the `os.stat` of the file at key, for the validators of a read. None for missing files and directories."""
+        try:
+            stat = os.stat(os.path.join(self.data_dir, key))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return stat if S_ISREG(stat.st_mode) else None
+
+    def multi_handler(self, req):
+        if not req.json:
+            msg = f'request json is empty: {req.text}'
+            print(msg)
+            return req.Response(text=msg)
+        multi_entry = MultiEntry(**req.json)
+        print("loading {} keys, type: {}".format(len(multi_entry.keys), multi_entry.type))
+        return req.Response(text=serialize_many(self.load_many(*multi_entry)))
+
+    def load_many(self, keys, dtype="read_pkl"):
+        """loads each of the keys, see `load`. Missing keys load as None."""
+        return [self.load(key, dtype) for key in keys]
+
+    def list_handler(self, req):
+        list_entry = ListEntry(**(req.json or {}))
+        print("listing: {} {}".format(list_entry.prefix, list_entry.pattern or ""))
+        return req.Response(text=serialize(self.list(*list_entry)))
+
+    def list(self, prefix="", pattern=None, sort="name", limit=100, cursor=None):
+        """
+        lists the directories under the logging directory, one page at a time, from an index that
+        `log` and `remove` keep up to date. See `DirectoryIndex.list` for the arguments.
+
+        :return: dict(entries=[(path, mtime), ...], cursor=...), pass the cursor back for the next page.
+        """
+        return self.index.list(prefix, pattern, sort, limit, cursor)
 
     def remove_handler(self, req):
         if not req.json:
@@ -108,53 +517,243 @@ class LoggingServer:
         self.log(log_entry.key, data, log_entry.type, LogOptions(*log_entry.options))
         return req.Response(text='ok')
 
-    def load(self, key, dtype):
+    def batch_handler(self, req):
+        """applies the log and remove requests forwarded by a node-local aggregator, in order."""
+        if not req.json:
+            msg = f'request json is empty: {req.text}'
+            print(msg)
+            return req.Response(text=msg)
+        batch_entry = BatchEntry(**req.json)
+        entries = unpack_batch(batch_entry.data)
+        print("writing batch of {} entries".format(len(entries)))
+        for method, json in entries:
+            if method == "DELETE":
+                self.remove(RemoveEntry(**json).key)
+            else:
+                log_entry = LogEntry(**json)
+                data = deserialize(log_entry.data)
+                self.log(log_entry.key, data, log_entry.type, LogOptions(*(log_entry.options or ())))
+        return req.Response(text='ok')
+
+    def load(self, key, dtype, start=None, stop=None):
+        """
+        :param key: the path from the logging directory.
+        :param dtype: one of `read`, `read_text`, `read_pkl` and `read_np`.
+        :param start: for `read`, the first byte to read. Negative values count from the end.
+        :param stop: for `read`, the byte to stop at (exclusive). None reads to the end.
+        """
         if dtype == 'read':
             abs_path = os.path.join(self.data_dir, key)
             try:
                 with open(abs_path, 'rb') as f:
-                    return f.decode('utf-8')
+                    if start is not None:
+                        f.seek(start, 0 if start >= 0 else 2)
+                    return f.read(-1 if stop is None else max(stop - f.tell(), 0))
             except FileNotFoundError as e:
-                return None
+                return self._load_missing(key, dtype, start, stop)
         elif dtype == 'read_text':
             abs_path = os.path.join(self.data_dir, key)
             try:
                 with open(abs_path, 'r') as f:
-                    return f.decode('utf-8')
+                    return f.read()
             except FileNotFoundError as e:
-                return None
+                return self._load_missing(key, dtype)
         elif dtype == 'read_pkl':
             from ml_logger.helpers import load_from_pickle
             abs_path = os.path.join(self.data_dir, key)
             try:
                 return list(load_from_pickle(abs_path))
             except FileNotFoundError as e:
-                return None
+                return self._load_missing(key, dtype)
         elif dtype == 'read_np':
             import numpy
             abs_path = os.path.join(self.data_dir, key)
             try:
                 return numpy.load(abs_path)
             except FileNotFoundError as e:
-                return None
+                return self._load_missing(key, dtype)
         elif dtype == 'read_image':
             raise NotImplemented('reading images is not implemented.')
 
+    def params_handler(self, req):
+        query = ParamsQuery(**(req.json or {}))
+        print("querying params: {}".format(query.where))
+        return req.Response(text=serialize(self.query_params(*query)))
+
+    def query_params(self, where=(), prefix="", limit=1000):
+        """
+        finds the experiments by their parameters, from the index that `log` keeps of every
+        `parameters.pkl`. See `KVStore.query` for the predicates.
+
+        :return: the sorted list of the matching experiment prefixes.
+        """
+        return self.kv.query([tuple(predicate) for predicate in where], prefix, limit)
+
+    def _index_params(self, key, items, overwrite=False):
+        """
+        updates the record and the index of a `parameters.pkl` from the items written to it.
+
+        :param items: the records written, in order. Dictionaries are merged, anything else is skipped.
+        :param overwrite: whether the file was overwritten, which replaces the record instead.
+        """
+        params = {}
+        for item in items:
+            if isinstance(item, dict):
+                params.update(item)
+        if params or overwrite:
+            path = os.path.normpath(key)
+            self.kv.update_params(os.path.splitext(path)[0] + ".yml", os.path.dirname(path), params,
+                                  merge=not overwrite)
+
+    def reindex_params(self):
+        """indexes the `parameters.pkl` files that were written before the index existed."""
+        from ml_logger.helpers import load_from_pickle
+        for parent, dirs, files in os.walk(self.data_dir):
+            dirs[:] = [d for d in dirs if d != TRASH]
+            if PARAMETERS in files:
+                key = os.path.relpath(os.path.join(parent, PARAMETERS), self.data_dir)
+                self._index_params(key, load_from_pickle(os.path.join(parent, PARAMETERS)), overwrite=True)
+
+    async def archive_handler(self, req):
+        if not req.json:
+            msg = f'request json is empty: {req.text}'
+            print(msg)
+            return req.Response(text=msg)
+        archive_entry = ArchiveEntry(**req.json)
+        print("{}: {}".format("unpacking" if archive_entry.unpack else "archiving", archive_entry.key))
+        # note: packing takes a while, and runs on a thread so that the server keeps serving.
+        loop = asyncio.get_event_loop()
+        fn = self.unarchive if archive_entry.unpack else self.archive
+        n = await loop.run_in_executor(None, fn, archive_entry.key)
+        return req.Response(text=serialize(n))
+
+    def archive(self, key):
+        """
+        packs a finished experiment into a single file, `key.archive.zip`, and removes the directory.
+        `load` reads its files from the archive in place, so the paths stay the same. Writes to the
+        directory after this make a new directory, which takes precedence. See `ml_logger.archive`.
+
+        :param key: the path of the directory.
+        :return: the number of files archived.
+        """
+        path = os.path.normpath(key)
+        abs_path = os.path.join(self.data_dir, path)
+        assert path != "." and os.path.isdir(abs_path), f"{key} is not a directory under the logging directory"
+        archive_path = abs_path + ARCHIVE
+        if os.path.exists(archive_path):
+            # an archived directory that has been written to since: the two are merged.
+            unpack(archive_path, abs_path)
+        n = pack(abs_path, archive_path)
+        self.archives.close(archive_path)
+        self.trash.put(abs_path)
+        self.index.discard(path)
+        self.index.touch(os.path.join(path, ARCHIVE))
+        return n
+
+    def unarchive(self, key):
+        """
+        the reverse of `archive`: extracts the archive of the directory at key, and removes it.
+
+        :return: the number of files in the archive.
+        """
+        path = os.path.normpath(key)
+        abs_path = os.path.join(self.data_dir, path)
+        names = unpack(abs_path + ARCHIVE, abs_path)
+        self.archives.close(abs_path + ARCHIVE)
+        os.remove(abs_path + ARCHIVE)
+        for name in names:
+            self.index.touch(os.path.join(path, name))
+        return len(names)
+
+    def trash_handler(self, req):
+        return req.Response(text=serialize(self.trash.status()))
+
+    def _load_missing(self, key, dtype, start=None, stop=None):
+        """loads a key that has no file: from the archive of a directory above it, or from its record."""
+        found = self.archives.find(key)
+        if found is not None:
+            return self._load_member(*found, dtype, start, stop)
+        if dtype in ('read', 'read_text'):
+            return self._load_record(key, dtype, start, stop)
+        return None
+
+    def _missing_size(self, key):
+        """the size of a key that has no file, see `_load_missing`. None if there is nothing at key."""
+        found = self.archives.find(key)
+        if found is not None:
+            return found[1].file_size
+        record = self.kv.get(os.path.normpath(key))
+        return None if record is None else len(to_yaml(record).encode("utf-8"))
+
+    def _load_member(self, zf, info, dtype, start=None, stop=None):
+        """reads a member of an archive, in place."""
+        with zf.open(info) as f:
+            if dtype == 'read':
+                if start is not None:
+                    f.seek(start if start >= 0 else max(info.file_size + start, 0))
+                return f.read(-1 if stop is None else max(stop - f.tell(), 0))
+            elif dtype == 'read_text':
+                return f.read().decode("utf-8")
+            elif dtype == 'read_pkl':
+                records = []
+                while True:
+                    try:
+                        records.append(dill.load(f))
+                    except EOFError:
+                        return records
+            elif dtype == 'read_np':
+                import numpy
+                return numpy.load(BytesIO(f.read()))
+
+    def _load_record(self, key, dtype, start=None, stop=None):
+        """the YAML file of the record at key, generated on demand. None if there is no record."""
+        record = self.kv.get(os.path.normpath(key))
+        if record is None:
+            return None
+        text = to_yaml(record)
+        return text if dtype == 'read_text' else text.encode("utf-8")[start:stop]
+
     def remove(self, key):
         """
-        removes by key.
+        removes by key. Directories are moved into the trash, and deleted in the background, so they
+        are gone right away however many files they hold. See `Trash`.
 
         :param key: the path from the logging directory.
         :return: None
         """
         abs_path = os.path.join(self.data_dir, key)
+        if os.path.normpath(abs_path) == os.path.normpath(self.data_dir):
+            # note: the logging directory itself stays, and holds the trash.
+            self.archives.close()
+            for name in os.listdir(self.data_dir):
+                if name != TRASH and not name.startswith(RECORDS):
+                    self.remove(name)
+            self.kv.delete("")
+            self.presence.clear()
+            self.mailbox.clear()
+            return
+        self.index.discard(key)
+        archive_path = os.path.normpath(abs_path) + ARCHIVE
+        if os.path.isfile(archive_path):
+            self.archives.close(archive_path)
+            os.remove(archive_path)
         try:
             os.remove(abs_path)
+            if os.path.basename(key) == PARAMETERS:
+                path = os.path.normpath(key)
+                self.kv.delete(os.path.splitext(path)[0] + ".yml")
+                self.kv.index(os.path.dirname(path), {})
         except FileNotFoundError as e:
-            return None
+            # note: records have no file, and neither do directories that only hold records.
+            self.kv.delete(key)
         except OSError as e:
-            import shutil
-            shutil.rmtree(abs_path)
+            # note: only directories, so that burning a signal on every ping does not scan the registry.
+            self.kv.delete(key)
+            self._forget_experiments(key)
+            try:
+                self.trash.put(abs_path)
+            except FileNotFoundError:
+                return None
 
     def log(self, key, data, dtype, options: LogOptions = None):
         """
@@ -166,6 +765,7 @@ class LoggingServer:
         :param options:
         :return:
         """
+        self.index.touch(key)
         # todo: overwrite mode is not tested and not in-use.
         write_mode = "w" if options and options.overwrite else "a"
         if dtype == "log":
@@ -177,6 +777,22 @@ class LoggingServer:
                 os.makedirs(os.path.dirname(abs_path))
                 with open(abs_path, write_mode + 'b') as f:
                     dill.dump(data, f)
+            if os.path.basename(key) == "__signal.pkl":
+                self.notify(os.path.dirname(key))
+            elif os.path.basename(key) == PARAMETERS:
+                self._index_params(key, [data], overwrite=write_mode == "w")
+        elif dtype == "log_many":
+            abs_path = os.path.join(self.data_dir, key)
+            try:
+                f = open(abs_path, write_mode + 'b')
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(abs_path))
+                f = open(abs_path, write_mode + 'b')
+            with f:
+                for item in data:
+                    dill.dump(item, f)
+            if os.path.basename(key) == PARAMETERS:
+                self._index_params(key, data, overwrite=write_mode == "w")
         if dtype == "byte":
             abs_path = os.path.join(self.data_dir, key)
             try:
@@ -195,29 +811,24 @@ class LoggingServer:
                 os.makedirs(os.path.dirname(abs_path))
                 with open(abs_path, write_mode + "+") as f:
                     f.write(data)
+        elif dtype.startswith("yaml") and options and (options.overwrite or options.write_mode == 'key'):
+            # note: YAML files that are rewritten (presence, status) are kept as records, and
+            #   generated on demand by `load`. The directory is still made, for listing.
+            abs_path = os.path.join(self.data_dir, key)
+            os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+            if options.write_mode == 'key':
+                self.kv.update(os.path.normpath(key), data)
+            else:
+                self.kv.put(os.path.normpath(key), data)
         elif dtype.startswith("yaml"):
-            yaml = YAML()
-            yaml.explict_start = True
-            stream = StringIO()
-            yaml.dump(data, stream)
-            output = stream.getvalue()
+            output = to_yaml(data)
             abs_path = os.path.join(self.data_dir, key)
             try:
                 with open(abs_path, write_mode + "+") as f:
-                    if options.write_mode == 'key':
-                        d = yaml.load('\n'.join(f))
-                        if d is not None:
-                            d.update(output)
-                            output = d
                     f.write(output)
             except FileNotFoundError:
                 os.makedirs(os.path.dirname(abs_path))
                 with open(abs_path, write_mode + "+") as f:
-                    if options.write_mode == 'key':
-                        d = yaml.load('\n'.join(f))
-                        if d is not None:
-                            d.update(output)
-                            output = d
                     f.write(output)
         elif dtype.startswith("image"):
             abs_path = os.path.join(self.data_dir, key)
@@ -233,6 +844,9 @@ class LoggingServer:
             except FileNotFoundError:
                 os.makedirs(os.path.dirname(abs_path))
                 im.save(abs_path)
+        if key in self.listeners:
+            # wakes up the `tail` subscribers of the file.
+            self.notify(key)
 
 
 @cli_parse
@@ -0,0 +1,268 @@
+"""
+Shared-memory hand-off of schema metrics to a logging sidecar process.
+
+With `logger.schema(..., sidecar=True)`, each step is copied as one fixed-layout row into a ring
+buffer in shared memory. A sidecar process reads the rows back, and does the pickling and the
+writes (or requests) in its place, so the training process only pays for the copy.
+
+The sidecar is the only writer of its file. The other records the training process logs to the same
+file are sent to the sidecar through its stdin, and written in between the rows.
+"""
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import cloudpickle
+import numpy as np
+
+from ml_logger.helpers import COLUMNAR, local_datetime64
+
+# head (rows written), tail (rows read) and the closed flag, padded to a cache line.
+HEADER_SIZE = 64
+
+
+def row_dtype(**dtypes):
+    """the structured dtype of a ring row: the step and timestamp, then one field per key."""
+    return np.dtype([("_step", np.int64), ("_timestamp", np.float64),
+                     *[(k, np.dtype(dtype)) for k, dtype in dtypes.items()]])
+
+
+class ShmRing:
+    """
+    A single-producer, single-consumer ring of fixed-layout rows in a `SharedMemory` block.
+
+    The head and tail only ever grow, and each side only writes its own. The producer writes a row
+    before it moves the head, so the consumer never sees a half-written row.
+    """
+
+    def __init__(self, capacity, dtype, name=None):
+        """
+        :param capacity: the number of rows in the ring.
+        :param dtype: the structured dtype of a row, see `row_dtype`.
+        :param name: the name of an existing ring to attach to. Creates a new one when None.
+        """
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        size = HEADER_SIZE + capacity * self.dtype.itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self.header = np.ndarray(3, dtype=np.int64, buffer=self.shm.buf)
+        self.rows = np.ndarray(capacity, dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_SIZE)
+        if name is None:
+            self.header[:] = 0
+
+    @property
+    def closed(self):
+        return bool(self.header[2])
+
+    def push(self, row):
+        """
+        copies the row into the ring.
+
+        :return: False if the ring is full, in which case nothing is written.
+        """
+        head = int(self.header[0])
+        if head - int(self.header[1]) >= self.capacity:
+            return False
+        self.rows[head % self.capacity] = row
+        self.header[0] = head + 1
+        return True
+
+    def pop_all(self, stop=None):
+        """
+        returns a copy of the rows written since the last call, in order, or None.
+
+        :param stop: only the rows before this one, counted from the first row ever written.
+        """
+        head, tail = int(self.header[0]), int(self.header[1])
+        if stop is not None:
+            head = min(head, stop)
+        if head <= tail:
+            return None
+        i, j = tail % self.capacity, head % self.capacity
+        if i < j:
+            rows = self.rows[i:j].copy()
+        else:
+            rows = np.concatenate([self.rows[i:], self.rows[:j]])
+        self.header[1] = head
+        return rows
+
+    def close(self):
+        """marks the ring as closed, so that the consumer exits once it has read the remaining rows."""
+        self.header[2] = 1
+
+    def release(self, unlink=False):
+        del self.header, self.rows
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13 always tracks, and would unlink the block when the sidecar exits.
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def to_record(rows):
+    """turns a block of ring rows into a columnar record, like `MetricBuffer.to_record`."""
+    record = {COLUMNAR: True}
+    for k in rows.dtype.names:
+        record[k] = local_datetime64(rows[k]) if k == "_timestamp" else rows[k]
+    return record
+
+
+def read_records(stream, inbox):
+    """reads the (head, records) frames that `ShmMetricBuffer.send` writes, until the pipe is closed."""
+    while True:
+        try:
+            inbox.append(cloudpickle.load(stream))
+        except EOFError:
+            return
+
+
+def drain(name, capacity, dtype, log_directory, key, interval=0.05):
+    """
+    The sidecar loop. Reads the rows out of the ring, and logs them to `key` as columnar records,
+    until the ring is closed or the training process is gone. The records that come in on stdin are
+    logged after the rows that were in the ring when they were sent.
+    """
+    from ml_logger.log_client import LogClient
+
+    parent = os.getppid()
+    ring = ShmRing(capacity, dtype, name=name)
+    client = LogClient(url=log_directory)
+    inbox = deque()
+    reader = threading.Thread(target=read_records, args=(sys.stdin.buffer, inbox), daemon=True)
+    reader.start()
+    try:
+        while True:
+            closed = ring.closed or os.getppid() != parent
+            if closed:
+                # note: the pipe is closed before the ring, so every record sent is in once the reader is done.
+                reader.join()
+            while inbox:
+                head, records = inbox.popleft()
+                rows = ring.pop_all(head)
+                if rows is not None:
+                    client.log(key, to_record(rows), ordered=True)
+                client.log_many(key, records, ordered=True)
+            rows = ring.pop_all()
+            if rows is not None:
+                client.log(key, to_record(rows), ordered=True)
+            elif closed:
+                break
+            else:
+                time.sleep(interval)
+    finally:
+        ring.release()
+
+
+class ShmMetricBuffer:
+    """
+    Stands in for `MetricBuffer` in `ML_Logger.schema`, but hands the rows to a sidecar process.
+
+    The row of the current step is staged in process, and copied into the ring when the step changes
+    or on `commit`. Logging blocks while the ring is full.
+    """
+    sidecar = True
+
+    def __init__(self, log_directory, key, capacity=4096, **dtypes):
+        """
+        :param log_directory: the log directory (or server url) for the sidecar to log to.
+        :param key: the pickle file the rows go to.
+        :param capacity: the number of rows in the ring.
+        :param dtypes: key=dtype pairs, the dtype being anything `numpy.dtype` accepts.
+        """
+        self.key = key
+        self.ring = ShmRing(capacity, row_dtype(**dtypes))
+        dtype = self.ring.dtype
+        # the row is staged as a list, and copied over as a tuple, which numpy assigns in one go.
+        self.fields = {k: i for i, k in enumerate(dtype.names)}
+        self.blank = [np.nan if dtype[k].kind in "fc" else 0 for k in dtype.names]
+        self.row = list(self.blank)
+        self.size = 0
+        self.owner = threading.get_ident()
+        # a fresh interpreter rather than a fork, which is not safe in a process with threads or CUDA.
+        descr = json.dumps(dtype.descr)
+        self.process = subprocess.Popen([sys.executable, "-m", "ml_logger.shm", self.ring.name,
+                                         str(capacity), descr, log_directory, key], stdin=subprocess.PIPE)
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def accepts(self, values):
+        fields = self.fields
+        for k in values:
+            if k not in fields or k[0] == "_":
+                return False
+        return True
+
+    def write(self, step, values):
+        """writes the values into the row of the step. Always returns True."""
+        row = self.row
+        if not self.size or row[0] != step:
+            self.commit()
+            row[0] = step
+            row[1] = time.time()
+            self.size = 1
+        fields = self.fields
+        for k, v in values.items():
+            row[fields[k]] = v
+        return True
+
+    def commit(self):
+        """copies the staged row into the ring, waiting for the sidecar if the ring is full."""
+        if not self.size:
+            return
+        row = tuple(self.row)
+        while not self.ring.push(row):
+            if self.process.poll() is not None:
+                raise RuntimeError(f"the logging sidecar exited with code {self.process.returncode}")
+            time.sleep(0.001)
+        self.row[:] = self.blank
+        self.size = 0
+
+    def send(self, records):
+        """
+        hands other records for the key over to the sidecar, which writes them after the rows that are
+        in the ring now.
+
+        :return: False if the sidecar is closed, in which case nothing is sent.
+        """
+        with self.lock:
+            if self.ring is None:
+                return False
+            cloudpickle.dump((int(self.ring.header[0]), records), self.process.stdin)
+            self.process.stdin.flush()
+            return True
+
+    def close(self):
+        """commits the staged row, and waits for the sidecar to log everything before it exits."""
+        if self.ring is None:
+            return
+        self.commit()
+        with self.lock:
+            self.process.stdin.close()
+        self.ring.close()
+        self.process.wait()
+        self.ring.release(unlink=True)
+        self.ring = None
+
+
+if __name__ == "__main__":
+    name, capacity, descr, log_directory, key = sys.argv[1:]
+    dtype = np.dtype([tuple(field) for field in json.loads(descr)])
+    drain(name, int(capacity), dtype, log_directory, key)
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+
+class Trash:
+    """
+    Deletes directories in the background, for `LoggingServer.remove`.
+
+    A directory is first renamed into the trash, which is atomic and instant, so that it is gone for
+    everyone right away. A background thread then deletes the files in the trash one by one, at no
+    more than `rate` files per second, so that it does not starve the writes of the server.
+
+    Whatever is still in the trash when the server stops is deleted after the next start. Files that
+    can not be deleted are reported and skipped, and stay in the trash until then.
+    """
+
+    def __init__(self, path, rate=2000):
+        """
+        :param path: the trash directory. Has to be on the same file system as the removed directories.
+        :param rate: the maximum number of files deleted per second.
+        """
+        self.path = path
+        self.rate = rate
+        os.makedirs(path, exist_ok=True)
+        self.queue = deque(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.removed = 0
+        self.current = None
+        self.closed = False
+        if self.queue:
+            self._start()
+
+    def put(self, abs_path):
+        """moves the directory into the trash, for the background thread to delete."""
+        target = os.path.join(self.path, "{:x}-{}".format(time.time_ns(), uuid.uuid4().hex[:8]))
+        os.rename(abs_path, target)
+        with self.lock:
+            self.queue.append(target)
+            self._start()
+        self.wake.set()
+
+    def after_fork(self):
+        """starts over in a forked child, with a new lock. The directories in the trash are left to the parent."""
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.queue = deque()
+        self.thread = self.current = None
+
+    def close(self):
+        """stops the thread after the directory it is on. The rest is deleted after the next start."""
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+        self.wake.set()
+        if thread is not None:
+            thread.join()
+
+    def _start(self):
+        if not self.closed and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                self.current = self.queue[0] if self.queue else None
+            if self.current is None:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            try:
+                self._delete(self.current)
+            except Exception as e:
+                print(f"failed to empty {self.current} from the trash: {e}")
+            with self.lock:
+                self.queue.popleft()
+                self.current = None
+
+    def _delete(self, path):
+        # note: the sleep is paid every 100 files, to keep the overhead of throttling low.
+        batch, start = 0, time.time()
+        for parent, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                if self._unlink(os.path.join(parent, name), os.remove):
+                    self.removed += 1
+                batch += 1
+                if batch == 100:
+                    time.sleep(max(0., batch / self.rate - (time.time() - start)))
+                    batch, start = 0, time.time()
+            for name in dirs:
+                child = os.path.join(parent, name)
+                # note: a link to a directory is listed with the directories, but is unlinked like a file.
+                self._unlink(child, os.remove if os.path.islink(child) else os.rmdir)
+        self._unlink(path, os.rmdir)
+
+    @staticmethod
+    def _unlink(path, remove):
+        try:
+            remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print(f"failed to delete {path} from the trash: {e}")
+            return False
+
+    def status(self):
+        """:return: dict(pending=..., removed=..., current=...). `pending` includes the one being deleted."""
+        with self.lock:
+            return dict(pending=len(self.queue), removed=self.removed,
+                        current=self.current and os.path.basename(self.current))
+
+    def join(self, timeout=None):
+        """waits for the trash to be empty. Returns False if it is not empty after `timeout` seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.status()['pending']:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
@@ -0,0 +1,44 @@
+"""
+Per-call cost of `ML_Logger.log`, with and without a schema.
+
+    python scratch/benchmark_log_schema.py
+
+Logs to a temporary local directory, with the printouts sent to /dev/null.
+"""
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from timeit import default_timer
+
+from ml_logger import ML_Logger
+
+N = 20_000
+
+
+def bench(logger, n=N):
+    start = default_timer()
+    for step in range(n):
+        logger.log(step=step, loss=0.1, reward=1.0, episode=step)
+    logger.flush()
+    return (default_timer() - start) / n
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as log_dir, open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull):
+            logger = ML_Logger(log_dir, prefix="regular")
+            regular = bench(logger)
+
+            logger = ML_Logger(log_dir, prefix="schema")
+            logger.schema(capacity=N, loss='float32', reward='float32', episode='int64')
+            fast = bench(logger)
+
+            logger = ML_Logger(log_dir, prefix="sidecar")
+            logger.schema(capacity=N, sidecar=True, loss='float32', reward='float32', episode='int64')
+            sidecar = bench(logger)
+            logger.schema()
+
+    print(f"regular log: {regular * 1e6:.2f}µs per call", file=sys.stderr)
+    print(f"schema log:  {fast * 1e6:.2f}µs per call ({regular / fast:.0f}x)", file=sys.stderr)
+    print(f"sidecar log: {sidecar * 1e6:.2f}µs per call ({regular / sidecar:.0f}x)", file=sys.stderr)
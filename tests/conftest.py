@@ -1,3 +1,68 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import pytest
+
+
 def pytest_addoption(parser):
     parser.addoption('--log-dir', action='store', default='/tmp/ml-logger-debug',
                      help="The logging path for the test.")
+
+
+class Request:
+    """the parts of a japronto request that the handlers of `LoggingServer` use."""
+
+    def __init__(self, json=None, headers=None):
+        self.json, self.text, self.headers = json, "", headers or {}
+
+    class Response:
+        def __init__(self, text="", code=200, headers=None):
+            self.text, self.code, self.headers = text, code, headers or {}
+
+        # the names of a `requests` response, which the clients read.
+        @property
+        def status_code(self):
+            return self.code
+
+        @property
+        def ok(self):
+            return self.code < 400
+
+
+class Session:
+    """
+    Stands in for the http session of a `LogClient` (or of an `Aggregator`), and sends the requests
+    straight to the handlers of a server. Keeps the status of every response.
+    """
+
+    def __init__(self, server, routes=None, futures=True):
+        """
+        :param server: the `LoggingServer`.
+        :param routes: (method, path) => handler, on top of the reads and the batches.
+        :param futures: return completed futures, like a `FuturesSession`, rather than the responses.
+        """
+        self.routes = {("GET", "/"): server.read_handler, ("POST", "/batch"): server.batch_handler, **(routes or {})}
+        self.futures = futures
+        self.statuses = []
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        res = self.routes[method, urlparse(url).path or "/"](Request(json, headers))
+        self.statuses.append(res.code)
+        if not self.futures:
+            return res
+        future = Future()
+        future.set_result(res)
+        return future
+
+    def get(self, url, json=None, headers=None, **kwargs):
+        return self.request("GET", url, json=json, headers=headers, **kwargs)
+
+    def post(self, url, json=None, headers=None, **kwargs):
+        return self.request("POST", url, json=json, headers=headers, **kwargs)
+
+
+@pytest.fixture
+def fake_http():
+    """the fake japronto `Request`, and the `Session` that sends requests straight to a server."""
+    return SimpleNamespace(Request=Request, Session=Session)
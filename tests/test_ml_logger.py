@@ -21,6 +21,7 @@ or do
 make test-with-server
 ```
 """
+import os
 import pytest
 from time import sleep
 from os.path import join as pathJoin
@@ -224,3 +225,910 @@ def test_ping(setup):
         sleep(0.4)
 
     logger.ping('completed')
+
+
+def test_ping_idle(tmp_path, monkeypatch):
+    import time
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(str(tmp_path), prefix="idle")
+    _logger.listen_timeout = 0.5
+    timeouts = []
+    listen = _logger.logger.listen
+    monkeypatch.setattr(_logger.logger, "listen",
+                        lambda *args, timeout: timeouts.append(timeout) or listen(*args, timeout=timeout))
+    assert _logger.ping('running', 0.05) == []
+    time.sleep(1.2)
+    assert 1 <= len(timeouts) <= 3, "an idle job sends one request per long-poll, not per status interval"
+    assert all(timeout == 0.5 for timeout in timeouts)
+
+    _logger.listen_timeout = 3600
+    _logger.logger.send_signal("idle", signal="stop")
+    time.sleep(0.2)
+    assert _logger.ping('running') == [["stop"]], "signals still come through right away"
+
+
+def test_listen(setup):
+    import threading
+    from time import time
+
+    exp_key = pathJoin(logger.prefix, 'listen_test')
+    logger.logger.listen(exp_key, 'running', timeout=0)  # burn left-over signals
+
+    def send():
+        sleep(0.2)
+        logger.logger.send_signal(exp_key, signal="stop")
+
+    threading.Thread(target=send).start()
+    start = time()
+    signals = logger.logger.listen(exp_key, 'running', timeout=10)
+    assert signals == ["stop"], "the signal should be pushed to the listener"
+    assert time() - start < 5, "the listener should return as soon as the signal is sent"
+
+
+def test_broadcast_signal(setup):
+    sweep = pathJoin(logger.prefix, 'sweep')
+    for exp in ['lr-1/seed-0', 'lr-1/seed-1', 'lr-2/seed-0']:
+        logger.logger.ping(pathJoin(sweep, exp), 'running')
+
+    exp_keys = logger.logger.broadcast_signal(pathJoin(sweep, 'lr-1'), signal="stop")
+    assert sorted(exp_keys) == [pathJoin(sweep, 'lr-1/seed-0'), pathJoin(sweep, 'lr-1/seed-1')]
+    assert logger.logger.ping(pathJoin(sweep, 'lr-1/seed-0'), 'running') == ["stop"]
+    assert logger.logger.ping(pathJoin(sweep, 'lr-2/seed-0'), 'running') is None
+
+    exp_keys = logger.logger.broadcast_signal(pathJoin(sweep, '*/seed-0'), signal="pause")
+    assert len(exp_keys) == 2, "glob patterns should match across the sweep"
+
+
+def test_schema(setup, log_dir):
+    import numpy as np
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'schema_test'))
+    _logger.remove('metrics.pkl')
+    _logger.schema(capacity=4, loss='float32', episode='int64')
+    for step in range(6):
+        _logger.log(step=step, loss=step * 0.5)
+        _logger.log(step=step, episode=step * 10)
+    _logger.flush()
+
+    rows = _logger.load_pkl_log('metrics.pkl')
+    assert [row['_step'] for row in rows] == list(range(6))
+    assert [row['episode'] for row in rows] == [i * 10 for i in range(6)]
+    assert np.allclose([row['loss'] for row in rows], [i * 0.5 for i in range(6)])
+    assert len(_logger.load_pkl_log('metrics.pkl', expand=False)) == 2, "one record per full buffer"
+
+
+def test_schema_fallback(setup, log_dir):
+    from ml_logger import ML_Logger, Color
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'schema_fallback'))
+    _logger.remove('metrics.pkl')
+    _logger.schema(capacity=4, loss='float32')
+    _logger.log(step=7, loss=1.0, silent=True)
+    assert _logger.data['loss'] == 1.0 and _logger.step == 7, "silent keys go through the regular path"
+    _logger.log(step=8, loss=Color(2.0, 'red'))
+    assert _logger.data['loss'] == 2.0, "so do colors"
+    _logger.log(step=9, loss=3.0, flush=True)
+    assert _logger.data['loss'] == 3.0, "and flushes"
+    _logger.log(step=10)
+    assert _logger.step == 10 and not _logger.data, "a step without values still moves on"
+    _logger.log(step=11, loss=4.0)
+    assert _logger.step == 11 and not _logger.data, "the schema buffer keeps the step up to date"
+    _logger.flush()
+
+    rows = _logger.load_pkl_log('metrics.pkl')
+    assert sorted((row['_step'], row['loss']) for row in rows) == [(7, 1.0), (8, 2.0), (9, 3.0), (11, 4.0)]
+
+
+def test_schema_sidecar(setup, log_dir):
+    import numpy as np
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'sidecar_test'))
+    _logger.remove('metrics.pkl')
+    _logger.schema(capacity=4, sidecar=True, loss='float32', episode='int64')
+    for step in range(10):
+        _logger.log(step=step, loss=step * 0.5)
+        _logger.log(step=step, episode=step * 10)
+    # turning the schema off waits for the sidecar to write out the rows.
+    _logger.schema()
+
+    rows = _logger.load_pkl_log('metrics.pkl')
+    assert [row['_step'] for row in rows] == list(range(10))
+    assert [row['episode'] for row in rows] == [i * 10 for i in range(10)]
+    assert np.allclose([row['loss'] for row in rows], [i * 0.5 for i in range(10)])
+
+
+def test_schema_sidecar_shared_file(setup, log_dir, monkeypatch):
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'sidecar_shared'))
+    _logger.remove('metrics.pkl')
+    _logger.schema(capacity=4, sidecar=True, loss='float32')
+    shipped = []
+    log_many = _logger.logger.log_many
+    monkeypatch.setattr(_logger.logger, "log_many",
+                        lambda key, items, **kw: shipped.append(key) or log_many(key, items, **kw))
+    for step in range(10):
+        _logger.log(step=step, loss=step * 0.5)
+        if step % 3 == 0:
+            # not in the schema, so these go through the regular path.
+            _logger.log(step=step, lr=0.1 / (step + 1))
+            _logger.flush()
+    _logger.schema()
+
+    assert pathJoin(_logger.prefix, 'metrics.pkl') not in shipped, "the sidecar is the only writer of its file"
+    rows = _logger.load_pkl_log('metrics.pkl')
+    assert sorted(row['_step'] for row in rows if 'loss' in row) == list(range(10))
+    assert [row['_step'] for row in rows if 'lr' in row] == [0, 3, 6, 9]
+
+
+def test_aggregator(tmp_path, fake_http):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from ml_logger.aggregator import Aggregator
+    from ml_logger.log_client import LogClient
+    from ml_logger.serdes import serialize, unpack_batch
+    from ml_logger.server import LoggingServer
+
+    server = LoggingServer(str(tmp_path / "server"))
+    socket_path = tmp_path / "aggregator.sock"
+    batches = []
+    polling, released = threading.Event(), threading.Event()
+
+    def batch(req):
+        batches.append([entry['key'] for _, entry in unpack_batch(req.json['data'])])
+        return server.batch_handler(req)
+
+    def listen(req):
+        polling.set()
+        released.wait(timeout=5)
+        return req.Response(serialize([]))
+
+    class LocalAggregator(Aggregator):
+        # the upstream requests of the aggregator go straight to the server.
+        session = fake_http.Session(server, {("POST", "/batch"): batch, ("POST", "/listen"): listen}, futures=False)
+
+    def start():
+        aggregator = LocalAggregator(str(socket_path), "http://localhost:8081", connections=2, interval=60)
+        thread = threading.Thread(target=aggregator.run, daemon=True)
+        thread.start()
+        deadline = time.time() + 10
+        while not socket_path.exists() and time.time() < deadline:
+            time.sleep(0.01)
+        return aggregator, thread
+
+    aggregator, thread = start()
+    client = LogClient(f"unix://{socket_path}")
+    for i in range(5):
+        client.log("run-1/metrics.pkl", dict(i=i))
+        client.log("run-2/metrics.pkl", dict(i=i))
+    assert batches == [], "writes are held until the next flush"
+    assert client.read_pkl("run-1/metrics.pkl") == [dict(i=i) for i in range(5)], "reads flush the writes first"
+    assert client.read_pkl("run-2/metrics.pkl") == [dict(i=i) for i in range(5)]
+    assert sum(map(len, batches)) == 10 and len(batches) <= 2, "one batch per shard"
+
+    aggregator.stop()
+    thread.join(timeout=10)
+    assert not socket_path.exists()
+    aggregator, thread = start()
+    client.log("run-1/metrics.pkl", dict(i=5))
+    assert client.read_pkl("run-1/metrics.pkl") == [dict(i=i) for i in range(6)], "reconnects to the new aggregator"
+
+    aggregator.executor = ThreadPoolExecutor(max_workers=1)
+    poll = threading.Thread(target=client.listen, args=("run-1", "running"), kwargs=dict(timeout=1))
+    poll.start()
+    assert polling.wait(timeout=5)
+    started = time.time()
+    assert client.read_pkl("run-1/metrics.pkl") == [dict(i=i) for i in range(6)]
+    assert time.time() - started < 2, "long-polls do not hold up the reads"
+    released.set()
+    poll.join()
+
+    aggregator.stop()
+    thread.join(timeout=10)
+    assert isinstance(client.log("run-1/metrics.pkl", dict(i=6)).exception(), OSError)
+    with pytest.raises(OSError):
+        client.read_pkl("run-1/metrics.pkl")
+    assert server.load("run-1/metrics.pkl", "read_pkl") == [dict(i=i) for i in range(6)]
+
+
+def test_stream():
+    import numpy as np
+    from ml_logger import Stream
+
+    xs = np.random.RandomState(0).randn(5000)
+    stream = Stream(len=100, quantiles=(0.5, 0.99))
+    assert stream.mean is None and stream.max is None and stream.min is None
+
+    for i, x in enumerate(xs):
+        stream.append(x)
+        window = xs[max(0, i - 99):i + 1]
+        assert stream.latest == x
+        assert np.isclose(stream.mean, window.mean())
+        assert stream.max == window.max() and stream.min == window.min()
+    assert np.array_equal(stream.d, xs[-100:])
+    assert abs(stream.quantile(0.5) - np.median(xs)) < 0.05
+    assert abs(stream.quantile(0.99) - np.percentile(xs, 99)) < 0.1
+    assert abs(stream.ema - xs[-100:].mean()) < 0.5
+
+
+def test_accumulate(setup, log_dir):
+    import numpy as np
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'accumulate_test'))
+    _logger.remove('metrics.pkl')
+    _logger.log(step=0, lr=0.1)
+    returns = np.random.randn(1000)
+    for chunk in np.split(returns, 100):
+        _logger.accumulate(episode_return=chunk)
+    _logger.accumulate(stats=('mean', 'p90', 'p99.9'), episode_length=np.arange(10))
+    for stats in [('ptp',), ('prod',), ('p',), ('p9x',)]:
+        with pytest.raises(ValueError):
+            _logger.accumulate(stats=stats, episode_length=1)
+    _logger.flush()
+
+    row, = _logger.load_pkl_log('metrics.pkl')
+    assert row['episode_return/count'] == 1000
+    assert np.isclose(row['episode_return/mean'], returns.mean())
+    assert np.isclose(row['episode_return/std'], returns.std())
+    assert np.isclose(row['episode_length/p90'], np.percentile(np.arange(10), 90))
+    assert np.isclose(row['episode_length/p99.9'], np.percentile(np.arange(10), 99.9))
+    assert 'episode_length/std' not in row and row['lr'] == 0.1
+
+
+def test_threaded_logging(setup, log_dir):
+    import threading
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'threaded_test'))
+    _logger.remove('metrics.pkl')
+    _logger.log(step=0, lr=0.1)
+
+    def worker(i):
+        _logger.log(**{f"worker_{i}": i}, silent=True)
+        for _ in range(1000):
+            _logger.accumulate(batch_time=0.01)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert set(_logger.data) == {'lr', *[f"worker_{i}" for i in range(8)]}
+    _logger.data['worker_0'] = 10
+    del _logger.data['worker_7']
+    assert _logger.data['worker_0'] == 10 and 'worker_7' not in _logger.data
+    _logger.flush()
+
+    row, = _logger.load_pkl_log('metrics.pkl')
+    assert [row.get(f"worker_{i}") for i in range(8)] == [10, *range(1, 7), None]
+    assert row['batch_time/count'] == 8000 and row['lr'] == 0.1
+    assert len(_logger._stages) == 1, "the stages of the finished threads are dropped on flush"
+
+
+def test_log_pipeline(setup, log_dir, monkeypatch):
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'pipeline_test'), ship_interval=60)
+    shipped = []
+    # note: the client is shared with the other loggers of the log_dir, so the patch is undone after the test.
+    monkeypatch.setattr(_logger.logger, 'log_text', lambda key, text, **_: shipped.append(text))
+
+    for i in range(100):
+        _logger.log_line(f"line {i}", silent=True)
+    assert not shipped, "lines should be collected, not shipped one by one"
+    _logger.flush()
+    assert shipped == ["".join(f"line {i}\n" for i in range(100))], "the lines should be shipped once, in order"
+
+
+def test_shared_client(setup, log_dir):
+    from ml_logger import ML_Logger
+    from ml_logger.log_client import LogClient
+
+    a = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'shared_a'))
+    b = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'shared_b'))
+    assert a.logger is b.logger, "loggers with the same log directory share one client"
+    client = a.logger
+    refs = client.refs
+
+    b.configure(log_dir + "/shared_elsewhere", prefix='shared_b')
+    assert b.logger is not client and client.refs == refs - 1, "reconfiguring releases the old client"
+    del b
+    assert (log_dir + "/shared_elsewhere") not in LogClient.registry, "the last release removes the client"
+
+    c = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'shared_c'))
+    c.log_line("logged before it is dropped")
+    c.flush()
+    assert client.refs == refs
+    del c
+    assert client.refs == refs - 1, "a logger that has logged is released as well"
+
+
+def test_release_local_client(tmp_path):
+    from ml_logger import ML_Logger
+    from ml_logger.log_client import LogClient
+
+    _logger = ML_Logger(str(tmp_path), prefix="run")
+    _logger.log_line("hey")
+    server = _logger.logger.local_server
+    server.log("run/parameters.pkl", dict(Args=dict(seed=1)), dtype="log")
+    server.remove("run")
+    thread = server.trash.thread
+    del _logger
+    assert str(tmp_path) not in LogClient.registry
+    assert server.trash.closed and not thread.is_alive(), "releasing a local client closes its server"
+    assert server.kv.local.conn is None
+
+
+def test_logger_threads(tmp_path):
+    import threading
+    from ml_logger import ML_Logger
+
+    threads = threading.active_count()
+    for i in range(20):
+        _logger = ML_Logger(str(tmp_path), prefix=f"run-{i}", print_interval=0.1)
+        _logger.log("hey", step=0, x=i)
+        _logger.flush()
+        del _logger
+    assert threading.active_count() == threads, "dropping a logger stops its threads"
+    assert (tmp_path / "run-19" / "text.log").read_text().startswith("hey\n")
+
+    _logger = ML_Logger(str(tmp_path), prefix="closed")
+    _logger.log_line("bye")
+    _logger.close()
+    assert threading.active_count() == threads
+    assert "bye" in (tmp_path / "closed" / "text.log").read_text(), "close ships what is pending"
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_fork(tmp_path):
+    import time
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(str(tmp_path), prefix="forked")
+    _logger.log_line("from the parent", flush=True)
+    pipeline = _logger.pipeline
+    # as if another thread was in the middle of a write at the time of the fork.
+    pipeline.buffer_lock.acquire()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _logger.log("from the child", step=0, x=1)
+            _logger.flush()
+        finally:
+            os._exit(0)
+    pipeline.buffer_lock.release()
+
+    deadline = time.time() + 30
+    while os.waitpid(pid, os.WNOHANG) == (0, 0):
+        if time.time() > deadline:
+            os.kill(pid, 9)
+            pytest.fail("the child hung on a lock of the parent")
+        time.sleep(0.01)
+    assert "from the child" in (tmp_path / "forked" / "text.log").read_text()
+    assert [row['x'] for row in _logger.load_pkl_log("metrics.pkl")] == [1]
+
+
+def test_list_dirs(setup, log_dir):
+    import time
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'list_test'))
+    _logger.remove('')
+    _logger.list_dirs()  # builds the index from disk
+    for lr in ["0.1", "0.01", "0.001"]:
+        for seed in range(3):
+            _logger.log_text("ok", f"lr-{lr}/seed-{seed}/status.txt")
+            time.sleep(0.001)
+
+    page = _logger.list_dirs(limit=5)
+    paths = [path for path, _ in page['entries']]
+    while page['cursor'] is not None:
+        page = _logger.list_dirs(limit=5, cursor=page['cursor'])
+        paths += [path for path, _ in page['entries']]
+    assert len(paths) == 12 and paths == sorted(paths), "3 lr and 9 seed directories, in order"
+
+    newest = _logger.list_dirs(pattern="*/seed-*", sort="mtime", limit=2)
+    assert [path for path, _ in newest['entries']] == \
+           [pathJoin(_logger.prefix, f"lr-0.001/seed-{i}") for i in (2, 1)]
+
+    _logger.remove("lr-0.1")
+    assert not _logger.list_dirs("lr-0.1/")['entries']
+    assert len(_logger.list_dirs("lr-0.01")['entries']) == 4, "lr-0.01 itself and its seeds stay"
+
+
+def test_directory_index(tmp_path, monkeypatch):
+    import threading
+    from ml_logger.directory_index import DirectoryIndex
+
+    for path in ["a/x", "b/y"]:
+        (tmp_path / path).mkdir(parents=True)
+    index = DirectoryIndex(str(tmp_path))
+    walking, released = threading.Event(), threading.Event()
+    walk = index._walk
+
+    def blocked():
+        walking.set()
+        released.wait(5)
+        return walk()
+
+    monkeypatch.setattr(index, "_walk", blocked)
+    index.start()
+    assert walking.wait(5)
+    index.touch("c/z/file.txt", mtime=1e10)
+    index.discard("b")
+    released.set()
+    assert [path for path, _ in index.list()['entries']] == ["a", "a/x", "c", "c/z"], \
+        "the writes made during the walk are replayed on it"
+
+    def by_mtime():
+        assert index.by_mtime == sorted((-mtime, path) for path, mtime in index.mtimes.items())
+        return [path for path, _ in index.list(sort="mtime")['entries']]
+
+    assert by_mtime()[:2] == ["c", "c/z"]
+    index.touch("a/x/file.txt", mtime=2e10)
+    assert by_mtime() == ["a", "a/x", "c", "c/z"], "a write moves its directories to the front"
+    for i in range(100):
+        index.touch(f"d/{i}/file.txt", mtime=3e10 + i)
+    assert by_mtime()[:3] == ["d", "d/99", "d/98"]
+    index.discard("a/x")
+    index.discard("d")
+    assert by_mtime() == ["a", "c", "c/z"]
+
+
+def test_tail_pkl_log(setup, log_dir):
+    import threading
+    import time
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'tail_test'))
+    _logger.remove('metrics.pkl')
+    for step in range(3):
+        _logger.log(step=step, loss=step, silent=True)
+    _logger.flush()
+
+    rows, offset = _logger.tail_pkl_log(timeout=0)
+    assert [row['loss'] for row in rows] == [0, 1, 2]
+
+    def write_later():
+        time.sleep(0.2)
+        _logger.log(step=3, loss=3, silent=True)
+        _logger.flush()
+
+    threading.Thread(target=write_later).start()
+    start = time.time()
+    rows, offset = _logger.tail_pkl_log(offset=offset, timeout=10)
+    assert [row['loss'] for row in rows] == [3], "only the new row comes through"
+    assert time.time() - start < 5, "the write wakes up the tail, before the timeout"
+
+    res = _logger.logger.tail(pathJoin(_logger.prefix, 'metrics.pkl'), record=2, timeout=0)
+    assert [r['loss'] for r in res['records']] == [2, 3] and res['record'] == 4
+
+
+def test_print_interval(setup, log_dir):
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'print_interval_test'), print_interval=60)
+    _logger.remove('metrics.pkl')
+    printed = []
+    _logger._print_table = lambda data, *_: printed.append(data['epoch'])
+    for step in range(10):
+        _logger.log(step=step, epoch=step)
+    _logger.flush()
+    _logger.renderer.flush()
+
+    assert len(printed) <= 2, "the tables should be rate-limited on the console"
+    assert printed[-1] == 9, "the latest table should be printed"
+    assert len(_logger.load_pkl_log('metrics.pkl')) == 10, "every step should still be logged"
+
+
+def test_policies(setup, log_dir):
+    from ml_logger import ML_Logger, Every, LogSpaced, ReservoirSample
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'policy_test'))
+    _logger.remove('metrics.pkl')
+    _logger.remove('samples.pkl')
+    _logger.set_policy(loss=Every(10), grad=LogSpaced(2), hist=ReservoirSample(5))
+    for step in range(100):
+        _logger.log(step=step, loss=step, grad=step, hist=[step] * 3, silent=True)
+    _logger.flush()
+    _logger.flush_samples()
+
+    rows = _logger.load_pkl_log('metrics.pkl')
+    assert [r['loss'] for r in rows if 'loss' in r] == list(range(0, 100, 10))
+    assert [r['grad'] for r in rows if 'grad' in r] == [0, 1, 2, 4, 8, 16, 32, 64]
+    assert all('hist' not in r for r in rows), "reservoir values should not go into the metrics"
+    samples = _logger.load_pkl_log('samples.pkl')
+    assert len(samples) == 5 and all(s['hist'] == [s['_step']] * 3 for s in samples)
+
+
+def test_log_batch(setup, log_dir):
+    import numpy as np
+    from ml_logger import ML_Logger
+
+    _logger = ML_Logger(log_dir, prefix=pathJoin(logger.prefix, 'batch_test'))
+    _logger.remove('metrics.pkl')
+    rewards, observations = np.random.randn(1000), np.random.randn(1000, 3)
+    _logger.log_batch(steps=np.arange(1000), reward=rewards, obs=observations)
+    with pytest.raises(AssertionError):
+        _logger.log_batch(steps=np.arange(10), reward=rewards)
+    _logger.flush()
+
+    assert len(_logger.load_pkl_log('metrics.pkl', expand=False)) == 1, "the batch should be a single record"
+    rows = _logger.load_pkl_log('metrics.pkl')
+    assert [row['_step'] for row in rows] == list(range(1000))
+    assert np.allclose([row['reward'] for row in rows], rewards)
+    assert np.allclose(rows[10]['obs'], observations[10])
+    assert rows[0]['_timestamp'] == rows[-1]['_timestamp']
+
+
+def test_load_pickle_as_dataframe(tmp_path):
+    import dill
+    import numpy as np
+    import pandas
+    from ml_logger.helpers import load_pickle_as_dataframe, COLUMNAR
+
+    rows = [dict(_step=i, loss=i * 0.5, name=f"run-{i}") for i in range(25)]
+    rows[3]['lr'], rows[20]['lr'] = 0.1, 0.2
+    rows[5]['loss'] = None
+    path = str(tmp_path / 'metrics.pkl')
+    with open(path, 'wb') as f:
+        for row in rows:
+            dill.dump(row, f)
+        dill.dump({COLUMNAR: True, '_step': np.arange(25, 28), 'loss': np.ones(3)}, f)
+
+    df = load_pickle_as_dataframe(path, chunk_size=7)
+    expected = pandas.DataFrame(rows + [dict(_step=25 + i, loss=1.0) for i in range(3)])
+    pandas.testing.assert_frame_equal(df, expected, check_dtype=False)
+    assert df['loss'].dtype == np.float64 and df['_step'].dtype == np.int64
+
+    df = load_pickle_as_dataframe(path, columns=['loss', '_step'], downcast=True, n_rows=28)
+    assert list(df.columns) == ['loss', '_step'] and df['loss'].dtype == np.float32
+
+
+def test_sample(tmp_path):
+    import dill
+    from ml_logger.helpers import sample, sample_pickle, load_from_pickle, pickle_index
+
+    assert list(sample(range(10), 20)) == list(range(10))
+    assert list(sample(range(10 ** 5), 10, seed=0)) == list(sample(range(10 ** 5), 10, seed=0))
+    assert len(set(sample(range(10 ** 5), 10))) == 10
+
+    path = str(tmp_path / 'metrics.pkl')
+    with open(path, 'wb') as f:
+        for i in range(100):
+            dill.dump(dict(_step=i), f)
+    assert pickle_index(path) is None, "the row count is not known before the file is read"
+    rows = list(sample_pickle(path, 10, seed=1))
+    assert len(rows) == 10 and rows == sorted(rows, key=lambda r: r['_step'])
+    assert pickle_index(path).n_rows == 100, "reading the file should index it"
+    assert list(sample_pickle(path, 10, seed=1)) == list(sample_pickle(path, 10, seed=1))
+    assert [r['_step'] for r in sample_pickle(path, 200)] == list(range(100))
+
+
+def test_pickle_index_cap(tmp_path, monkeypatch):
+    import dill
+    from ml_logger import helpers
+
+    # 16 bytes per record, so room for 4 files of 10 records.
+    monkeypatch.setattr(helpers, "MAX_PICKLE_INDEX_BYTES", 4 * 160)
+    monkeypatch.setattr(helpers, "_pickle_indices", type(helpers._pickle_indices)())
+    monkeypatch.setattr(helpers, "_pickle_indices_bytes", 0)
+    paths = [str(tmp_path / f"{i}.pkl") for i in range(10)]
+    for path in paths:
+        with open(path, 'wb') as f:
+            for step in range(10):
+                dill.dump(dict(_step=step), f)
+        list(helpers.load_from_pickle(path))
+        helpers.pickle_index(paths[0])
+    assert len(helpers._pickle_indices) == 4 and helpers._pickle_indices_bytes == 4 * 160, "capped by bytes"
+    assert helpers.pickle_index(paths[0]) is not None, "recently used indices are kept"
+    assert helpers.pickle_index(paths[1]) is None
+
+    cached = helpers.pickle_index(paths[0])
+    with open(paths[0], 'ab') as f:
+        dill.dump(dict(_step=10), f)
+    assert helpers.pickle_index(paths[0]).n_rows == 11
+    assert cached.n_rows == 10, "the cached index is extended on a copy"
+    assert helpers._pickle_indices_bytes == 176 + 2 * 160, "a grown index evicts the least recently used"
+
+    path = str(tmp_path / "long.pkl")
+    with open(path, 'wb') as f:
+        for step in range(100):
+            dill.dump(dict(_step=step), f)
+    list(helpers.load_from_pickle(path))
+    assert helpers.pickle_index(path) is None, "an index larger than the cache is not kept"
+
+
+def test_follow_pickle(tmp_path):
+    import dill
+    from ml_logger.helpers import follow_pickle
+
+    path = str(tmp_path / "metrics.pkl")
+    follower = follow_pickle(path, block=False, inotify=False)
+    assert follower.poll() == [], "the file does not have to exist yet"
+
+    with open(path, 'wb') as f:
+        for step in range(2):
+            dill.dump(dict(step=step), f)
+    third = dill.dumps(dict(step=2))
+    with open(path, 'ab') as f:
+        f.write(third[:5])
+    assert [r['step'] for r in follower] == [0, 1], "the partly written record is left for later"
+
+    with open(path, 'ab') as f:
+        f.write(third[5:])
+        dill.dump(dict(step=3), f)
+    assert [r['step'] for r in follower.poll()] == [2, 3]
+    assert follower.poll() == []
+
+    follower = follow_pickle(path, timeout=0.2, interval=0.05, inotify=False)
+    assert [r['step'] for r in follower] == [0, 1, 2, 3], "stops after waiting for the timeout"
+
+
+def test_read_validators(tmp_path, fake_http):
+    from ml_logger.serdes import deserialize
+    from ml_logger.server import LoggingServer, LoadEntry
+
+    def Request(key, dtype, **headers):
+        return fake_http.Request(LoadEntry(key, dtype)._asdict(), headers)
+
+    server = LoggingServer(str(tmp_path))
+    server.log("blob.bin", bytes(range(100)), dtype="byte")
+    assert server.load("blob.bin", "read", 10, 20) == bytes(range(10, 20))
+    assert server.load("blob.bin", "read", -5) == bytes(range(95, 100))
+
+    res = server.read_handler(Request("blob.bin", "read"))
+    assert res.code == 200 and deserialize(res.text) == bytes(range(100))
+    etag = res.headers['ETag']
+    assert server.read_handler(Request("blob.bin", "read", **{'If-None-Match': etag})).code == 304
+
+    res = server.read_handler(Request("blob.bin", "read", Range="bytes=90-"))
+    assert res.code == 206 and deserialize(res.text) == bytes(range(90, 100))
+    assert res.headers['Content-Range'] == "bytes 90-99/100"
+
+    server.log("blob.bin", b"more", dtype="byte")
+    res = server.read_handler(Request("blob.bin", "read", **{'If-None-Match': etag}))
+    assert res.code == 200 and res.headers['ETag'] != etag, "appending changes the ETag"
+
+
+def test_read_cache(tmp_path, fake_http):
+    from ml_logger.log_client import LogClient
+    from ml_logger.server import LoggingServer
+
+    server = LoggingServer(str(tmp_path / "server"))
+    server.log("params.pkl", dict(lr=0.1), dtype="log")
+    client = LogClient("http://localhost:8081")
+    client.session = fake_http.Session(server)
+    statuses = client.session.statuses
+    assert client.read_pkl("params.pkl") == [dict(lr=0.1)]
+    assert statuses == [200] and client.cache is None, "the cache is off by default"
+
+    client.enable_cache(max_bytes=1 << 20)
+    assert client.read_pkl("params.pkl") == [dict(lr=0.1)]
+    assert client.read_pkl("params.pkl") == [dict(lr=0.1)]
+    assert statuses == [200, 200, 304], "the second read is revalidated, and served from the cache"
+    client.read_pkl("params.pkl", cache=False)
+    assert statuses[-1] == 200, "the bypass always downloads"
+
+    cache = client.enable_cache(max_bytes=1 << 20, disk_dir=str(tmp_path / "cache"), max_age=60)
+    client.read_pkl("params.pkl")
+    del statuses[:]
+    cache.memory.clear()
+    assert client.read_pkl("params.pkl") == [dict(lr=0.1)]
+    assert statuses == [], "fresh entries come from the disk tier without a request"
+    assert client.enable_cache(disk_dir=str(tmp_path / "cache")).disk, "the disk tier outlives the cache"
+
+
+def test_load_many(setup):
+    for seed in range(3):
+        for step in range(2):
+            logger.log_pkl(dict(step=step, loss=0.5 ** step / (seed + 1)), f"sweep/seed-{seed}/metrics.pkl")
+    sleep(1.0)
+    prefixes = [f"sweep/seed-{seed}" for seed in range(3)] + ["sweep/missing"]
+    keys = [os.path.join(logger.prefix, p, "metrics.pkl") for p in prefixes]
+    assert logger.logger.read_many(keys, chunk_size=1, max_parallel=2) == logger.logger.read_many(keys)
+
+    df = logger.load_many(prefixes, max_parallel=2)
+    assert list(df.columns[:1]) == ["prefix"] and len(df) == 6
+    assert sorted(set(df['prefix'])) == prefixes[:3]
+    assert df[df['prefix'] == "sweep/seed-1"]['loss'].tolist() == [0.5, 0.25]
+
+
+def test_remove_to_trash(tmp_path):
+    from ml_logger.server import LoggingServer, TRASH
+
+    server = LoggingServer(str(tmp_path))
+    for i in range(250):
+        server.log(f"exp/images/{i:04d}.txt", "x", dtype="text")
+    server.log("keep/metrics.txt", "x", dtype="text")
+    server.trash.rate = 1000
+    server.remove("exp")
+    assert server.load("exp/images/0000.txt", "read_text") is None, "removed keys miss right away"
+    assert [path for path, _ in server.list()['entries']] == ["keep"]
+    assert server.trash.join(timeout=10)
+    assert server.trash.status() == dict(pending=0, removed=250, current=None)
+    assert os.listdir(tmp_path / TRASH) == []
+
+    server.remove("")
+    assert [name for name in os.listdir(tmp_path) if not name.startswith(".")] == []
+
+
+def test_trash_errors(tmp_path, monkeypatch):
+    from ml_logger.server import LoggingServer, TRASH
+
+    server = LoggingServer(str(tmp_path / "logs"))
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside" / "data.bin").write_bytes(b"x")
+    server.log("run-1/locked.bin", b"x", dtype="byte")
+    os.symlink(tmp_path / "outside", tmp_path / "logs" / "run-1" / "link")
+
+    remove = os.remove
+
+    def locked(path, *args, **kwargs):
+        if os.path.basename(path) == "locked.bin":
+            raise PermissionError(path)
+        return remove(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "remove", locked)
+    server.remove("run-1")
+    assert server.trash.join(timeout=10)
+    assert (tmp_path / "outside" / "data.bin").exists(), "links are unlinked, not followed"
+
+    server.log("run-2/metrics.txt", "x", dtype="text")
+    server.remove("run-2")
+    assert server.trash.join(timeout=10) and server.trash.thread.is_alive(), "the trash keeps going"
+    assert server.trash.status()['removed'] == 1
+    trashed, = os.listdir(tmp_path / "logs" / TRASH)
+    assert os.listdir(tmp_path / "logs" / TRASH / trashed) == ["locked.bin"]
+
+
+def test_records(tmp_path):
+    from threading import Thread
+    from ml_logger.server import LoggingServer, LogOptions
+
+    server = LoggingServer(str(tmp_path))
+    options = LogOptions(overwrite=True, write_mode='key')
+
+    def update(i):
+        for j in range(20):
+            server.log("exp/status.yml", {f"worker-{i}": j}, dtype="yaml", options=options)
+
+    threads = [Thread(target=update, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert server.kv.get("exp/status.yml") == {f"worker-{i}": 19 for i in range(4)}, "no update is lost"
+    assert "worker-3: 19" in server.load("exp/status.yml", "read_text")
+
+    server.ping("exp", "running")
+    assert "status: running" in server.load("exp/__presence", "read_text")
+    server.log("exp/parameters.pkl", dict(Args=dict(lr=0.1)), dtype="log")
+    assert server.load("exp/parameters.yml", "read").startswith(b"Args:")
+    assert [path for path, _ in server.list()['entries']] == ["exp"]
+
+    server.remove("exp")
+    assert server.kv.list() == [] and server.load("exp/__presence", "read_text") is None
+
+
+def test_query_params(tmp_path):
+    from ml_logger.server import LoggingServer
+
+    server = LoggingServer(str(tmp_path))
+    for lr in [1e-4, 3e-4]:
+        for seed in range(8):
+            params = dict(Args=dict(lr=lr, seed=seed, env="Ant-v2" if seed % 2 else "Hopper-v2"))
+            server.log(f"sweep/lr-{lr}/seed-{seed}/parameters.pkl", params, dtype="log")
+
+    assert server.query_params([("Args.lr", "==", 3e-4), ("Args.seed", "<", 3)]) == \
+           [f"sweep/lr-0.0003/seed-{seed}" for seed in range(3)]
+    assert server.query_params([("Args.env", "prefix", "Ant"), ("Args.seed", "in", [1, 2, 3])],
+                               prefix="sweep/lr-0.0001") == ["sweep/lr-0.0001/seed-1", "sweep/lr-0.0001/seed-3"]
+    assert len(server.query_params()) == 16
+
+    server.log("sweep/lr-0.0001/seed-0/parameters.pkl", dict(Eval=dict(seed=10)), dtype="log")
+    assert server.query_params([("Eval.seed", ">=", 10), ("Args.lr", "==", 1e-4)]) == ["sweep/lr-0.0001/seed-0"], \
+        "sections logged later are merged in"
+    server.remove("sweep/lr-0.0003")
+    assert len(server.query_params()) == 8
+
+    server.kv.delete("")
+    server.reindex_params()
+    assert len(server.query_params([("Args.seed", "!=", 0)])) == 7
+
+    from ml_logger.server import LogOptions
+    server.log("exp/parameters.pkl", dict(Args=dict(lr=0.1), Old=dict(x=1)), dtype="log")
+    server.log("exp/parameters.pkl", dict(Args=dict(lr=0.2)), dtype="log", options=LogOptions(overwrite=True))
+    assert server.query_params([("Old.x", "==", 1)]) == [], "overwriting the file replaces the parameters"
+    assert server.query_params([("Args.lr", "==", 0.2)]) == ["exp"]
+    server.log("exp/parameters.pkl", [dict(Old=dict(x=2)), dict(New=dict(y="a"))], dtype="log_many")
+    assert server.query_params([("Old.x", "==", 2), ("New.y", "==", "a"), ("Args.lr", "==", 0.2)]) == ["exp"]
+
+
+def test_archive(tmp_path):
+    import numpy as np
+    from ml_logger.archive import ARCHIVE
+    from ml_logger.server import LoggingServer
+
+    server = LoggingServer(str(tmp_path))
+    for i in range(20):
+        server.log(f"run-1/images/{i:03d}.png", bytes([i]) * 100, dtype="byte")
+    server.log("run-1/metrics.pkl", dict(step=0), dtype="log")
+    server.log("run-1/metrics.pkl", dict(step=1), dtype="log")
+    server.log("run-1/notes.txt", "finished", dtype="text")
+    np.save(tmp_path / "run-1" / "weights.npy", np.arange(5))
+
+    assert server.archive("run-1") == 23
+    assert server.trash.join(timeout=10)
+    assert not (tmp_path / "run-1").exists() and (tmp_path / ("run-1" + ARCHIVE)).is_file()
+    assert server.load("run-1/images/007.png", "read") == bytes([7]) * 100
+    assert server.load("run-1/images/007.png", "read", -10) == bytes([7]) * 10
+    assert server.load("run-1/metrics.pkl", "read_pkl") == [dict(step=0), dict(step=1)]
+    assert server.load("run-1/notes.txt", "read_text") == "finished"
+    assert server.load("run-1/weights.npy", "read_np").tolist() == list(range(5))
+    assert server.load("run-1/missing.txt", "read_text") is None
+    assert [path for path, _ in server.list()['entries']] == ["run-1"]
+
+    assert server.unarchive("run-1") == 23
+    assert (tmp_path / "run-1" / "images" / "019.png").read_bytes() == bytes([19]) * 100
+    assert not (tmp_path / ("run-1" + ARCHIVE)).exists()
+
+    server.archive("run-1")
+    server.remove("run-1")
+    assert server.load("run-1/notes.txt", "read_text") is None
+
+
+def test_read_range_archived(tmp_path, fake_http):
+    from ml_logger.log_client import LogClient
+    from ml_logger.server import LoggingServer, LogOptions
+
+    server = LoggingServer(str(tmp_path))
+    server.log("run-1/blob.bin", bytes(range(100)), dtype="byte")
+    server.log("run-1/status.yml", dict(status="done"), dtype="yaml", options=LogOptions(overwrite=True))
+    server.archive("run-1")
+    client = LogClient("http://localhost:8081")
+    client.session = fake_http.Session(server)
+    statuses = client.session.statuses
+    assert client.read("run-1/blob.bin", 10, 20) == bytes(range(10, 20))
+    assert client.read("run-1/blob.bin", -5) == bytes(range(95, 100))
+    assert client.read("run-1/blob.bin", 200) == b""
+    assert statuses == [206, 206, 416]
+    assert client.read("run-1/status.yml", 0, 6) == b"status"
+    assert statuses[-1] == 206, "records are read by range as well"
+
+    class Ignored(fake_http.Session):
+        """a server that sends the whole file whatever the range."""
+
+        def get(self, url, json=None, headers=None, **kwargs):
+            return super().get(url, json=json, **kwargs)
+
+    client.session = Ignored(server)
+    assert client.read("run-1/blob.bin", 10, 20) == bytes(range(10, 20))
+
+
+def test_presence_expiry(tmp_path, monkeypatch):
+    from ml_logger import server as server_module
+    from ml_logger.server import LoggingServer
+
+    server = LoggingServer(str(tmp_path))
+    server.ping("sweep/run-1", "running")
+    server.ping("sweep/run-2", "running")
+    assert server.broadcast("sweep", "stop") == ["sweep/run-1", "sweep/run-2"]
+    server.remove("sweep/run-1")
+    assert list(server.presence) == list(server.mailbox) == ["sweep/run-2"], "removed experiments are dropped"
+
+    monkeypatch.setattr(server_module, "MAX_PRESENCE", 2)
+    for i in range(3, 6):
+        server.ping(f"sweep/run-{i}", "running")
+    assert list(server.presence) == ["sweep/run-4", "sweep/run-5"]
+    assert "sweep/run-2" not in server.mailbox, "undelivered broadcasts expire with the experiment"
+
+    monkeypatch.setattr(server_module, "PRESENCE_TTL", 0)
+    sleep(0.01)
+    server.ping("sweep/run-5", "done")
+    assert list(server.presence) == ["sweep/run-5"]